@@ -16,6 +16,27 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///server/db.sqlite3'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['CLIENT_PATH'] = app.root_path + '/client/'
+# Byte budget of the in-memory cache for rendered image tiles
+app.config['TILE_CACHE_MAX_BYTES'] = 512 * 1024 * 1024
+# Background threads warming the tile cache with neighboring tiles (0 disables prefetching)
+app.config['TILE_PREFETCH_WORKERS'] = 4
+app.config['TILE_PREFETCH_QUEUE_SIZE'] = 64
+# Memory budget of the datasources kept loaded at once, the least recently used ones are evicted beyond it
+app.config['DATASOURCE_MEMORY_BUDGET'] = 4 * 1024 * 1024 * 1024
+# Memory budget per datasource of feature columns loaded on demand, beyond the coordinate and phenotype columns
+app.config['FEATURE_COLUMN_CACHE_BYTES'] = 1024 * 1024 * 1024
+# Background threads loading datasources, and the datasources they load at server start ('*' for all)
+app.config['DATASOURCE_LOAD_WORKERS'] = 2
+app.config['PRELOAD_DATASOURCES'] = []
+# Most cells a viewport query returns, and the screen pixels between sampled cells when zoomed out
+app.config['VIEWPORT_MAX_POINTS'] = 50000
+app.config['VIEWPORT_SAMPLE_SPACING'] = 4
+# Worker processes computing the neighborhood composition of all cells
+app.config['NEIGHBORHOOD_WORKERS'] = 4
+# Worker processes computing spatial correlations of markers
+app.config['SPATIAL_CORR_WORKERS'] = 4
+# Worker processes computing spatial statistics of phenotype pairs
+app.config['SPATIAL_STATS_WORKERS'] = 4
 
 # If you're running the pyinstaller version of the code, create a
 # new directory for the data (this will be at ~/ on mac)
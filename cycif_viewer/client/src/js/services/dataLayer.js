@@ -16,21 +16,54 @@ class DataLayer {
         this.x = this.config["featureData"][dataSrcIndex]["xCoordinate"];
         this.y = this.config["featureData"][dataSrcIndex]["yCoordinate"];
         this.phenotypes = [];
+        // Datasource version, tiles requested with it are cached by the browser until a re-import
+        this.version = null;
     }
 
     async init() {
         try {
+            // Loading runs in the background on the server, poll until it is done instead of holding a request open
             let response = await fetch('/init_database?' + new URLSearchParams({
-                datasource: datasource
+                datasource: datasource,
+                async: true
             }))
             let response_data = await response.json();
+            let job = response_data.job;
+            while (job.state === 'queued' || job.state === 'running') {
+                await new Promise(resolve => setTimeout(resolve, 500));
+                response = await fetch('/get_load_status?' + new URLSearchParams({
+                    job: job.id
+                }))
+                response_data = await response.json();
+                job = response_data.job;
+            }
+            if (job.state === 'failed') {
+                throw job.error;
+            }
             this.phenotypes = await this.getPhenotypes();
+            this.version = await this.getDatasourceVersion();
 
         } catch (e) {
             console.log("Error Initializing Dataset", e);
         }
     }
 
+    async getDatasourceVersion() {
+        try {
+            let response = await fetch('/get_datasource_version?' + new URLSearchParams({
+                datasource: datasource
+            }))
+            let response_data = await response.json();
+            return response_data.version;
+        } catch (e) {
+            console.log("Error Getting Datasource Version", e);
+        }
+    }
+
+    getTileUrl(url) {
+        return this.version ? url + '?' + new URLSearchParams({v: this.version}) : url;
+    }
+
     async getRow(row) {
         try {
             let response = await fetch('/get_database_row?' + new URLSearchParams({
@@ -124,6 +157,78 @@ class DataLayer {
         }
     }
 
+    // Nearest cells of many [x, y] points in one request, columnar: the k ids and distances of point i are at
+    // [i * k, (i + 1) * k), each requested field lines up with them
+    async getNearestCells(points, k = 1, fields = []) {
+        try {
+            let response = await fetch('/get_nearest_cells', {
+                method: 'POST',
+                body: new URLSearchParams({
+                    points: JSON.stringify(points),
+                    k: k,
+                    fields: JSON.stringify(fields),
+                    datasource: datasource
+                })
+            });
+            return await response.json();
+        } catch (e) {
+            console.log("Error Getting Nearest Cells", e);
+        }
+    }
+
+    // Neighborhoods of many [x, y] points in one request, columnar: the cells of point i are at
+    // [offsets[i], offsets[i + 1]). maxDistance is one radius or one per point
+    async getNeighborhoods(maxDistance, points, fields = []) {
+        try {
+            let response = await fetch('/get_neighborhoods', {
+                method: 'POST',
+                body: new URLSearchParams({
+                    points: JSON.stringify(points),
+                    radius: JSON.stringify(maxDistance),
+                    fields: JSON.stringify(fields),
+                    datasource: datasource
+                })
+            });
+            return await response.json();
+        } catch (e) {
+            console.log("Error Getting Neighborhoods", e);
+        }
+    }
+
+    // Cells in a rectangle {rect: [x0, y0, x1, y1]} or lasso {polygon: [[x, y], ...]}, columnar ids and fields
+    async getSelectedCells(selection, fields = []) {
+        try {
+            let params = {fields: JSON.stringify(fields), datasource: datasource};
+            if (selection.polygon) {
+                params.polygon = JSON.stringify(selection.polygon);
+            } else {
+                params.rect = JSON.stringify(selection.rect);
+            }
+            let response = await fetch('/get_selected_cells', {method: 'POST', body: new URLSearchParams(params)});
+            return await response.json();
+        } catch (e) {
+            console.log("Error Getting Selected Cells", e);
+        }
+    }
+
+    // Cells of a viewport [x0, y0, x1, y1] at a pyramid level, sampled when zoomed out. Each page is spread
+    // over the whole viewport, so pages can be drawn as they arrive
+    async getViewportCells(rect, level, fields = [], page = 0, pageSize = 10000) {
+        try {
+            let response = await fetch('/get_viewport_cells?' + new URLSearchParams({
+                rect: rect.join(','),
+                level: level,
+                page: page,
+                pageSize: pageSize,
+                fields: JSON.stringify(fields),
+                datasource: datasource
+            }));
+            return await response.json();
+        } catch (e) {
+            console.log("Error Getting Viewport Cells", e);
+        }
+    }
+
     async getNeighborhoodForCell(maxDistance, selectedCell) {
         return this.getNeighborhood(maxDistance, selectedCell[this.x], selectedCell[this.y]);
     }
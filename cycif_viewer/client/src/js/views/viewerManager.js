@@ -74,7 +74,7 @@ export class ViewerManager {
                 tileWidth: this.imageViewer.config['tileWidth'],
                 tileHeight: this.imageViewer.config['tileHeight'],
                 getTileUrl: function (level, x, y) {
-                    return `${src}${maxLevel - level}/${x}_${y}.png`
+                    return dataLayer.getTileUrl(`${src}${maxLevel - level}/${x}_${y}.png`)
                 }
             },
             // index: 0,
@@ -183,7 +183,7 @@ export class ViewerManager {
                     tileWidth: this.imageViewer.config['tileWidth'],
                     tileHeight: this.imageViewer.config['tileHeight'],
                     getTileUrl: function (level, x, y) {
-                        return `${url}${maxLevel - level}/${x}_${y}.png`
+                        return dataLayer.getTileUrl(`${url}${maxLevel - level}/${x}_${y}.png`)
                     }
                 },
                 index: 0,
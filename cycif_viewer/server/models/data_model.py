@@ -1,4 +1,3 @@
-from sklearn.neighbors import BallTree
 import numpy as np
 import pandas as pd
 from PIL import ImageColor
@@ -6,10 +5,21 @@ import json
 import os
 from pathlib import Path
 from ome_types import from_xml
-from cycif_viewer import config_json_path, data_path
+from cycif_viewer import app, config_json_path, data_path, get_config_names
 from cycif_viewer.server.utils import pyramid_assemble
+from cycif_viewer.server.utils import aggregate_tiles, derived_pyramid, feature_cache, feature_table, intensity_stats
+from cycif_viewer.server.utils import label_colors, neighborhoods
+from cycif_viewer.server.utils import segmentation_outlines, spatial_correlation, spatial_index, spatial_statistics
+from cycif_viewer.server.utils import tile_compositing, tile_encoding
+from cycif_viewer.server.utils.datasource_registry import Datasource, DatasourceRegistry
+from cycif_viewer.server.utils.load_jobs import LoadJobs
+from cycif_viewer.server.utils.tile_cache import TileCache
+from cycif_viewer.server.utils.tile_prefetch import TilePrefetcher
 from cycif_viewer.server.models import database_model
 import dateutil.parser
+import hashlib
+import sys
+import threading
 import time
 import pickle
 import tifffile as tf
@@ -18,74 +28,314 @@ import zarr
 from dask import dataframe as dd
 import cv2
 
-ball_tree = None
-database = None
-source = None
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak memory is then not logged
+    resource = None
+
 config = None
-seg = None
-channels = None
-metadata = None
+# Serializes read-modify-write cycles of config.json
+config_lock = threading.Lock()
+datasource_versions = {}
+intensity_stats_cache = {}
+label_luts = {}
+# (datasource, phenotype column) -> (codes, phenotypes, digest) for aggregate tiles and neighborhoods
+phenotype_codes = {}
+tile_cache = TileCache(app.config['TILE_CACHE_MAX_BYTES'])
+tile_prefetcher = TilePrefetcher(lambda key, generation: prefetch_tile(key, generation),
+                                 app.config['TILE_PREFETCH_WORKERS'],
+                                 app.config['TILE_PREFETCH_QUEUE_SIZE'])
+datasources = DatasourceRegistry(app.config['DATASOURCE_MEMORY_BUDGET'], on_evict=lambda name: evict_datasource(name),
+                                 derived_memory=lambda name: get_derived_memory(name))
+load_jobs = LoadJobs(lambda name, reload, params: load_datasource(name, reload=reload),
+                     app.config['DATASOURCE_LOAD_WORKERS'])
+neighborhood_jobs = LoadJobs(lambda name, reload, params: compute_neighborhoods(name, params, reload=reload), 1,
+                             name='neighborhoods')
+spatial_corr_jobs = LoadJobs(lambda name, reload, params: spatial_corr(name, params, reload=reload), 1,
+                             name='spatial-corr')
+spatial_stats_jobs = LoadJobs(lambda name, reload, params: spatial_stats(name, params, reload=reload), 1,
+                              name='spatial-stats')
+# Stage of the datasources being loaded, and the percentage of the load done when each stage starts. Entries
+# are removed once their load is over.
+load_progress = {}
+load_progress_lock = threading.Lock()
+LOAD_STAGES = {'features': 0, 'index': 40, 'segmentation': 70, 'metadata': 85, 'ready': 100}
 
 
 def init(datasource_name):
-    load_ball_tree(datasource_name)
+    load_datasource(datasource_name)
 
 
 def load_datasource(datasource_name, reload=False):
-    global datasource
-    global source
-    global config
-    global seg
-    global channels
-    global metadata
-    if source is datasource_name and datasource is not None and reload is False:
-        return
-    load_config(datasource_name)
+    """
+    Returns the loaded datasource, loading it first if it is not resident. Concurrent requests for a datasource
+    that is being loaded wait for that load instead of starting their own. A reload swaps in a fully loaded
+    new datasource, queries already running keep reading the old one.
+    """
+    try:
+        loaded = datasources.load(datasource_name, lambda name: build_datasource(name, reload), reload=reload)
+    finally:
+        # The registry reports ready or failed from now on, unless another load has started meanwhile
+        with load_progress_lock:
+            if not datasources.is_loading(datasource_name):
+                load_progress.pop(datasource_name, None)
     if reload:
-        load_ball_tree(datasource_name, reload=reload)
+        drop_derived_state(datasource_name)
+        tile_prefetcher.cancel(datasource_name)
+        tile_cache.invalidate(datasource_name)
+    return loaded
+
+
+def start_datasource_load(datasource_name, reload=False):
+    """
+    Starts loading a datasource in the background and returns the load job, without waiting for it.
+    """
+    if datasource_name not in get_config_names():
+        raise ValueError('Unknown datasource ' + str(datasource_name))
+    return load_jobs.start(datasource_name, reload).to_dict()
+
+
+def preload_datasources():
+    names = app.config['PRELOAD_DATASOURCES']
+    if names == '*':
+        names = get_config_names()
+    for name in names:
+        print('Preloading datasource', name)
+        start_datasource_load(name)
+
+
+def get_load_status(datasource_name=None, job_id=None):
+    """
+    Readiness of a datasource, or of the datasource of a load job. While it is being loaded, stage is one of
+    features, index, segmentation and metadata and percent is the share of the load done. Returns None for
+    unknown jobs.
+    """
+    job = load_jobs.get(job_id) if job_id is not None else load_jobs.latest(datasource_name)
+    if job_id is not None and job is None:
+        return None
+    if job is not None:
+        datasource_name = job.datasource_name
+    ready = datasource_name in datasources
+    if datasources.is_loading(datasource_name):
+        [stage, percent] = load_progress.get(datasource_name, ('features', 0))
+    elif job is not None and job.is_active():
+        [stage, percent] = ['queued', 0]
+    elif ready:
+        [stage, percent] = ['ready', 100]
+    elif job is not None and job.state == 'failed':
+        [stage, percent] = ['failed', 0]
+    else:
+        [stage, percent] = ['not loaded', 0]
+    return {'datasource': datasource_name, 'ready': ready, 'stage': stage, 'percent': percent,
+            'job': job.to_dict() if job is not None else None}
+
+
+def report_load_stage(datasource_name, stage):
+    with load_progress_lock:
+        load_progress[datasource_name] = (stage, LOAD_STAGES[stage])
+
+
+def build_datasource(datasource_name, reload=False):
+    """
+    Loads everything of a datasource in one pass: the feature table is parsed once, and the spatial index
+    is built from its in-memory coordinate columns if it was not saved before. Stage timings and peak memory
+    are logged.
+    """
+    start = time.time()
+    config = load_config(datasource_name)
+    loaded = Datasource(datasource_name, config[datasource_name])
+
+    report_load_stage(datasource_name, 'features')
+    stage = time.time()
     csvPath = Path(config[datasource_name]['featureData'][0]['src'])
-    print("Loading csv data.. (this can take some time)")
-    datasource = pd.read_csv(csvPath)
-    datasource['id'] = datasource.index
-    datasource = datasource.replace(-np.Inf, 0)
-    source = datasource_name
+    loaded.data = feature_table.read_features(csvPath, data_path / datasource_name / 'feature_cache',
+                                              **get_feature_options(datasource_name))
+    log_load_stage('Features', stage)
+
+    report_load_stage(datasource_name, 'index')
+    stage = time.time()
+    loaded.spatial_index = open_spatial_index(loaded, reload=reload)
+    log_load_stage('Spatial index', stage)
+
+    report_load_stage(datasource_name, 'segmentation')
+    stage = time.time()
     print("Loading segmentation.")
     if config[datasource_name]['segmentation'].endswith('.zarr'):
-        seg = zarr.load(config[datasource_name]['segmentation'])
+        loaded.seg = zarr.load(config[datasource_name]['segmentation'])
     else:
         seg_io = tf.TiffFile(config[datasource_name]['segmentation'], is_ome=False)
-        seg = zarr.open(seg_io.series[0].aszarr())
-    channel_io = tf.TiffFile(config[datasource_name]['channelFile'], is_ome=False)
+        loaded.seg = zarr.open(seg_io.series[0].aszarr())
+    log_load_stage('Segmentation', stage)
+
+    report_load_stage(datasource_name, 'metadata')
+    stage = time.time()
+    [loaded.channels, channel_io] = open_channel_pyramid(datasource_name)
     print("Loading image descriptions.")
     try:
         xml = channel_io.pages[0].tags['ImageDescription'].value
-        metadata = from_xml(xml).images[0].pixels
+        loaded.metadata = from_xml(xml).images[0].pixels
     except:
-        metadata = {}
-    channels = zarr.open(channel_io.series[0].aszarr())
-    print("Data loading done.")
+        loaded.metadata = {}
+    if isinstance(loaded.channels, derived_pyramid.DerivedPyramid) and \
+            config[datasource_name].get('maxLevel', 1) < len(loaded.channels):
+        # Advertise the derived levels of single resolution images to the viewer
+        update_config_value(datasource_name, 'maxLevel', len(loaded.channels))
+    log_load_stage('Images and metadata', stage)
+
+    loaded.measure_memory()
+    report_load_stage(datasource_name, 'ready')
+    log_load_stage('Data loading', start)
+    print('Datasource', datasource_name, 'uses', round(loaded.memory / 1024 ** 2), 'MB')
+    return loaded
+
+
+def drop_derived_state(datasource_name):
+    # Forgets state computed from a datasource, when it is reloaded or evicted
+    datasource_versions.pop(datasource_name, None)
+    for key in [key for key in list(intensity_stats_cache) if key[0] == datasource_name]:
+        intensity_stats_cache.pop(key, None)
+    for key in [key for key in list(label_luts) if key[0] == datasource_name]:
+        label_luts.pop(key, None)
+    for key in [key for key in list(phenotype_codes) if key[0] == datasource_name]:
+        phenotype_codes.pop(key, None)
+
+
+def get_derived_memory(datasource_name):
+    # Bytes of the lookup tables, intensity statistics and phenotype codes kept for a datasource, dropped with
+    # its derived state
+    memory = sum(lut.nbytes for key, lut in list(label_luts.items()) if key[0] == datasource_name)
+    for key, stats in list(intensity_stats_cache.items()):
+        if key[0] == datasource_name:
+            memory += sum(value.nbytes for value in stats.values())
+    for key, [codes, _, _] in list(phenotype_codes.items()):
+        if key[0] == datasource_name:
+            memory += codes.nbytes
+    return memory
+
+
+def evict_datasource(datasource_name):
+    # Rendered tiles stay cached, they are still valid when the datasource is loaded again
+    drop_derived_state(datasource_name)
+    tile_prefetcher.cancel(datasource_name)
+
+
+def get_loaded_datasources():
+    return datasources.stats()
+
+
+def get_feature_options(datasource_name):
+    """
+    Compaction settings of a feature table, from the featureData entry in config.json: floatDtype ('float32'
+    by default, 'float64' keeps full precision), categorical (strings as categoricals, true by default) and
+    excludeColumns, columns that are not loaded. Coordinate and phenotype columns are always loaded, and kept
+    loaded, the other columns are loaded when first used.
+    """
+    features = config[datasource_name]['featureData'][0]
+    required = {features.get('xCoordinate'), features.get('yCoordinate'), features.get('celltype')}
+    exclude_columns = features.get('excludeColumns', [])
+    if required.intersection(exclude_columns):
+        print('Not excluding required columns', sorted(required.intersection(exclude_columns)))
+    return {'pinned_columns': [column for column in required if column is not None],
+            'max_bytes': app.config['FEATURE_COLUMN_CACHE_BYTES'],
+            'exclude_columns': [column for column in exclude_columns if column not in required],
+            'float_dtype': features.get('floatDtype', 'float32'),
+            'categorical': features.get('categorical', True)}
+
+
+def with_ids(rows):
+    # Row ids are the feature table's index, they are only materialized for the rows being returned
+    return rows.assign(id=rows.index.to_numpy())
+
+
+def peak_memory_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def log_load_stage(name, start):
+    peak = peak_memory_mb()
+    memory = ', peak memory ' + str(round(peak)) + ' MB' if peak is not None else ''
+    print(name, 'done in', str(round(time.time() - start, 2)) + 's' + memory)
+
+
+def open_channel_pyramid(datasource_name):
+    """
+    Opens the channel image of a datasource, returns (channels, TiffFile). Single resolution images are
+    wrapped in a DerivedPyramid whose lower resolution levels are built on demand.
+    """
+    channel_file = config[datasource_name]['channelFile']
+    channel_io = tf.TiffFile(channel_file, is_ome=False)
+    pyramid = zarr.open(channel_io.series[0].aszarr())
+    if isinstance(pyramid, zarr.Array) and derived_pyramid.count_levels(pyramid.shape) > 1:
+        directory = data_path / datasource_name
+        directory.mkdir(parents=True, exist_ok=True)
+        pyramid = derived_pyramid.open_derived_pyramid(pyramid, channel_file, directory / 'channel_pyramid.zarr',
+                                                       config[datasource_name]['tileHeight'],
+                                                       config[datasource_name]['tileWidth'])
+    return pyramid, channel_io
+
+
+def update_config_value(datasource_name, key, value):
+    config[datasource_name][key] = value
+    with config_lock, open(config_json_path, "r+") as configJson:
+        config_data = json.load(configJson)
+        config_data[datasource_name][key] = value
+        configJson.seek(0)  # <--- should reset file position to the beginning.
+        json.dump(config_data, configJson, indent=4)
+        configJson.truncate()
+    datasource_versions.pop(datasource_name, None)
+
+
+def get_datasource_version(datasource_name):
+    """
+    Returns (version, last_modified) of a datasource. The version hashes its config entry together with the
+    modification time and size of its feature, channel and segmentation files, so it changes on re-import.
+    """
+    if datasource_name in datasource_versions:
+        return datasource_versions[datasource_name]
+    with open(config_json_path, "r") as configJson:
+        datasource_config = json.load(configJson).get(datasource_name)
+    if datasource_config is None:
+        return None, None
+    paths = [datasource_config.get('channelFile'), datasource_config.get('segmentation')]
+    paths.extend([feature.get(key) for feature in datasource_config.get('featureData', [])
+                  for key in ['src', 'celltypeData']])
+    digest = hashlib.sha1(json.dumps(datasource_config, sort_keys=True).encode())
+    last_modified = 0
+    for path in paths:
+        if path and os.path.exists(path):
+            stat = os.stat(path)
+            digest.update(('%s:%d:%d' % (path, stat.st_mtime_ns, stat.st_size)).encode())
+            last_modified = max(last_modified, int(stat.st_mtime))
+    datasource_versions[datasource_name] = (digest.hexdigest()[:16], last_modified)
+    return datasource_versions[datasource_name]
 
 
 def load_config(datasource_name):
     global config
 
-    with open(config_json_path, "r+") as configJson:
-        config = json.load(configJson)
+    # Built in a local dict and published once complete, other threads keep reading the previous one
+    with config_lock, open(config_json_path, "r+") as configJson:
+        new_config = json.load(configJson)
         updated = False
         # Update Feature SRC
-        original = config[datasource_name]['featureData'][0]['src']
-        config[datasource_name]['featureData'][0]['src'] = original.replace('static/data', 'cycif_viewer/data')
-        csvPath = config[datasource_name]['featureData'][0]['src']
+        original = new_config[datasource_name]['featureData'][0]['src']
+        new_config[datasource_name]['featureData'][0]['src'] = original.replace('static/data', 'cycif_viewer/data')
+        csvPath = new_config[datasource_name]['featureData'][0]['src']
         if Path(csvPath).exists() is False:
             if Path('.' + csvPath).exists():
                 csvPath = '.' + csvPath
-        config[datasource_name]['featureData'][0]['src'] = str(Path(csvPath))
-        if original != config[datasource_name]['featureData'][0]['src']:
+        new_config[datasource_name]['featureData'][0]['src'] = str(Path(csvPath))
+        if original != new_config[datasource_name]['featureData'][0]['src']:
             updated = True
         try:
-            original = config[datasource_name]['segmentation']
-            config[datasource_name]['segmentation'] = original.replace('static/data', 'cycif_viewer/data')
-            if original != config[datasource_name]['segmentation']:
+            original = new_config[datasource_name]['segmentation']
+            new_config[datasource_name]['segmentation'] = original.replace('static/data', 'cycif_viewer/data')
+            if original != new_config[datasource_name]['segmentation']:
                 updated = True
 
         except KeyError:
@@ -93,48 +343,40 @@ def load_config(datasource_name):
 
         if updated:
             configJson.seek(0)  # <--- should reset file position to the beginning.
-            json.dump(config, configJson, indent=4)
+            json.dump(new_config, configJson, indent=4)
             configJson.truncate()
+        config = new_config
+    return config
 
 
-def load_ball_tree(datasource_name_name, reload=False):
-    global ball_tree
-    global datasource
-    global config
-    if datasource_name_name != source:
-        load_datasource(datasource_name_name)
-    pickled_kd_tree_path = str(
-        Path(
-            os.path.join(os.getcwd())) / data_path / datasource_name_name / "ball_tree.pickle")
-    if os.path.isfile(pickled_kd_tree_path) and reload is False:
-        print("Pickled KD Tree Exists, Loading")
-        ball_tree = pickle.load(open(pickled_kd_tree_path, "rb"))
-        print("Pickled KD Tree Loaded.")
-    else:
-        print("Creating KD Tree.")
-        xCoordinate = config[datasource_name_name]['featureData'][0]['xCoordinate']
-        yCoordinate = config[datasource_name_name]['featureData'][0]['yCoordinate']
-        csvPath = Path(config[datasource_name_name]['featureData'][0]['src'])
-        raw_data = pd.read_csv(csvPath)
-        points = pd.DataFrame({'x': raw_data[xCoordinate], 'y': raw_data[yCoordinate]})
-        ball_tree = BallTree(points, metric='euclidean')
-        pickle.dump(ball_tree, open(pickled_kd_tree_path, 'wb'))
-        print('Creating KD Tree done.')
+def open_spatial_index(loaded, reload=False):
+    """
+    Opens the saved grid index of the cell centroids memory mapped, or builds it from the coordinate columns
+    of the feature table when the feature CSV, the coordinate columns or their dtype changed.
+    """
+    directory = data_path / loaded.name
+    features = loaded.config['featureData'][0]
+    x_column = features['xCoordinate']
+    y_column = features['yCoordinate']
+    identity = {'source': feature_cache.source_identity(Path(features['src'])), 'coordinates': [x_column, y_column],
+                'float_dtype': get_feature_options(loaded.name)['float_dtype']}
+    index = spatial_index.open_index(directory / 'spatial_index', loaded.data.column(x_column).to_numpy(),
+                                     loaded.data.column(y_column).to_numpy(), identity, reload=reload)
+    # Replaced by the spatial index
+    if os.path.isfile(directory / 'ball_tree.pickle'):
+        os.remove(directory / 'ball_tree.pickle')
+    return index
 
 
 def query_for_closest_cell(x, y, datasource_name):
-    global datasource
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    distance, index = ball_tree.query([[x, y]], k=1)
-    if distance == np.inf:
+    loaded = load_datasource(datasource_name)
+    [distance, index] = loaded.spatial_index.nearest(x, y, k=1)
+    if len(index) == 0:
         return {}
     #         Nothing found
     else:
         try:
-            row = datasource.iloc[index[0]]
+            row = with_ids(loaded.data.rows(index))
             obj = row.to_dict(orient='records')[0]
             if 'celltype' not in obj:
                 obj['celltype'] = ''
@@ -144,21 +386,14 @@ def query_for_closest_cell(x, y, datasource_name):
 
 
 def get_row(row, datasource_name):
-    global database
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    obj = database.loc[[row]].to_dict(orient='records')[0]
+    loaded = load_datasource(datasource_name)
+    obj = loaded.data.rows([row]).to_dict(orient='records')[0]
     obj['id'] = row
     return obj
 
 
 def get_channel_names(datasource_name, shortnames=True):
-    global datasource
-    global source
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    load_datasource(datasource_name)
     if shortnames:
         channel_names = [channel['name'] for channel in config[datasource_name]['imageData'][1:]]
     else:
@@ -167,15 +402,9 @@ def get_channel_names(datasource_name, shortnames=True):
 
 
 def get_channel_cells(datasource_name, channels):
-    global datasource
-    global source
-    global ball_tree
-
     range = [0, 65536]
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    loaded = load_datasource(datasource_name)
 
     query_string = ''
     for c in channels:
@@ -184,8 +413,8 @@ def get_channel_cells(datasource_name, channels):
         query_string += str(range[0]) + ' < ' + c + ' < ' + str(range[1])
     if query_string == None or query_string == "":
         return []
-    query = datasource.query(query_string)[['id']].to_dict(orient='records')
-    return query
+    query = loaded.data.frame(channels).query(query_string)
+    return pd.DataFrame({'id': query.index}).to_dict(orient='records')
 
 
 def get_phenotype_description(datasource):
@@ -213,15 +442,9 @@ def get_phenotype_column_name(datasource):
 
 
 def get_cells_phenotype(datasource_name):
-    global datasource
-    global source
-    global ball_tree
-
     range = [0, 65536]
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    loaded = load_datasource(datasource_name)
 
     try:
         phenotype_field = config[datasource_name]['featureData'][0]['celltype']
@@ -230,14 +453,11 @@ def get_cells_phenotype(datasource_name):
     except TypeError:
         phenotype_field = 'celltype'
 
-    query = datasource[['id', phenotype_field]].to_dict(orient='records')
+    query = with_ids(loaded.data.frame([phenotype_field]))[['id', phenotype_field]].to_dict(orient='records')
     return query
 
 
 def get_phenotypes(datasource_name):
-    global datasource
-    global source
-    global config
     try:
         phenotype_field = config[datasource_name]['featureData'][0]['celltype']
     except KeyError:
@@ -245,47 +465,74 @@ def get_phenotypes(datasource_name):
     except TypeError:
         phenotype_field = 'celltype'
 
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    if phenotype_field in datasource.columns:
-        return sorted(datasource[phenotype_field].unique().tolist())
+    loaded = load_datasource(datasource_name)
+    if phenotype_field in loaded.data.columns:
+        return sorted(loaded.data.column(phenotype_field).unique().tolist())
     else:
         return ['']
 
 
 def get_neighborhood(x, y, datasource_name, r=100, fields=None):
-    global database
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    index = ball_tree.query_radius([[x, y]], r=r)
-    neighbors = index[0]
+    loaded = load_datasource(datasource_name)
+    neighbors = loaded.spatial_index.radius(x, y, r)
     try:
+        rows = with_ids(loaded.data.rows(neighbors))
         if fields and len(fields) > 0:
             fields.append('id') if 'id' not in fields else fields
             if len(fields) > 1:
-                neighborhood = database.iloc[neighbors][fields].to_dict(orient='records')
+                neighborhood = rows[fields].to_dict(orient='records')
             else:
-                neighborhood = database.iloc[neighbors][fields].to_dict()
+                neighborhood = rows[fields].to_dict()
         else:
-            neighborhood = database.iloc[neighbors].to_dict(orient='records')
+            neighborhood = rows.to_dict(orient='records')
 
         return neighborhood
     except:
         return {}
 
 
+def query_for_closest_cells(points, datasource_name, k=1, fields=()):
+    """
+    Columnar nearest cells of many (x, y) points, answered by one index query: 'id' and 'distance' hold k
+    values per point, point i's are at [i * k:(i + 1) * k] closest first, and each requested field holds the
+    values of those cells.
+    """
+    loaded = load_datasource(datasource_name)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    [distances, ids] = loaded.spatial_index.nearest_batch(points[:, 0], points[:, 1], k=k)
+    result = {'k': ids.shape[1], 'id': ids.ravel(), 'distance': distances.ravel()}
+    result.update(get_field_columns(loaded, ids.ravel(), fields))
+    return result
+
+
+def get_neighborhoods(points, radii, datasource_name, fields=()):
+    """
+    Columnar neighborhoods of many (x, y) points, answered by one index query. radii is a single radius or
+    one per point. The cells within radius of point i are at [offsets[i]:offsets[i + 1]] of 'id', 'distance'
+    and each requested field, in ascending id order.
+    """
+    loaded = load_datasource(datasource_name)
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    [offsets, ids, distances] = loaded.spatial_index.radius_batch(points[:, 0], points[:, 1], radii)
+    result = {'offsets': offsets, 'id': ids, 'distance': distances}
+    result.update(get_field_columns(loaded, ids, fields))
+    return result
+
+
+def get_field_columns(loaded, ids, fields):
+    # Raises KeyError for unknown fields. Non numeric columns (phenotypes) are lists, numpy object arrays
+    # do not serialize
+    rows = loaded.data.rows(ids, [field for field in fields if field != 'id'])
+    columns = {}
+    for field in rows.columns:
+        values = rows[field]
+        columns[field] = values.to_numpy() if values.dtype.kind in 'biuf' else values.tolist()
+    return columns
+
+
 def get_number_of_cells_in_circle(x, y, datasource_name, r):
-    global source
-    global ball_tree
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    index = ball_tree.query_radius([[x, y]], r=r)
-    try:
-        return len(index[0])
-    except:
-        return 0
+    loaded = load_datasource(datasource_name)
+    return loaded.spatial_index.count_radius(x, y, r)
 
 
 def get_color_scheme(datasource_name, refresh, label_field='celltype'):
@@ -300,6 +547,13 @@ def get_color_scheme(datasource_name, refresh, label_field='celltype'):
     if label_field == 'celltype':
         labels = get_phenotypes(datasource_name)
         print(labels)
+    else:
+        values = load_datasource(datasource_name).data.column(label_field)
+        # Continuous values have no categories to color
+        if not (pd.api.types.is_integer_dtype(values) or pd.api.types.is_bool_dtype(values)
+                or pd.api.types.is_object_dtype(values) or pd.api.types.is_categorical_dtype(values)):
+            raise ValueError('Label field ' + str(label_field) + ' is not categorical')
+        labels = sorted(values.dropna().unique().tolist())
     labels.append('SelectedCluster')
     color_scheme = {}
     colors = ["#e41a1c", "#377eb8", "#4daf4a", "#984ea3", "#ff7f00", "#a65628", "#f781bf", "#808080", "#7A4900",
@@ -332,6 +586,8 @@ def get_color_scheme(datasource_name, refresh, label_field='celltype'):
               "#83A485", "#453C23", "#47675D", "#3A3F00", "#061203", "#DFFB71", "#868E7E", "#98D058", "#6C8F7D",
               "#D7BFC2", "#3C3E6E", "#D83D66", "#2F5D9B", "#6C5E46", "#D25B88", "#5B656C", "#00B57F", "#545C46",
               "#866097", "#365D25", "#252F99", "#00CCFF", "#674E60", "#FC009C", "#92896B"]
+    if len(labels) > len(colors):
+        raise ValueError('Label field ' + str(label_field) + ' has more values than there are colors')
     for i in range(len(labels)):
         color_scheme[str(labels[i])] = {}
         color_scheme[str(labels[i])]['rgb'] = list(ImageColor.getcolor(colors[i], "RGB"))
@@ -342,23 +598,14 @@ def get_color_scheme(datasource_name, refresh, label_field='celltype'):
 
 
 def get_rect_cells(datasource_name, rect, channels):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    loaded = load_datasource(datasource_name)
 
     # Query
-    index = ball_tree.query_radius([[rect[0], rect[1]]], r=rect[2])
-    print('Query size:', len(index[0]))
-    neighbors = index[0]
+    neighbors = loaded.spatial_index.radius(rect[0], rect[1], rect[2])
+    print('Query size:', len(neighbors))
     try:
         neighborhood = []
-        for neighbor in neighbors:
-            row = datasource.iloc[[neighbor]]
-            obj = row.to_dict(orient='records')[0]
+        for obj in with_ids(loaded.data.rows(neighbors)).to_dict(orient='records'):
             if 'celltype' not in obj:
                 obj['celltype'] = ''
             neighborhood.append(obj)
@@ -367,14 +614,129 @@ def get_rect_cells(datasource_name, rect, channels):
         return {}
 
 
-def get_gated_cells(datasource_name, gates):
-    global datasource
-    global source
-    global ball_tree
+def get_selected_cells(datasource_name, rect=None, polygon=None, fields=()):
+    """
+    Columnar selection of the cells in a rectangle [x0, y0, x1, y1] or a polygon (lasso) of [x, y] vertices:
+    'id' in ascending order and the values of each requested field for those cells.
+    """
+    loaded = load_datasource(datasource_name)
+    if polygon is not None:
+        ids = loaded.spatial_index.polygon(polygon)
+    else:
+        [x0, y0, x1, y1] = [float(value) for value in rect]
+        ids = loaded.spatial_index.rect(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+    result = {'id': ids}
+    result.update(get_field_columns(loaded, ids, fields))
+    return result
+
+
+def start_neighborhood_job(datasource_name, params, reload=False):
+    """
+    Starts computing the neighborhood composition of all cells of a datasource in the background, params are
+    {'k': k} or {'radius': radius}. Returns the job, its status is polled through get_neighborhood_status.
+    """
+    if datasource_name not in get_config_names():
+        raise ValueError('Unknown datasource ' + str(datasource_name))
+    return neighborhood_jobs.start(datasource_name, reload, params).to_dict()
+
+
+def get_neighborhood_status(datasource_name=None, params=None, job_id=None):
+    # Whether a composition is computed, and its latest job. Returns None for unknown jobs
+    job = neighborhood_jobs.get(job_id) if job_id is not None else neighborhood_jobs.latest(datasource_name, params)
+    if job_id is not None and job is None:
+        return None
+    if job is not None:
+        [datasource_name, params] = [job.datasource_name, job.params]
+    ready = datasource_name in datasources and get_neighborhood_composition(datasource_name, params)[0] is not None
+    return {'datasource': datasource_name, 'params': params, 'ready': ready,
+            'job': job.to_dict() if job is not None else None}
 
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+
+def get_neighborhood_path(datasource_name, params):
+    return data_path / datasource_name / 'neighborhoods' / neighborhoods.result_name(params)
+
+
+def get_neighborhood_identity(datasource_name):
+    # A composition depends on the cell positions, like the spatial index, and on the phenotype column
+    loaded = load_datasource(datasource_name)
+    [_, _, digest] = get_phenotype_codes(datasource_name)
+    return {'index': loaded.spatial_index.header['identity'], 'phenotypes': digest}
+
+
+def compute_neighborhoods(datasource_name, params, reload=False):
+    loaded = load_datasource(datasource_name)
+    path = get_neighborhood_path(datasource_name, params)
+    identity = get_neighborhood_identity(datasource_name)
+    if not reload and neighborhoods.load_composition(path, identity) is not None:
+        return
+    [codes, phenotypes, _] = get_phenotype_codes(datasource_name)
+    index_path = data_path / datasource_name / 'spatial_index'
+    neighborhoods.compute_composition(loaded.spatial_index, index_path, codes, len(phenotypes), params, path,
+                                      identity, num_workers=app.config['NEIGHBORHOOD_WORKERS'])
+
+
+def get_neighborhood_composition(datasource_name, params):
+    """
+    Neighbor counts per phenotype of every cell, shaped (cells, phenotypes) and memory mapped, or None if it
+    was not computed for the current data, and the phenotypes.
+    """
+    [_, phenotypes, _] = get_phenotype_codes(datasource_name)
+    composition = neighborhoods.load_composition(get_neighborhood_path(datasource_name, params),
+                                                 get_neighborhood_identity(datasource_name))
+    return composition, phenotypes
+
+
+def get_cellular_neighborhoods(datasource_name, params, num_clusters):
+    """
+    Cluster (cellular neighborhood) of every cell by its neighborhood composition, with the mean phenotype
+    fractions of each cluster. Clusters are computed once per composition and number of clusters. Returns
+    None if the composition was not computed.
+    """
+    [composition, phenotypes] = get_neighborhood_composition(datasource_name, params)
+    if composition is None:
+        return None
+    path = get_neighborhood_path(datasource_name, params)
+    clusters = neighborhoods.load_clusters(path, num_clusters)
+    if clusters is None:
+        print('Clustering', len(composition), 'neighborhoods into', num_clusters, 'clusters')
+        clusters = neighborhoods.cluster_composition(composition, num_clusters)
+        neighborhoods.save_clusters(path, num_clusters, *clusters)
+    [labels, centers] = clusters
+    return {'phenotypes': phenotypes, 'centers': centers, 'labels': labels}
+
+
+def get_viewport_cells(datasource_name, rect, level=0, max_points=None, page=0, page_size=None, fields=()):
+    """
+    Columnar cells of a viewport [x0, y0, x1, y1] at a pyramid level (0 is full resolution). Zoomed out, one
+    cell per square of VIEWPORT_SAMPLE_SPACING screen pixels is kept, and at most max_points (capped by
+    VIEWPORT_MAX_POINTS) in total. 'count' is the number of cells each returned cell stands for. Cells are
+    ordered so that every page is spread over the whole viewport, page i holds cells
+    [i * page_size, (i + 1) * page_size) of the sample and 'total' its size. Raises ValueError for levels
+    beyond the channel pyramid and for max_points below 1.
+    """
+    loaded = load_datasource(datasource_name)
+    get_level_shape(datasource_name, level)
+    if max_points is None:
+        max_points = app.config['VIEWPORT_MAX_POINTS']
+    elif max_points < 1:
+        raise ValueError('maxPoints must be at least 1')
+    max_points = min(max_points, app.config['VIEWPORT_MAX_POINTS'])
+    [x0, y0, x1, y1] = [float(value) for value in rect]
+    stratum_size = float(2 ** level * app.config['VIEWPORT_SAMPLE_SPACING']) if level > 0 else None
+    [ids, x, y, counts, stratum_size] = loaded.spatial_index.viewport(
+        min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1), stratum_size=stratum_size, max_points=max_points)
+    total = len(ids)
+    if page_size is not None:
+        page_slice = slice(page * page_size, (page + 1) * page_size)
+        [ids, x, y, counts] = [ids[page_slice], x[page_slice], y[page_slice], counts[page_slice]]
+    result = {'total': total, 'page': page, 'page_size': page_size, 'stratum_size': stratum_size, 'id': ids,
+              'x': x, 'y': y, 'count': counts}
+    result.update(get_field_columns(loaded, ids, fields))
+    return result
+
+
+def get_gated_cells(datasource_name, gates):
+    loaded = load_datasource(datasource_name)
 
     query_string = ''
     for key, value in gates.items():
@@ -383,18 +745,12 @@ def get_gated_cells(datasource_name, gates):
         query_string += str(value[0]) + ' < ' + key + ' < ' + str(value[1])
     if query_string == None or query_string == "":
         return []
-    query = datasource.query(query_string)[['id']].to_dict(orient='records')
-    return query
+    query = loaded.data.frame(gates).query(query_string)
+    return pd.DataFrame({'id': query.index}).to_dict(orient='records')
 
 
 def download_gating_csv(datasource_name, gates, channels):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    loaded = load_datasource(datasource_name)
 
     query_string = ''
     columns = []
@@ -403,16 +759,16 @@ def download_gating_csv(datasource_name, gates, channels):
         if query_string != '':
             query_string += ' and '
         query_string += str(value[0]) + ' < ' + key + ' < ' + str(value[1])
-    ids = datasource.query(query_string)[['id']].to_numpy().flatten()
+    ids = loaded.data.frame(gates).query(query_string).index.to_numpy()
     if 'idField' in config[datasource_name]['featureData'][0]:
         idField = config[datasource_name]['featureData'][0]['idField']
     else:
         idField = "CellID"
     columns.append(idField)
 
-    csv = datasource.copy()
+    csv = with_ids(loaded.data.frame())
 
-    csv[idField] = datasource['id']
+    csv[idField] = csv['id']
     for channel in channels:
         if channel in gates:
             csv.loc[csv[idField].isin(ids), key] = 1
@@ -424,13 +780,7 @@ def download_gating_csv(datasource_name, gates, channels):
 
 
 def download_gates(datasource_name, gates, channels):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
+    load_datasource(datasource_name)
     arr = []
     for key, value in channels.items():
         arr.append([key, value[0], value[1]])
@@ -445,16 +795,14 @@ def download_gates(datasource_name, gates, channels):
 
 
 def get_datasource_description(datasource_name):
-    global datasource
-    global source
-    global ball_tree
-
-    # Load if not loaded
-    if datasource_name != source:
-        load_ball_tree(datasource_name)
-    description = datasource.describe(percentiles=[.005, .01, .25, .5, .75, .95, .99, .995]).to_dict()
-    for column in description:
-        col = datasource[column]
+    loaded = load_datasource(datasource_name)
+    description = {}
+    # Column by column, so that only the column being described has to be loaded
+    for column in loaded.data.columns:
+        col = loaded.data.column(column)
+        if col.dtype.kind not in 'iuf':
+            continue
+        description[column] = col.describe(percentiles=[.005, .01, .25, .5, .75, .95, .99, .995]).to_dict()
         col = col[(col >= description[column]['1%']) & (col <= description[column]['99%'])]
         col = col.to_numpy()
         [hist, bin_edges] = np.histogram(col, bins=25, density=True)
@@ -471,102 +819,441 @@ def get_datasource_description(datasource_name):
 
 
 
-def spatial_corr (adata, raw=False, log=False, threshold=None, x_coordinate='X_centroid',y_coordinate='Y_centroid',
-                  marker=None, k=500, label='spatial_corr'):
-    """
-    Parameters
-    ----------
-    adata : TYPE
-        DESCRIPTION.
-    raw : TYPE, optional
-        DESCRIPTION. The default is False.
-    log : TYPE, optional
-        DESCRIPTION. The default is False.
-    threshold : TYPE, optional
-        DESCRIPTION. The default is None.
-    x_coordinate : TYPE, optional
-        DESCRIPTION. The default is 'X_centroid'.
-    y_coordinate : TYPE, optional
-        DESCRIPTION. The default is 'Y_centroid'.
-    marker : TYPE, optional
-        DESCRIPTION. The default is None.
-    k : TYPE, optional
-        DESCRIPTION. The default is 500.
-    label : TYPE, optional
-        DESCRIPTION. The default is 'spatial_corr'.
-    Returns
-    -------
-    corrfunc : TYPE
-        DESCRIPTION.
-    Example
-    -------
-    adata = spatial_corr (adata, threshold=0.5, x_coordinate='X_position',y_coordinate='Y_position',marker=None)
-    """
-    # Start
-    bdata = adata.copy()
-    # Create a DataFrame with the necessary inforamtion
-    data = pd.DataFrame({'x': bdata.obs[x_coordinate], 'y': bdata.obs[y_coordinate]})
-    # user defined expression matrix
-    if raw is True:
-        exp =  pd.DataFrame(bdata.raw.X, index= bdata.obs.index, columns=bdata.var.index)
+def get_feature_columns(datasource_name):
+    """
+    Feature columns of a datasource, name -> whether the column is numeric or None if that is not known, read
+    without loading the datasource: from its loaded table, else its feature cache, else the feature CSV header.
+    """
+    loaded = datasources.get(datasource_name)
+    if loaded is not None:
+        return {name: loaded.data.is_numeric(name) for name in loaded.data.columns}
+    manifest = feature_cache.read_manifest(data_path / datasource_name / 'feature_cache')
+    if manifest is not None and manifest.get('version') == feature_cache.CACHE_VERSION:
+        return {column['name']: 'categories' not in column for column in manifest['columns']}
+    if config is None or datasource_name not in config:
+        load_config(datasource_name)
+    header = pd.read_csv(config[datasource_name]['featureData'][0]['src'], nrows=0)
+    return {name: None for name in header.columns}
+
+
+def check_markers(datasource_name, markers):
+    # Raises ValueError for markers that are not numeric feature columns
+    columns = get_feature_columns(datasource_name)
+    for marker in markers:
+        if marker not in columns:
+            raise ValueError('Unknown marker ' + str(marker))
+        if columns[marker] is False:
+            raise ValueError('Marker ' + str(marker) + ' is not numeric')
+
+
+def get_spatial_corr_params(datasource_name, markers=None, k=500, log=False, threshold=None):
+    """
+    Checked spatial correlation parameters, markers are numeric feature columns and default to the image
+    channels that are feature columns. Raises ValueError for invalid ones. The datasource is not loaded,
+    markers are checked again by the job once it is.
+    """
+    if datasource_name not in get_config_names():
+        raise ValueError('Unknown datasource ' + str(datasource_name))
+    if markers is None:
+        if config is None or datasource_name not in config:
+            load_config(datasource_name)
+        columns = get_feature_columns(datasource_name)
+        markers = [channel['name'] for channel in config[datasource_name]['imageData'][1:]
+                   if channel['name'] in columns]
+    check_markers(datasource_name, markers)
+    return spatial_correlation.parse_params(markers, k, log, threshold)
+
+
+def start_spatial_corr_job(datasource_name, params, reload=False):
+    # Starts computing a spatial correlation in the background, polled through get_spatial_corr_status
+    if datasource_name not in get_config_names():
+        raise ValueError('Unknown datasource ' + str(datasource_name))
+    return spatial_corr_jobs.start(datasource_name, reload, params).to_dict()
+
+
+def get_spatial_corr_status(datasource_name=None, params=None, job_id=None):
+    # Whether a spatial correlation is computed, and its latest job. Returns None for unknown jobs
+    job = spatial_corr_jobs.get(job_id) if job_id is not None else spatial_corr_jobs.latest(datasource_name, params)
+    if job_id is not None and job is None:
+        return None
+    if job is not None:
+        [datasource_name, params] = [job.datasource_name, job.params]
+    ready = datasource_name in datasources and get_spatial_corr(datasource_name, params) is not None
+    return {'datasource': datasource_name, 'params': params, 'ready': ready,
+            'job': job.to_dict() if job is not None else None}
+
+
+def get_spatial_corr_path(datasource_name, params):
+    return data_path / datasource_name / 'spatial_corr' / spatial_correlation.result_name(params)
+
+
+def spatial_corr(datasource_name, params, reload=False):
+    """
+    Computes the spatial correlation of markers by neighbor rank over all cells of a datasource, params are
+    from get_spatial_corr_params. Results are kept per parameter set until the cell positions or values change.
+    """
+    loaded = load_datasource(datasource_name)
+    path = get_spatial_corr_path(datasource_name, params)
+    # Marker values come from the same feature CSV and float dtype as the positions of the spatial index
+    identity = {'index': loaded.spatial_index.header['identity']}
+    if not reload and spatial_correlation.load_correlation(path, identity) is not None:
+        return
+    check_markers(datasource_name, params['markers'])
+    values = np.column_stack([loaded.data.column(marker).to_numpy(dtype=np.float64) for marker in params['markers']])
+    index_path = data_path / datasource_name / 'spatial_index'
+    spatial_correlation.compute_correlation(loaded.spatial_index, index_path, values, params, path, identity,
+                                            num_workers=app.config['SPATIAL_CORR_WORKERS'])
+
+
+def get_spatial_corr(datasource_name, params):
+    # The computed spatial correlation, None if it was not computed for the current data
+    loaded = load_datasource(datasource_name)
+    return spatial_correlation.load_correlation(get_spatial_corr_path(datasource_name, params),
+                                                {'index': loaded.spatial_index.header['identity']})
+
+
+def check_spatial_stats_params(datasource_name, params):
+    """
+    Raises ValueError for phenotypes that are not values of the phenotype column or radii that exceed half
+    the shorter side of the cells' bounding box. Loads the datasource.
+    """
+    [_, phenotypes, _] = get_phenotype_codes(datasource_name)
+    for phenotype in [params['phenotype_a'], params['phenotype_b']]:
+        if phenotype not in [str(known) for known in phenotypes]:
+            raise ValueError('Unknown phenotype ' + phenotype)
+    loaded = load_datasource(datasource_name)
+    if params['radii'][-1] > spatial_statistics.max_radius(spatial_statistics.window(loaded.spatial_index)):
+        raise ValueError('Radii must not exceed half the shorter side of the cells\' bounding box')
+
+
+def get_spatial_stats_params(datasource_name, phenotype_a, phenotype_b, radii, permutations=99):
+    """
+    Checked spatial statistics parameters. Raises ValueError for invalid ones. Phenotypes and radii are checked
+    against the data here if the datasource is loaded, otherwise by the job once it loaded it.
+    """
+    if datasource_name not in get_config_names():
+        raise ValueError('Unknown datasource ' + str(datasource_name))
+    params = spatial_statistics.parse_params(phenotype_a, phenotype_b, radii, permutations)
+    if datasource_name in datasources:
+        check_spatial_stats_params(datasource_name, params)
+    return params
+
+
+def start_spatial_stats_job(datasource_name, params, reload=False):
+    # Starts computing spatial statistics in the background, polled through get_spatial_stats_status
+    if datasource_name not in get_config_names():
+        raise ValueError('Unknown datasource ' + str(datasource_name))
+    return spatial_stats_jobs.start(datasource_name, reload, params).to_dict()
+
+
+def get_spatial_stats_status(datasource_name=None, params=None, job_id=None):
+    # Whether spatial statistics are computed, and their latest job. Returns None for unknown jobs
+    job = spatial_stats_jobs.get(job_id) if job_id is not None else spatial_stats_jobs.latest(datasource_name, params)
+    if job_id is not None and job is None:
+        return None
+    if job is not None:
+        [datasource_name, params] = [job.datasource_name, job.params]
+    ready = datasource_name in datasources and get_spatial_stats(datasource_name, params) is not None
+    return {'datasource': datasource_name, 'params': params, 'ready': ready,
+            'job': job.to_dict() if job is not None else None}
+
+
+def get_spatial_stats_path(datasource_name, params):
+    return data_path / datasource_name / 'spatial_stats' / spatial_statistics.result_name(params)
+
+
+def spatial_stats(datasource_name, params, reload=False):
+    """
+    Computes Ripley's K, L, the pair correlation and nearest neighbor distances of a pair of phenotypes over
+    all cells of a datasource, params are from get_spatial_stats_params. Results are kept per parameter set
+    until the cell positions or phenotypes change.
+    """
+    loaded = load_datasource(datasource_name)
+    path = get_spatial_stats_path(datasource_name, params)
+    check_spatial_stats_params(datasource_name, params)
+    identity = get_neighborhood_identity(datasource_name)
+    if not reload and spatial_statistics.load_statistics(path, identity) is not None:
+        return
+    [codes, phenotypes, _] = get_phenotype_codes(datasource_name)
+    names = [str(phenotype) for phenotype in phenotypes]
+    index_path = data_path / datasource_name / 'spatial_index'
+    spatial_statistics.compute_statistics(loaded.spatial_index, index_path, codes,
+                                          names.index(params['phenotype_a']), names.index(params['phenotype_b']),
+                                          params, path, identity, num_workers=app.config['SPATIAL_STATS_WORKERS'])
+
+
+def get_spatial_stats(datasource_name, params):
+    # The computed spatial statistics, None if they were not computed for the current data
+    return spatial_statistics.load_statistics(get_spatial_stats_path(datasource_name, params),
+                                              get_neighborhood_identity(datasource_name))
+
+
+def parse_tile_name(tile):
+    [tx, ty] = tile.replace('.png', '').split('_')
+    return int(tx), int(ty)
+
+
+def get_level_shape(datasource_name, level, segmentation=False):
+    """
+    Shape of a pyramid level of the channel image, (channels, height, width), or of the segmentation,
+    (height, width). Raises ValueError for a level that does not exist.
+    """
+    loaded = load_datasource(datasource_name)
+    images = loaded.seg if segmentation else loaded.channels
+    # A single resolution image is its only level
+    num_levels = 1 if hasattr(images, 'shape') else len(images)
+    if level < 0 or level >= num_levels:
+        raise ValueError('Level ' + str(level) + ' does not exist')
+    return images.shape if hasattr(images, 'shape') else images[level].shape
+
+
+def check_tile(datasource_name, level, tile, channel_nums=(), segmentation=False):
+    """
+    Whether a tile lies within its level of the channel image or of the segmentation. Raises ValueError for
+    malformed tile names and for levels or channel indices that do not exist.
+    """
+    if config is None or datasource_name not in config:
+        if datasource_name not in get_config_names():
+            return False
+        load_config(datasource_name)
+    [tx, ty] = parse_tile_name(tile)
+    shape = get_level_shape(datasource_name, int(level), segmentation)
+    for channel_num in channel_nums:
+        if channel_num < 0 or channel_num >= shape[0]:
+            raise ValueError('Channel ' + str(channel_num) + ' does not exist')
+    return (0 <= tx * config[datasource_name]['tileWidth'] < shape[-1]
+            and 0 <= ty * config[datasource_name]['tileHeight'] < shape[-2])
+
+
+def get_tile(datasource_name, channel, level, tile, encoding=tile_encoding.DEFAULT_ENCODING):
+    [tx, ty] = parse_tile_name(tile)
+    key = (datasource_name, channel, int(level), tx, ty, encoding)
+    generation = tile_cache.generation(datasource_name)
+    data = tile_cache.get(key)
+    if data is None:
+        data = render_tile(key, generation)
+    else:
+        tile_prefetcher.record_hit(key)
+    tile_prefetcher.schedule(get_prefetch_keys(key), generation)
+    return data
+
+
+def get_multi_channel_tile(datasource_name, channel_nums, level, tile, encoding='raw'):
+    return get_tile(datasource_name, tuple(channel_nums), level, tile, encoding)
+
+
+def get_composite_tile(datasource_name, settings, level, tile, encoding='png'):
+    return get_tile(datasource_name, settings, level, tile, encoding)
+
+
+def get_outline_tile(datasource_name, bits, level, tile, encoding='png'):
+    return get_tile(datasource_name, segmentation_outlines.Outline(bits), level, tile, encoding)
+
+
+def get_label_color_tile(datasource_name, label_field, level, tile, encoding='png'):
+    [version, _] = get_datasource_version(datasource_name)
+    return get_tile(datasource_name, label_colors.LabelColors(label_field, version), level, tile, encoding)
+
+
+def get_label_lut(datasource_name, label_field, version):
+    """
+    Color lookup table of a label field ('celltype' is the configured phenotype column), built once per
+    datasource version so that coloring a tile is a single gather.
+    """
+    key = (datasource_name, label_field, version)
+    lut = label_luts.get(key)
+    if lut is None:
+        loaded = load_datasource(datasource_name)
+        column = label_field
+        if label_field == 'celltype':
+            column = get_phenotype_column_name(datasource_name) or 'celltype'
+        if column not in loaded.data.columns:
+            raise ValueError('Unknown label field ' + str(label_field))
+        color_scheme = get_color_scheme(datasource_name, False, label_field)
+        lut = label_colors.build_label_lut(loaded.data.column(column), color_scheme)
+        for stale in [k for k in list(label_luts) if k[:2] == key[:2]]:
+            label_luts.pop(stale, None)
+        label_luts[key] = lut
+    return lut
+
+
+def get_aggregate_tile(datasource_name, field, level, tile, encoding='raw'):
+    [version, _] = get_datasource_version(datasource_name)
+    return get_tile(datasource_name, aggregate_tiles.Aggregate(field, version), level, tile, encoding)
+
+
+def get_aggregate_store(datasource_name):
+    """
+    Aggregate rasters of a datasource, aligned with its segmentation pyramid and tiles. They depend on the
+    feature CSV and the coordinate columns like the spatial index, and on the image and tile size.
+    """
+    loaded = load_datasource(datasource_name)
+    seg = loaded.seg if hasattr(loaded.seg, 'shape') else loaded.seg[0]
+    [height, width] = seg.shape[-2:]
+    features = loaded.config['featureData'][0]
+    identity = {'source': feature_cache.source_identity(Path(features['src'])),
+                'coordinates': [features['xCoordinate'], features['yCoordinate']],
+                'float_dtype': get_feature_options(datasource_name)['float_dtype'], 'size': [height, width],
+                'tile': [loaded.config['tileHeight'], loaded.config['tileWidth']]}
+    return aggregate_tiles.open_aggregate_store(data_path / datasource_name / 'aggregates.zarr', identity, height,
+                                                width, loaded.config['tileHeight'], loaded.config['tileWidth'])
+
+
+def get_phenotype_codes(datasource_name):
+    # Phenotype codes of the cells, phenotypes and their digest, computed once per phenotype column
+    column = get_phenotype_column_name(datasource_name)
+    key = (datasource_name, column)
+    phenotypes = phenotype_codes.get(key)
+    if phenotypes is None:
+        loaded = load_datasource(datasource_name)
+        if column not in loaded.data.columns:
+            raise ValueError('Datasource ' + str(datasource_name) + ' has no phenotype column')
+        values = pd.Categorical(loaded.data.column(column))
+        codes = np.asarray(values.codes)
+        phenotypes = (codes, list(values.categories), aggregate_tiles.phenotype_digest(codes, values.categories))
+        phenotype_codes[key] = phenotypes
+    return phenotypes
+
+
+def get_aggregate_counts(datasource_name, level):
+    loaded = load_datasource(datasource_name)
+    [codes, phenotypes, digest] = get_phenotype_codes(datasource_name)
+    features = loaded.config['featureData'][0]
+
+    def load():
+        print('Computing phenotype counts for level', level)
+        return (loaded.data.column(features['xCoordinate']).to_numpy(),
+                loaded.data.column(features['yCoordinate']).to_numpy(), codes, phenotypes)
+
+    return get_aggregate_store(datasource_name).counts(level, digest, load)
+
+
+def get_aggregate_info(datasource_name):
+    """
+    Layout of the aggregate tiles: bin size in screen pixels, bins per tile and the phenotypes in the order of
+    the phenotype tile's channels.
+    """
+    store = get_aggregate_store(datasource_name)
+    [_, phenotypes, _] = get_phenotype_codes(datasource_name)
+    return {'binPixels': store.bin_pixels, 'tileBins': list(store.tile_bins), 'phenotypes': phenotypes,
+            'maxLevel': config[datasource_name].get('maxLevel', 1)}
+
+
+def check_aggregate_tile(datasource_name, level, tile):
+    """
+    Whether an aggregate tile lies within the bins of its level. Raises ValueError for malformed tile names
+    and for levels that do not exist.
+    """
+    if config is None or datasource_name not in config:
+        if datasource_name not in get_config_names():
+            return False
+        load_config(datasource_name)
+    [tx, ty] = parse_tile_name(tile)
+    level = int(level)
+    if level < 0 or level >= config[datasource_name].get('maxLevel', 1):
+        raise ValueError('Level ' + str(level) + ' does not exist')
+    store = get_aggregate_store(datasource_name)
+    [height, width] = store.level_shape(level)
+    return 0 <= tx * store.tile_bins[1] < width and 0 <= ty * store.tile_bins[0] < height
+
+
+def generate_aggregate(datasource_name, field, level, tile):
+    """
+    Aggregate tile of a level: cell density (y, x), counts per phenotype (phenotype, y, x) for the phenotype
+    field, or the mean of a marker column (y, x).
+    """
+    loaded = load_datasource(datasource_name)
+    [tx, ty] = parse_tile_name(tile)
+    if level < 0 or level >= config[datasource_name].get('maxLevel', 1):
+        raise ValueError('Level ' + str(level) + ' does not exist')
+    store = get_aggregate_store(datasource_name)
+    if field in ['density', 'celltype', get_phenotype_column_name(datasource_name)]:
+        counts = store.read_tile(get_aggregate_counts(datasource_name, level), tx, ty)
+        return counts.sum(axis=0, dtype=np.uint32) if field == 'density' else counts
+    if field not in loaded.data.columns or loaded.data.column(field).dtype.kind not in 'biuf':
+        raise ValueError('Unknown marker ' + str(field))
+    features = loaded.config['featureData'][0]
+
+    def load():
+        print('Computing', field, 'means for level', level)
+        return (loaded.data.column(features['xCoordinate']).to_numpy(),
+                loaded.data.column(features['yCoordinate']).to_numpy(), loaded.data.column(field).to_numpy())
+
+    return store.read_tile(store.means(level, field, load), tx, ty)
+
+
+def render_tile(key, generation=None):
+    # Channel is a channel/segmentation name, a tuple of channel indices for a batched tile,
+    # or the settings of a composite, outline, label color or aggregate tile. The tile is not cached if
+    # the datasource was reloaded since generation, the tile cache generation taken before rendering.
+    datasource_name, channel, level, tx, ty, encoding = key
+    if generation is None:
+        generation = tile_cache.generation(datasource_name)
+    tile = str(tx) + '_' + str(ty)
+    if isinstance(channel, aggregate_tiles.Aggregate):
+        tile_data = generate_aggregate(datasource_name, channel.field, level, tile)
+    elif isinstance(channel, label_colors.LabelColors):
+        labels = generate_zarr_png(datasource_name, 'segmentation', level, tile)
+        tile_data = label_colors.apply_label_lut(labels, get_label_lut(datasource_name, *channel))
+    elif isinstance(channel, segmentation_outlines.Outline):
+        tile_data = generate_zarr_outline(datasource_name, channel.bits, level, tile)
+    elif isinstance(channel, tile_compositing.Composite):
+        slab = generate_zarr_channels(datasource_name, channel.channels, level, tile)
+        tile_data = tile_compositing.composite(slab, channel)
+    elif isinstance(channel, tuple):
+        tile_data = generate_zarr_channels(datasource_name, channel, level, tile)
     else:
-        exp =  pd.DataFrame(bdata.X, index= bdata.obs.index, columns=bdata.var.index)
-    # log the data if needed
-    if log is True:
-        exp = np.log1p(exp)
-    # set a threshold if needed
-    if threshold is not None:
-        exp[exp >= threshold] = 1
-        exp[exp < threshold] = 0
-    # subset markers if needed
-    if marker is not None:
-        if isinstance(marker, str):
-            marker = [marker]
-        exp = exp[marker]
-    # find the nearest neighbours
-    tree = BallTree(data, leaf_size= 2)
-    dist, ind = tree.query(data, k=k, return_distance= True)
-    neighbours = pd.DataFrame(ind, index = bdata.obs.index)
-    # find the mean dist
-    rad_approx = np.mean(dist, axis=0)
-    # Calculate the correlation
-    mean = np.mean(exp).values
-    std = np.std(exp).values
-    A = (exp - mean) / std
-    def corrfunc (marker, A, neighbours, ind):
-        print('Processing ' + str(marker))
-        # Map phenotype
-        ind_values = dict(zip(list(range(len(ind))), A[marker])) # Used for mapping
-        # Loop through (all functionized methods were very slow)
-        neigh = neighbours.copy()
-        for i in neigh.columns:
-            neigh[i] = neigh[i].dropna().map(ind_values, na_action='ignore')
-        # multiply the matrices
-        Y = neigh.T * A[marker]
-        corrfunc = np.mean(Y, axis=1)
-        # return
-        return corrfunc
-    # apply function to all markers    # Create lamda function
-    r_corrfunc = lambda x: corrfunc(marker=x,A=A, neighbours=neighbours, ind=ind)
-    all_data = list(map(r_corrfunc, exp.columns)) # Apply function
-    # Merge all the results into a single dataframe
-    df = pd.concat(all_data, axis=1)
-    df.columns = exp.columns
-    df['distance'] = rad_approx
-    # add it to anndata object
-    adata.uns[label] = df
-    # return
-    return adata
+        tile_data = generate_zarr_png(datasource_name, channel, level, tile)
+    data = tile_encoding.encode_tile(tile_data, encoding)
+    tile_cache.put(key, data, generation)
+    return data
+
+
+def prefetch_tile(key, generation):
+    # Tiles of a datasource that is no longer loaded, was reloaded since they were scheduled or that were
+    # cached meanwhile are skipped
+    if key[0] not in datasources or key in tile_cache or generation != tile_cache.generation(key[0]):
+        return False
+    render_tile(key, generation)
+    return True
+
+
+def get_prefetch_keys(key):
+    """
+    Neighbors of a tile at the same level, followed by its parent and child tiles.
+    Level 0 is the full resolution image.
+    """
+    datasource_name, channel, level, tx, ty, encoding = key
+    if config is None or datasource_name not in config:
+        return []
+    tile_width = config[datasource_name]['tileWidth']
+    tile_height = config[datasource_name]['tileHeight']
+    max_level = config[datasource_name].get('maxLevel', 1)
+    width = config[datasource_name].get('width')
+    height = config[datasource_name].get('height')
+
+    def in_bounds(l, x, y):
+        if l < 0 or l >= max_level or x < 0 or y < 0:
+            return False
+        if width is None or height is None:
+            return True
+        return x * tile_width < width / 2 ** l and y * tile_height < height / 2 ** l
+
+    tiles = [(level, tx + dx, ty + dy) for dy in [-1, 0, 1] for dx in [-1, 0, 1] if dx != 0 or dy != 0]
+    tiles.append((level + 1, tx // 2, ty // 2))
+    tiles.extend([(level - 1, tx * 2 + dx, ty * 2 + dy) for dy in [0, 1] for dx in [0, 1]])
+    return [(datasource_name, channel, l, x, y, encoding) for (l, x, y) in tiles if in_bounds(l, x, y)]
+
+
+def get_tile_cache_stats():
+    stats = tile_cache.stats()
+    stats['prefetch'] = tile_prefetcher.stats()
+    return stats
 
 
 def generate_zarr_png(datasource_name, channel, level, tile):
-    if config is None:
-        load_datasource(datasource_name)
-    global channels
-    global seg
-    [tx, ty] = tile.replace('.png', '').split('_')
-    tx = int(tx)
-    ty = int(ty)
+    loaded = load_datasource(datasource_name)
+    [tx, ty] = parse_tile_name(tile)
     level = int(level)
     tile_width = config[datasource_name]['tileWidth']
     tile_height = config[datasource_name]['tileHeight']
@@ -578,27 +1265,103 @@ def generate_zarr_png(datasource_name, channel, level, tile):
     except AttributeError:
         segmentation = True
     if segmentation:
-        tile = seg[level][iy:iy + tile_height, ix:ix + tile_width]
-
-        tile = tile.view('uint8').reshape(tile.shape + (-1,))[..., [0, 1, 2]]
-        tile = np.append(tile, np.zeros((tile.shape[0], tile.shape[1], 1), dtype='uint8'), axis=2)
+        # Label tiles are returned as uint32, the encoder decides how to pack them
+        tile = loaded.seg[level][iy:iy + tile_height, ix:ix + tile_width]
+        tile = tile.astype('uint32', copy=False)
     else:
-        if isinstance(channels, zarr.Array):
-            tile = channels[channel_num, iy:iy + tile_height, ix:ix + tile_width]
+        if isinstance(loaded.channels, zarr.Array):
+            tile = loaded.channels[channel_num, iy:iy + tile_height, ix:ix + tile_width]
         else:
-            tile = channels[level][channel_num, iy:iy + tile_height, ix:ix + tile_width]
+            tile = loaded.channels[level][channel_num, iy:iy + tile_height, ix:ix + tile_width]
             tile = tile.astype('uint16')
 
-    # tile = np.ascontiguousarray(tile, dtype='uint32')
-    # png = tile.view('uint8').reshape(tile.shape + (-1,))[..., [2, 1, 0]]
     return tile
 
 
+def generate_zarr_channels(datasource_name, channel_nums, level, tile):
+    # Reads one tile of several channels in a single orthogonal selection, shaped (channel, y, x)
+    loaded = load_datasource(datasource_name)
+    [tx, ty] = parse_tile_name(tile)
+    level = int(level)
+    tile_width = config[datasource_name]['tileWidth']
+    tile_height = config[datasource_name]['tileHeight']
+    ix = tx * tile_width
+    iy = ty * tile_height
+    selection = (list(channel_nums), slice(iy, iy + tile_height), slice(ix, ix + tile_width))
+    if isinstance(loaded.channels, zarr.Array):
+        slab = loaded.channels.get_orthogonal_selection(selection)
+    else:
+        slab = loaded.channels[level].get_orthogonal_selection(selection)
+        slab = slab.astype('uint16')
+    return slab
+
+
+def generate_zarr_outline(datasource_name, bits, level, tile):
+    # Reads the label tile with a 1 pixel halo so that boundaries across tile edges are detected
+    loaded = load_datasource(datasource_name)
+    [tx, ty] = parse_tile_name(tile)
+    level = int(level)
+    tile_width = config[datasource_name]['tileWidth']
+    tile_height = config[datasource_name]['tileHeight']
+    labels = loaded.seg[level]
+    y0, y1, y_pad = segmentation_outlines.halo_window(ty * tile_height, tile_height, labels.shape[0])
+    x0, x1, x_pad = segmentation_outlines.halo_window(tx * tile_width, tile_width, labels.shape[1])
+    labels = np.pad(labels[y0:y1, x0:x1], (y_pad, x_pad), mode='edge')
+    return segmentation_outlines.outline_mask(labels, bits)
+
+
+def get_intensity_stats(datasource_name, level=None, tiles=False):
+    """
+    Channel intensity statistics at one pyramid level, the coarsest by default. Levels that were not indexed
+    at import time are computed on first request and persisted next to the datasource.
+    """
+    if config is None or datasource_name not in config:
+        load_config(datasource_name)
+    max_level = config[datasource_name].get('maxLevel', 1)
+    level = max_level - 1 if level is None else level
+    if level < 0 or level >= max_level:
+        raise ValueError('Level ' + str(level) + ' does not exist')
+    key = (datasource_name, level)
+    stats = intensity_stats_cache.get(key)
+    if stats is None:
+        directory = data_path / datasource_name
+        [pyramid, _] = open_channel_pyramid(datasource_name)
+        img = pyramid if isinstance(pyramid, zarr.Array) else pyramid[level]
+        identity = intensity_stats.source_identity(config[datasource_name]['channelFile'], img.shape)
+        stats = intensity_stats.load_level_stats(directory, level, identity)
+        if stats is None:
+            print('Computing intensity statistics for level', level)
+            stats = intensity_stats.compute_level_stats(img, config[datasource_name]['tileHeight'],
+                                                        config[datasource_name]['tileWidth'])
+            intensity_stats.save_level_stats(directory, level, stats, identity)
+        intensity_stats_cache[key] = stats
+
+    channel_names = {}
+    for channel in config[datasource_name]['imageData'][1:]:
+        match = re.match(r".*_(\d+)$", channel['src'].rstrip('/'))
+        if match:
+            channel_names[int(match.groups()[0])] = channel['name']
+    percentiles = intensity_stats.percentiles_from_histogram(stats['histogram'], stats['edges'])
+    counts = stats['tile_count']
+    description = {'level': level, 'tileSize': stats['tile_size'], 'percentiles': intensity_stats.PERCENTILES,
+                   'histogramEdges': stats['edges'], 'channels': []}
+    for c in range(stats['histogram'].shape[0]):
+        description['channels'].append({
+            'index': c,
+            'name': channel_names.get(c, ''),
+            'min': stats['tile_min'][c].min(),
+            'max': stats['tile_max'][c].max(),
+            'mean': float((stats['tile_mean'][c] * counts).sum() / max(counts.sum(), 1)),
+            'percentiles': percentiles[c],
+            'histogram': stats['histogram'][c]
+        })
+    if tiles:
+        description['tiles'] = {'min': stats['tile_min'], 'max': stats['tile_max'], 'mean': stats['tile_mean']}
+    return description
+
+
 def get_ome_metadata(datasource_name):
-    if config is None:
-        load_datasource(datasource_name)
-    global metadata
-    return metadata
+    return load_datasource(datasource_name).metadata
 
 
 def convertOmeTiff(filePath, channelFilePath=None, dataDirectory=None, isLabelImg=False):
@@ -608,7 +1371,8 @@ def convertOmeTiff(filePath, channelFilePath=None, dataDirectory=None, isLabelIm
         channel_io = tf.TiffFile(str(filePath), is_ome=False)
         channels = zarr.open(channel_io.series[0].aszarr())
         if isinstance(channels, zarr.Array):
-            channel_info['maxLevel'] = 1
+            # Lower resolution levels are derived on demand, see open_channel_pyramid
+            channel_info['maxLevel'] = derived_pyramid.count_levels(channels.shape)
             chunks = channels.chunks
             shape = channels.shape
         else:
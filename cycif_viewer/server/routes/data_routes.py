@@ -2,10 +2,15 @@ from cycif_viewer import app
 from flask import render_template, request, Response, jsonify, abort, send_file
 import io
 from PIL import Image
-from cycif_viewer import data_path, get_config
+from cycif_viewer import data_path, get_config, config_json_path
 from cycif_viewer.server.models import data_model
+from cycif_viewer.server.utils import neighborhoods, spatial_correlation, spatial_statistics, tile_compositing
+from cycif_viewer.server.utils import tile_encoding
 from pathlib import Path
 from time import time
+from datetime import datetime, timezone
+import os
+import numpy as np
 import pandas as pd
 import json
 import orjson
@@ -15,14 +20,37 @@ from flask_sqlalchemy import SQLAlchemy
 @app.route('/init_database', methods=['GET'])
 def init_database():
     datasource = request.args.get('datasource')
+    if request.args.get('async') == 'true':
+        return start_datasource_load(datasource)
     data_model.init(datasource)
     resp = jsonify(success=True)
     return resp
 
 
+def start_datasource_load(datasource):
+    # Returns the load job right away, its progress is polled through /get_load_status
+    try:
+        job = data_model.start_datasource_load(datasource, reload=request.args.get('reload') == 'true')
+    except ValueError:
+        abort(422)
+    return jsonify(success=True, job=job)
+
+
+@app.route('/get_load_status', methods=['GET'])
+def get_load_status():
+    status = data_model.get_load_status(request.args.get('datasource'), request.args.get('job'))
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
 @app.route('/config')
 def serve_config():
-    return get_config()
+    if not os.path.isfile(config_json_path):
+        return get_config()
+    stat = os.stat(config_json_path)
+    etag = '%d-%d' % (stat.st_mtime_ns, stat.st_size)
+    return cached_response(etag, int(stat.st_mtime), lambda: jsonify(get_config()))
 
 
 @app.route('/get_nearest_cell', methods=['GET'])
@@ -55,15 +83,15 @@ def get_database_row():
 def get_channel_names():
     datasource = request.args.get('datasource')
     shortnames = bool(request.args.get('shortNames'))
-    resp = data_model.get_channel_names(datasource, shortnames)
-    return serialize_and_submit_json(resp)
+    return cached_datasource_response(
+        datasource, lambda: serialize_and_submit_json(data_model.get_channel_names(datasource, shortnames)))
 
 
 @app.route('/get_phenotypes', methods=['GET'])
 def get_phenotypes():
     datasource = request.args.get('datasource')
-    resp = data_model.get_phenotypes(datasource)
-    return serialize_and_submit_json(resp)
+    return cached_datasource_response(
+        datasource, lambda: serialize_and_submit_json(data_model.get_phenotypes(datasource)))
 
 
 @app.route('/get_color_scheme', methods=['GET'])
@@ -84,6 +112,47 @@ def get_neighborhood():
     return serialize_and_submit_json(resp)
 
 
+# Batched versions of /get_nearest_cell and /get_neighborhood for many points at once, points is a JSON list
+# of [x, y] pairs and the result is columnar
+@app.route('/get_nearest_cells', methods=['POST'])
+def get_nearest_cells():
+    datasource = request.form['datasource']
+    try:
+        points = parse_points(request.form['points'])
+        k = int(request.form.get('k', 1))
+        if k < 1:
+            raise ValueError('k must be at least 1')
+        fields = json.loads(request.form.get('fields', '[]'))
+        resp = data_model.query_for_closest_cells(points, datasource, k=k, fields=fields)
+    except (ValueError, TypeError, KeyError):
+        abort(422)
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/get_neighborhoods', methods=['POST'])
+def get_neighborhoods():
+    datasource = request.form['datasource']
+    try:
+        points = parse_points(request.form['points'])
+        # A single radius or one per point
+        radius = np.asarray(json.loads(request.form['radius']), dtype=np.float64)
+        if not (np.isfinite(radius) & (radius >= 0)).all():
+            raise ValueError('Radii must be finite and not negative')
+        fields = json.loads(request.form.get('fields', '[]'))
+        resp = data_model.get_neighborhoods(points, radius, datasource, fields=fields)
+    except (ValueError, TypeError, KeyError):
+        abort(422)
+    return serialize_and_submit_json(resp)
+
+
+def parse_points(value):
+    # (x, y) pairs of a JSON list, json.loads accepts NaN and Infinity which no cell is near
+    points = np.asarray(json.loads(value), dtype=np.float64).reshape(-1, 2)
+    if not np.isfinite(points).all():
+        raise ValueError('Points must be finite')
+    return points
+
+
 @app.route('/get_num_cells_in_circle', methods=['GET'])
 def get_num_cells_in_circle():
     datasource = request.args.get('datasource')
@@ -138,11 +207,236 @@ def get_rect_cells():
     return serialize_and_submit_json(resp)
 
 
+# Cells in a rectangle ([x0, y0, x1, y1]) or a lasso polygon ([[x, y], ...]), columnar ids and requested fields
+@app.route('/get_selected_cells', methods=['POST'])
+def get_selected_cells():
+    datasource = request.form['datasource']
+    try:
+        rect = json.loads(request.form['rect']) if 'rect' in request.form else None
+        polygon = json.loads(request.form['polygon']) if 'polygon' in request.form else None
+        if (rect is None) == (polygon is None):
+            abort(422)
+        fields = json.loads(request.form.get('fields', '[]'))
+        resp = data_model.get_selected_cells(datasource, rect=rect, polygon=polygon, fields=fields)
+    except (ValueError, TypeError, KeyError):
+        abort(422)
+    return serialize_and_submit_json(resp)
+
+
+# Cells of a viewport at a zoom level for dot overlays and scatter layers, sampled when zoomed out and paged
+@app.route('/get_viewport_cells', methods=['GET'])
+def get_viewport_cells():
+    datasource = request.args.get('datasource')
+    try:
+        rect = [float(x) for x in request.args.get('rect').split(',')]
+        level = int(request.args.get('level', 0))
+        max_points = int(request.args['maxPoints']) if 'maxPoints' in request.args else None
+        page = max(int(request.args.get('page', 0)), 0)
+        page_size = int(request.args['pageSize']) if 'pageSize' in request.args else None
+        fields = json.loads(request.args.get('fields', '[]'))
+        resp = data_model.get_viewport_cells(datasource, rect, level, max_points, page, page_size, fields)
+    except (AttributeError, ValueError, TypeError, KeyError):
+        abort(422)
+    return serialize_and_submit_json(resp)
+
+
+def get_neighborhood_params():
+    # ?k= for the k nearest neighbors or ?radius= for the cells within a radius
+    try:
+        return neighborhoods.parse_params(request.args.get('k'), request.args.get('radius'))
+    except ValueError:
+        abort(422)
+
+
+# Starts computing the phenotype composition of the neighborhood of every cell, polled via /get_neighborhood_status
+@app.route('/compute_neighborhoods', methods=['GET'])
+def compute_neighborhoods():
+    params = get_neighborhood_params()
+    try:
+        job = data_model.start_neighborhood_job(request.args.get('datasource'), params,
+                                                reload=request.args.get('reload') == 'true')
+    except ValueError:
+        abort(422)
+    return jsonify(success=True, job=job)
+
+
+@app.route('/get_neighborhood_status', methods=['GET'])
+def get_neighborhood_status():
+    if request.args.get('job') is not None:
+        status = data_model.get_neighborhood_status(job_id=request.args.get('job'))
+    else:
+        status = data_model.get_neighborhood_status(request.args.get('datasource'), get_neighborhood_params())
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+# Neighbor counts per phenotype of every cell as a binary (1, cells, phenotypes) tile (raw, deflate or zstd),
+# phenotypes in the order of /get_neighborhood_phenotypes. 404 until it is computed
+@app.route('/get_neighborhood_composition', methods=['GET'])
+def get_neighborhood_composition():
+    datasource = request.args.get('datasource')
+    params = get_neighborhood_params()
+    encoding = request.args.get('format', 'zstd')
+    if encoding not in tile_encoding.COMPRESSION:
+        abort(422)
+
+    def build():
+        try:
+            [composition, _] = data_model.get_neighborhood_composition(datasource, params)
+        except ValueError:
+            abort(422)
+        if composition is None:
+            abort(404)
+        return app.response_class(tile_encoding.encode_binary(composition, encoding),
+                                  mimetype=tile_encoding.MIMETYPES[encoding])
+
+    return cached_datasource_response(datasource, build,
+                                      representation=neighborhoods.result_name(params) + '-' + encoding)
+
+
+@app.route('/get_neighborhood_phenotypes', methods=['GET'])
+def get_neighborhood_phenotypes():
+    try:
+        [_, phenotypes, _] = data_model.get_phenotype_codes(request.args.get('datasource'))
+    except ValueError:
+        abort(422)
+    return serialize_and_submit_json(phenotypes)
+
+
+# Cellular neighborhoods: the cluster of every cell by its neighborhood composition, ?clusters= is their number
+@app.route('/get_cellular_neighborhoods', methods=['GET'])
+def get_cellular_neighborhoods():
+    datasource = request.args.get('datasource')
+    params = get_neighborhood_params()
+    try:
+        num_clusters = int(request.args.get('clusters', 10))
+        if num_clusters < 2:
+            abort(422)
+        resp = data_model.get_cellular_neighborhoods(datasource, params, num_clusters)
+    except ValueError:
+        abort(422)
+    if resp is None:
+        abort(404)
+    return serialize_and_submit_json(resp)
+
+
+def get_spatial_corr_params():
+    # ?markers= a JSON list of marker columns (image channels by default), ?k=, ?log=true and ?threshold=
+    markers = request.args.get('markers')
+    threshold = request.args.get('threshold')
+    try:
+        return data_model.get_spatial_corr_params(request.args.get('datasource'),
+                                                  json.loads(markers) if markers else None,
+                                                  request.args.get('k', 500), request.args.get('log') == 'true',
+                                                  float(threshold) if threshold else None)
+    except (ValueError, TypeError):
+        abort(422)
+
+
+# Starts computing the spatial correlation of markers by neighbor rank, polled via /get_spatial_corr_status
+@app.route('/compute_spatial_corr', methods=['GET'])
+def compute_spatial_corr():
+    params = get_spatial_corr_params()
+    job = data_model.start_spatial_corr_job(request.args.get('datasource'), params,
+                                            reload=request.args.get('reload') == 'true')
+    return jsonify(success=True, job=job)
+
+
+@app.route('/get_spatial_corr_status', methods=['GET'])
+def get_spatial_corr_status():
+    if request.args.get('job') is not None:
+        status = data_model.get_spatial_corr_status(job_id=request.args.get('job'))
+    else:
+        status = data_model.get_spatial_corr_status(request.args.get('datasource'), get_spatial_corr_params())
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+# Mean neighbor distance and correlation of each marker by neighbor rank, 404 until it is computed
+@app.route('/get_spatial_corr', methods=['GET'])
+def get_spatial_corr():
+    datasource = request.args.get('datasource')
+    params = get_spatial_corr_params()
+
+    def build():
+        resp = data_model.get_spatial_corr(datasource, params)
+        if resp is None:
+            abort(404)
+        return serialize_and_submit_json(resp)
+
+    return cached_datasource_response(datasource, build, representation=spatial_correlation.result_name(params))
+
+
+def get_spatial_stats_params():
+    # ?phenotypeA= and ?phenotypeB= (the same for a single phenotype), ?radii= a JSON list and ?permutations=
+    try:
+        return data_model.get_spatial_stats_params(request.args.get('datasource'), request.args.get('phenotypeA'),
+                                                   request.args.get('phenotypeB'),
+                                                   json.loads(request.args.get('radii', '[]')),
+                                                   request.args.get('permutations', 99))
+    except (ValueError, TypeError):
+        abort(422)
+
+
+# Starts computing Ripley's K/L, pair correlation and nearest neighbor distances of a pair of phenotypes, polled via
+# /get_spatial_stats_status
+@app.route('/compute_spatial_stats', methods=['GET'])
+def compute_spatial_stats():
+    params = get_spatial_stats_params()
+    job = data_model.start_spatial_stats_job(request.args.get('datasource'), params,
+                                             reload=request.args.get('reload') == 'true')
+    return jsonify(success=True, job=job)
+
+
+@app.route('/get_spatial_stats_status', methods=['GET'])
+def get_spatial_stats_status():
+    if request.args.get('job') is not None:
+        status = data_model.get_spatial_stats_status(job_id=request.args.get('job'))
+    else:
+        status = data_model.get_spatial_stats_status(request.args.get('datasource'), get_spatial_stats_params())
+    if status is None:
+        abort(404)
+    return jsonify(status)
+
+
+# Observed, theoretical and permutation null envelope of each statistic by radius, 404 until they are computed
+@app.route('/get_spatial_stats', methods=['GET'])
+def get_spatial_stats():
+    datasource = request.args.get('datasource')
+    params = get_spatial_stats_params()
+
+    def build():
+        resp = data_model.get_spatial_stats(datasource, params)
+        if resp is None:
+            abort(404)
+        return serialize_and_submit_json(resp)
+
+    return cached_datasource_response(datasource, build, representation=spatial_statistics.result_name(params))
+
+
 @app.route('/get_ome_metadata', methods=['GET'])
 def get_ome_metadata():
     datasource = request.args.get('datasource')
-    resp = data_model.get_ome_metadata(datasource)
-    return serialize_and_submit_json(resp)
+    return cached_datasource_response(
+        datasource, lambda: serialize_and_submit_json(data_model.get_ome_metadata(datasource)))
+
+
+@app.route('/get_intensity_stats', methods=['GET'])
+def get_intensity_stats():
+    datasource = request.args.get('datasource')
+    level = request.args.get('level')
+    tiles = request.args.get('tiles') == 'true'
+
+    def build():
+        try:
+            resp = data_model.get_intensity_stats(datasource, int(level) if level else None, tiles)
+        except ValueError:
+            abort(422)
+        return serialize_and_submit_json(resp)
+
+    return cached_datasource_response(datasource, build)
 
 
 @app.route('/download_gating_csv', methods=['POST'])
@@ -174,16 +468,204 @@ def get_gating_csv_values():
 
 
 # E.G /generated/data/melanoma/channel_00_files/13/16_18.png
+# The encoding defaults to PNG, other formats are picked with ?format=raw|deflate|zstd|webp or the Accept header
 @app.route('/generated/data/<string:datasource>/<string:channel>/<string:level>/<string:tile>')
 def generate_png(datasource, channel, level, tile):
-    now = time()
-    png = data_model.generate_zarr_png(datasource, channel, level, tile)
-    file_object = io.BytesIO()
-    # write PNG in file-object
-    Image.fromarray(png).save(file_object, 'PNG', compress_level=0)
-    # move to beginning of file so `send_file()` it will read from start
-    file_object.seek(0)
-    return send_file(file_object, mimetype='image/PNG')
+    encoding = tile_encoding.negotiate_encoding(request.args.get('format'), request.accept_mimetypes)
+    if encoding is None:
+        abort(422)
+    return cached_tile_response(datasource, encoding, lambda: data_model.get_tile(
+        datasource, channel, level, tile, encoding))
+
+
+# E.G /generated/batch/melanoma/3/16_18?channels=0,4,7&format=zstd
+# Packs the same tile of several channels into one binary response (raw, deflate or zstd)
+@app.route('/generated/batch/<string:datasource>/<string:level>/<string:tile>')
+def generate_multi_channel_tile(datasource, level, tile):
+    try:
+        channel_nums = [int(channel) for channel in request.args.get('channels').split(',')]
+    except (AttributeError, ValueError):
+        abort(422)
+    encoding = tile_encoding.negotiate_encoding(request.args.get('format'), request.accept_mimetypes, default='raw')
+    if encoding not in tile_encoding.COMPRESSION:
+        abort(422)
+    try:
+        in_bounds = data_model.check_tile(datasource, level, tile, channel_nums)
+    except ValueError:
+        abort(422)
+    if not in_bounds:
+        abort(404)
+    return cached_tile_response(datasource, encoding, lambda: data_model.get_multi_channel_tile(
+        datasource, channel_nums, level, tile, encoding))
+
+
+# E.G /generated/composite/melanoma/3/16_18?channels=0,4&colors=0000ff,ff0000&min=500,1000&max=30000,12000&gamma=1,0.8
+# Blends several channels server-side into an 8 bit RGB tile (png or webp)
+@app.route('/generated/composite/<string:datasource>/<string:level>/<string:tile>')
+def generate_composite_tile(datasource, level, tile):
+    def parse_list(name, cast=float):
+        value = request.args.get(name)
+        return [cast(x) for x in value.split(',')] if value else None
+
+    try:
+        settings = tile_compositing.make_composite(parse_list('channels', int), parse_list('colors', str),
+                                                   parse_list('min'), parse_list('max'), parse_list('gamma'))
+    except (TypeError, ValueError):
+        abort(422)
+    encoding = request.args.get('format', 'png')
+    if encoding not in ['png', 'webp']:
+        abort(422)
+    try:
+        in_bounds = data_model.check_tile(datasource, level, tile, settings.channels)
+    except ValueError:
+        abort(422)
+    if not in_bounds:
+        abort(404)
+    return cached_tile_response(datasource, encoding, lambda: data_model.get_composite_tile(
+        datasource, settings, level, tile, encoding))
+
+
+# E.G /generated/outline/melanoma/3/16_18?bits=1
+# Cell boundaries of a segmentation tile as a 1 bit or 8 bit mask
+@app.route('/generated/outline/<string:datasource>/<string:level>/<string:tile>')
+def generate_outline_tile(datasource, level, tile):
+    bits = request.args.get('bits', '8')
+    if bits not in ['1', '8']:
+        abort(422)
+    encoding = tile_encoding.negotiate_encoding(request.args.get('format'), request.accept_mimetypes)
+    if encoding is None:
+        abort(422)
+    try:
+        in_bounds = data_model.check_tile(datasource, level, tile, segmentation=True)
+    except ValueError:
+        abort(422)
+    if not in_bounds:
+        abort(404)
+    return cached_tile_response(datasource, encoding, lambda: data_model.get_outline_tile(
+        datasource, int(bits), level, tile, encoding))
+
+
+# E.G /generated/labels/melanoma/3/16_18?field=celltype
+# Segmentation tile with every cell colored by its label field value (RGBA, background transparent)
+@app.route('/generated/labels/<string:datasource>/<string:level>/<string:tile>')
+def generate_label_color_tile(datasource, level, tile):
+    field = request.args.get('field', 'celltype')
+    encoding = request.args.get('format', 'png')
+    if encoding not in ['png', 'webp']:
+        abort(422)
+    try:
+        in_bounds = data_model.check_tile(datasource, level, tile, segmentation=True)
+    except ValueError:
+        abort(422)
+    if not in_bounds:
+        abort(404)
+
+    def render():
+        # Raised for an unknown label field
+        try:
+            return data_model.get_label_color_tile(datasource, field, level, tile, encoding)
+        except ValueError:
+            abort(422)
+
+    return cached_tile_response(datasource, encoding, render)
+
+
+# E.G /generated/aggregate/melanoma/5/1_2?field=celltype&format=zstd
+# Cells binned on a grid aligned with the image tiles: field=density gives cell counts (uint32, y, x), the
+# phenotype field counts per phenotype (uint32, phenotype, y, x) and a marker column its mean (float32, y, x)
+@app.route('/generated/aggregate/<string:datasource>/<string:level>/<string:tile>')
+def generate_aggregate_tile(datasource, level, tile):
+    field = request.args.get('field', 'density')
+    encoding = tile_encoding.negotiate_encoding(request.args.get('format'), request.accept_mimetypes, default='raw')
+    if encoding not in tile_encoding.COMPRESSION:
+        abort(422)
+    try:
+        in_bounds = data_model.check_aggregate_tile(datasource, level, tile)
+    except ValueError:
+        abort(422)
+    if not in_bounds:
+        abort(404)
+
+    def render():
+        # Raised for an unknown field
+        try:
+            return data_model.get_aggregate_tile(datasource, field, int(level), tile, encoding)
+        except ValueError:
+            abort(422)
+
+    return cached_tile_response(datasource, encoding, render)
+
+
+@app.route('/get_aggregate_info', methods=['GET'])
+def get_aggregate_info():
+    datasource = request.args.get('datasource')
+    try:
+        resp = data_model.get_aggregate_info(datasource)
+    except ValueError:
+        abort(422)
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/get_tile_cache_stats', methods=['GET'])
+def get_tile_cache_stats():
+    resp = data_model.get_tile_cache_stats()
+    return serialize_and_submit_json(resp)
+
+
+@app.route('/get_loaded_datasources', methods=['GET'])
+def get_loaded_datasources():
+    resp = data_model.get_loaded_datasources()
+    return serialize_and_submit_json(resp)
+
+
+def cached_response(etag, last_modified, build, immutable=False):
+    """
+    Answers 304 Not Modified if the client already holds this version, and only calls build() otherwise.
+    Unless immutable, clients keep the response but revalidate it on every use.
+    """
+    not_modified = request.if_none_match.contains(etag)
+    if not request.if_none_match and request.if_modified_since and last_modified:
+        since = request.if_modified_since
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        not_modified = since.timestamp() >= last_modified
+    if not_modified:
+        response = app.response_class(status=304)
+    else:
+        response = build()
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = datetime.fromtimestamp(last_modified, timezone.utc)
+    if immutable:
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+def cached_datasource_response(datasource, build, representation=None):
+    # Requests carrying the current datasource version (?v=) can be cached forever, others are revalidated
+    # against it so a re-imported datasource is never served stale
+    [version, last_modified] = data_model.get_datasource_version(datasource)
+    if version is None:
+        return build()
+    etag = version if representation is None else version + '-' + representation
+    immutable = request.args.get('v') == version
+    return cached_response(etag, last_modified, build, immutable=immutable)
+
+
+def cached_tile_response(datasource, encoding, render):
+    response = cached_datasource_response(
+        datasource, lambda: app.response_class(render(), mimetype=tile_encoding.MIMETYPES[encoding]), encoding)
+    response.vary.add('Accept')
+    return response
+
+
+@app.route('/get_datasource_version', methods=['GET'])
+def get_datasource_version():
+    datasource = request.args.get('datasource')
+    [version, last_modified] = data_model.get_datasource_version(datasource)
+    return serialize_and_submit_json({'version': version, 'lastModified': last_modified})
 
 
 def serialize_and_submit_json(data):
@@ -1,8 +1,9 @@
 # CRUD for Datasources
 
 from cycif_viewer import app, get_config_names, config_json_path, data_path
-from cycif_viewer.server.utils import mostFrequentLongestSubstring, pre_normalization
+from cycif_viewer.server.utils import intensity_stats, mostFrequentLongestSubstring, pre_normalization
 from cycif_viewer.server.models import data_model
+from cycif_viewer.server.routes import data_routes
 
 from flask import render_template, request, Response, jsonify
 from pathlib import Path
@@ -35,7 +36,7 @@ def delete_with_datasource_name(config_name):
     path = str(data_path / config_name)
     if os.path.exists(path):
         shutil.rmtree(path)
-    with open(config_json_path, "r+") as configJson:
+    with data_model.config_lock, open(config_json_path, "r+") as configJson:
         config_data = json.load(configJson)
         del config_data[config_name]
         configJson.seek(0)  # <--- should reset file position to the beginning.
@@ -203,7 +204,7 @@ def upload_file_page():
                         channelFile = channelFile[:-1]
                     channelFile = Path(channelFile)
 
-                    total_tasks = 2
+                    total_tasks = 3
                     # Process CSV
                     for file in csvFile:
                         # Upload CSV
@@ -229,6 +230,11 @@ def upload_file_page():
                     channelFileNames.extend(channel_info['channel_names'])
                     completed_task += 1
 
+                    current_task = "Computing Channel Intensity Statistics"
+                    intensity_stats.build_eager_stats(channelFile, file_path, channel_info['tileHeight'],
+                                                      channel_info['tileWidth'])
+                    completed_task += 1
+
                     current_task = "Converting Segmentation Mask"
                     label_info = data_model.convertOmeTiff(labelFile, channelFilePath=channelFile,
                                                            dataDirectory=file_path,
@@ -363,7 +369,8 @@ def save_config():
 
         headerList = [x for x in zip(headerList[1::3], headerList[0::3])]
         channelList = originalData['channelFileNames']
-        with open(config_json_path, "r+") as configJson:
+        # Loading the datasource may update config.json itself, so it is reloaded once the lock is released
+        with data_model.config_lock, open(config_json_path, "r+") as configJson:
             configData = json.load(configJson)
             configData[datasetName] = {}
             configData[datasetName]['shapes'] = ''
@@ -448,9 +455,9 @@ def save_config():
             configJson.seek(0)  # <--- should reset file position to the beginning.
             json.dump(configData, configJson, indent=4)
             configJson.truncate()
-            data_model.load_datasource(datasetName, reload=True)
-            resp = jsonify(success=True)
-            return resp
+        data_model.load_datasource(datasetName, reload=True)
+        resp = jsonify(success=True)
+        return resp
 
     except Exception as e:
         resp = jsonify(success=False)
@@ -462,6 +469,8 @@ def save_config():
 @app.route('/init_datasource', methods=['GET'])
 def init_datasource():
     datasource = request.args.get('datasource')
+    if request.args.get('async') == 'true':
+        return data_routes.start_datasource_load(datasource)
     data_model.init(datasource)
     resp = jsonify(success=True)
     return resp
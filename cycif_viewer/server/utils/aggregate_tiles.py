@@ -0,0 +1,141 @@
+# Aggregate rasters of the cell centroids per pyramid level: cell counts per phenotype and mean marker values in
+# square bins of bin_pixels screen pixels. A bin at level l covers bin_pixels * 2 ** l image pixels, so the
+# aggregate tile of a level and position covers the same area as the image tile. Rasters of a whole level are
+# built on first use, in one pass over all cells, and persisted in a zarr directory store next to the datasource
+# with one chunk per tile.
+
+import hashlib
+import shutil
+import threading
+from collections import namedtuple
+
+import numpy as np
+import zarr
+
+BIN_PIXELS = 16
+# Tile cache key component of an aggregate tile, field is 'density', the phenotype field or a marker column
+Aggregate = namedtuple('Aggregate', ['field', 'version'])
+
+open_stores = {}
+open_stores_lock = threading.Lock()
+
+
+def open_aggregate_store(path, identity, height, width, tile_height, tile_width, bin_pixels=BIN_PIXELS):
+    # One instance per store, so that all readers share its build lock
+    with open_stores_lock:
+        store = open_stores.get(str(path))
+        if store is None or store.identity != identity:
+            store = AggregateStore(path, identity, height, width, tile_height, tile_width, bin_pixels)
+            open_stores[str(path)] = store
+        return store
+
+
+def phenotype_digest(codes, categories):
+    # Counts are rebuilt when this changes, marker means are kept
+    digest = hashlib.sha1(np.ascontiguousarray(codes).tobytes())
+    digest.update('\n'.join(str(category) for category in categories).encode())
+    return digest.hexdigest()[:16]
+
+
+def bin_cells(x, y, bin_size, shape):
+    # Flat bin of each cell at one level, -1 for cells outside the raster
+    bx = np.floor(np.asarray(x, dtype=np.float64) / bin_size).astype(np.int64)
+    by = np.floor(np.asarray(y, dtype=np.float64) / bin_size).astype(np.int64)
+    inside = (bx >= 0) & (bx < shape[1]) & (by >= 0) & (by < shape[0])
+    return np.where(inside, by * shape[1] + bx, -1)
+
+
+def count_bins(bins, codes, num_codes, shape):
+    """
+    Cells per code (phenotype) and bin, shaped (code, y, x). Cells outside the raster or without a code
+    (code -1) are not counted.
+    """
+    size = shape[0] * shape[1]
+    valid = (bins >= 0) & (codes >= 0)
+    # Only the (code, bin) pairs that hold cells are counted, the raster itself is the only dense array
+    [keys, key_counts] = np.unique(codes[valid].astype(np.int64) * size + bins[valid], return_counts=True)
+    counts = np.zeros((num_codes,) + tuple(shape), dtype=np.uint32)
+    counts.reshape(-1)[keys] = key_counts
+    return counts
+
+
+def mean_bins(bins, values, shape):
+    # Mean value of the cells in each bin, NaN for empty bins and missing values are skipped
+    values = np.asarray(values, dtype=np.float64)
+    valid = (bins >= 0) & ~np.isnan(values)
+    size = shape[0] * shape[1]
+    sums = np.bincount(bins[valid], weights=values[valid], minlength=size)
+    counts = np.bincount(bins[valid], minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return means.astype(np.float32).reshape(shape)
+
+
+class AggregateStore:
+    """
+    Aggregate rasters of one datasource. identity holds everything they depend on besides the phenotype
+    column (feature source, coordinate columns, image and tile size), the store is emptied when it changes.
+    Counts are stored with the digest of the phenotype column they were built from.
+    """
+
+    def __init__(self, path, identity, height, width, tile_height, tile_width, bin_pixels=BIN_PIXELS):
+        self.path = str(path)
+        self.identity = identity
+        self.height = height
+        self.width = width
+        self.bin_pixels = bin_pixels
+        self.tile_bins = (max(tile_height // bin_pixels, 1), max(tile_width // bin_pixels, 1))
+        self._lock = threading.Lock()
+
+        stored = dict(identity, bin_pixels=bin_pixels, tile_bins=list(self.tile_bins))
+        root = zarr.open_group(zarr.DirectoryStore(self.path), mode='a')
+        if root.attrs.get('identity') != stored:
+            shutil.rmtree(self.path, ignore_errors=True)
+            root = zarr.open_group(zarr.DirectoryStore(self.path), mode='a')
+            root.attrs['identity'] = stored
+        self.root = root
+
+    def bin_size(self, level):
+        # Image pixels covered by a bin at a level
+        return self.bin_pixels * 2 ** level
+
+    def level_shape(self, level):
+        bin_size = self.bin_size(level)
+        return int(np.ceil(self.height / bin_size)), int(np.ceil(self.width / bin_size))
+
+    def _write(self, name, data, attrs):
+        chunks = data.shape[:-2] + self.tile_bins
+        array = self.root.create_dataset(name, data=data, chunks=chunks, overwrite=True)
+        array.attrs.update(attrs)
+        return array
+
+    def counts(self, level, digest, load):
+        """
+        (phenotype, y, x) cell counts of a level. load() returns the x, y, phenotype codes and phenotypes of
+        the cells, it is only called when the counts are missing or were built from another phenotype column,
+        and then the counts of the whole level are rebuilt.
+        """
+        name = 'counts/' + str(level)
+        with self._lock:
+            if name in self.root and self.root[name].attrs.get('digest') == digest:
+                return self.root[name]
+            [x, y, codes, categories] = load()
+            shape = self.level_shape(level)
+            counts = count_bins(bin_cells(x, y, self.bin_size(level), shape), codes, len(categories), shape)
+            return self._write(name, counts, {'digest': digest, 'phenotypes': [str(c) for c in categories]})
+
+    def means(self, level, column, load):
+        # (y, x) mean of a marker column per bin, load() returns the x, y and values of the cells
+        name = 'means/' + hashlib.sha1(column.encode()).hexdigest()[:16] + '/' + str(level)
+        with self._lock:
+            if name in self.root:
+                return self.root[name]
+            [x, y, values] = load()
+            shape = self.level_shape(level)
+            means = mean_bins(bin_cells(x, y, self.bin_size(level), shape), values, shape)
+            return self._write(name, means, {'column': column})
+
+    def read_tile(self, array, tx, ty):
+        # Bins of the tile at (tx, ty), edge tiles are cut at the raster border like image tiles
+        [bh, bw] = self.tile_bins
+        return array[..., ty * bh:(ty + 1) * bh, tx * bw:(tx + 1) * bw]
@@ -0,0 +1,151 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class Datasource:
+    """
+    Everything loaded for one datasource: its config entry, feature table, spatial index, segmentation
+    and channel images. It is not modified once it is in the registry, a reload builds a new one.
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.data = None
+        self.spatial_index = None
+        self.seg = None
+        self.channels = None
+        self.metadata = None
+        self.memory = 0
+
+    def measure_memory(self):
+        # Images opened from files and the memory mapped spatial index are not counted, the loaded feature
+        # columns change over time
+        memory = 0
+        if self.data is not None:
+            memory += self.data.memory()
+        memory += array_memory(self.seg) + array_memory(self.channels)
+        self.memory = memory
+        return memory
+
+
+def array_memory(images):
+    # Bytes of an image held in memory, a numpy array or the levels read so far from a zarr.load'ed group
+    if isinstance(images, np.ndarray):
+        return images.nbytes
+    cache = getattr(images, 'cache', None)
+    if isinstance(cache, dict):
+        return sum(level.nbytes for level in cache.values() if isinstance(level, np.ndarray))
+    return 0
+
+
+class DatasourceRegistry:
+    """
+    Loaded datasources in least recently used order. When their summed memory exceeds the budget the least
+    recently used ones are evicted, the most recently added one is always kept. derived_memory(name) counts
+    state kept outside the datasource that is dropped with it, such as color lookup tables.
+    """
+
+    def __init__(self, memory_budget, on_evict=None, derived_memory=None):
+        self.memory_budget = memory_budget
+        self.on_evict = on_evict
+        self.derived_memory = derived_memory
+        self.evictions = 0
+        self._datasources = OrderedDict()
+        # Loads in progress, name -> (Future, reload)
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._datasources
+
+    def get(self, name):
+        with self._lock:
+            datasource = self._datasources.get(name)
+            if datasource is not None:
+                self._datasources.move_to_end(name)
+            return datasource
+
+    def load(self, name, build, reload=False):
+        """
+        Returns the loaded datasource, calling build(name) if it is not loaded or reload is set. Only one
+        thread builds a datasource at a time, concurrent requests for it wait for that build and share its
+        result or error. The new datasource replaces the old one in a single step, so readers see either.
+        """
+        while True:
+            with self._lock:
+                datasource = self._datasources.get(name)
+                if datasource is not None and not reload:
+                    self._datasources.move_to_end(name)
+                    return datasource
+                if name not in self._loading:
+                    pending = Future()
+                    self._loading[name] = (pending, reload)
+                    break
+                [pending, pending_reload] = self._loading[name]
+            # A reload does not settle for a plain load that may have read the files before they changed
+            if not reload or pending_reload:
+                return pending.result()
+            # Waits for it without raising its error, then loads again
+            pending.exception()
+
+        try:
+            datasource = build(name)
+        except BaseException as e:
+            with self._lock:
+                del self._loading[name]
+            pending.set_exception(e)
+            raise
+        self.put(datasource)
+        with self._lock:
+            del self._loading[name]
+        pending.set_result(datasource)
+        return datasource
+
+    def put(self, datasource):
+        with self._lock:
+            self._datasources.pop(datasource.name, None)
+            self._datasources[datasource.name] = datasource
+            evicted = []
+            while len(self._datasources) > 1 and self.memory() > self.memory_budget:
+                _, oldest = self._datasources.popitem(last=False)
+                evicted.append(oldest)
+                self.evictions += 1
+        for oldest in evicted:
+            print('Evicting datasource', oldest.name, 'to stay within the memory budget')
+            if self.on_evict is not None:
+                self.on_evict(oldest.name)
+
+    def is_loading(self, name):
+        with self._lock:
+            return name in self._loading
+
+    def remove(self, name):
+        with self._lock:
+            return self._datasources.pop(name, None)
+
+    def measure(self, datasource):
+        memory = datasource.measure_memory()
+        if self.derived_memory is not None:
+            memory += self.derived_memory(datasource.name)
+        return memory
+
+    def memory(self):
+        with self._lock:
+            return sum(self.measure(datasource) for datasource in self._datasources.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'datasources': [{'name': name, 'memory': self.measure(datasource),
+                                 'features': datasource.data.stats()}
+                                for name, datasource in self._datasources.items()],
+                'memory': self.memory(),
+                'memory_budget': self.memory_budget,
+                'evictions': self.evictions,
+                'loading': list(self._loading)
+            }
@@ -0,0 +1,143 @@
+import os
+import shutil
+import threading
+
+import numpy as np
+import skimage
+import skimage.transform
+import zarr
+
+from cycif_viewer.server.utils import pyramid_assemble
+
+# Matches the tile size pyramid_assemble uses, so derived channel levels line up with the segmentation pyramid
+PYRAMID_TILE_SIZE = 1024
+
+open_pyramids = {}
+open_pyramids_lock = threading.Lock()
+
+
+def count_levels(shape, tile_size=PYRAMID_TILE_SIZE):
+    return max(int(np.ceil(np.log2(max(shape[-2:]) / tile_size))) + 1, 1)
+
+
+def open_derived_pyramid(source, source_path, path, tile_height, tile_width):
+    # One instance per sidecar store, so that all readers share its build lock
+    with open_pyramids_lock:
+        pyramid = open_pyramids.get(str(path))
+        if pyramid is None or not pyramid.matches(source_path, tile_height, tile_width):
+            pyramid = DerivedPyramid(source, source_path, path, tile_height, tile_width)
+            open_pyramids[str(path)] = pyramid
+        return pyramid
+
+
+class DerivedPyramid:
+    """
+    Pyramid over a single resolution (channel, y, x) image. Level 0 is the image itself, every further level
+    halves it like pyramid_assemble.preduce does. Tiles of derived levels are built on first access, from the
+    level below (recursively), and persisted in a zarr directory store next to the datasource.
+    """
+
+    def __init__(self, source, source_path, path, tile_height, tile_width):
+        self.source = source
+        self.path = str(path)
+        self.tile_height = tile_height
+        self.tile_width = tile_width
+        self.identity = self.source_identity(source_path, tile_height, tile_width)
+        self._lock = threading.RLock()
+        self._built = set()
+
+        root = zarr.open_group(zarr.DirectoryStore(self.path), mode='a')
+        if root.attrs.get('identity') != self.identity:
+            # Source image or tiling changed, the derived levels are stale
+            shutil.rmtree(self.path, ignore_errors=True)
+            root = zarr.open_group(zarr.DirectoryStore(self.path), mode='a')
+            root.attrs['identity'] = self.identity
+        self.store = root.store
+
+        num_channels, height, width = source.shape
+        self.arrays = [source]
+        for level in range(1, count_levels(source.shape)):
+            shape = (num_channels, int(np.ceil(height / 2 ** level)), int(np.ceil(width / 2 ** level)))
+            self.arrays.append(root.require_dataset(
+                str(level), shape=shape, chunks=(1, tile_height, tile_width), dtype=source.dtype, fill_value=0,
+                write_empty_chunks=True))
+
+    @staticmethod
+    def source_identity(source_path, tile_height, tile_width):
+        stat = os.stat(source_path)
+        return [str(source_path), stat.st_mtime_ns, stat.st_size, tile_height, tile_width]
+
+    def matches(self, source_path, tile_height, tile_width):
+        return self.identity == self.source_identity(source_path, tile_height, tile_width)
+
+    def __len__(self):
+        return len(self.arrays)
+
+    def __getitem__(self, level):
+        if level == 0:
+            return self.source
+        return DerivedLevel(self, level)
+
+    def is_built(self, level, channel, ty, tx):
+        key = '%d/%d.%d.%d' % (level, channel, ty, tx)
+        if key in self._built:
+            return True
+        if key in self.store:
+            self._built.add(key)
+            return True
+        return False
+
+    def build(self, level, channel, ty, tx):
+        if level == 0 or self.is_built(level, channel, ty, tx):
+            return
+        with self._lock:
+            if self.is_built(level, channel, ty, tx):
+                return
+            below = self.arrays[level - 1]
+            th, tw = self.tile_height, self.tile_width
+            if level > 1:
+                for cy in [2 * ty, 2 * ty + 1]:
+                    for cx in [2 * tx, 2 * tx + 1]:
+                        if cy * th < below.shape[1] and cx * tw < below.shape[2]:
+                            self.build(level - 1, channel, cy, cx)
+            block = below[channel, 2 * ty * th:2 * (ty + 1) * th, 2 * tx * tw:2 * (tx + 1) * tw]
+            block = skimage.img_as_float32(block)
+            block = skimage.transform.downscale_local_mean(block, (2, 2))
+            block = pyramid_assemble.dtype_convert(block, self.source.dtype)
+            self.arrays[level][channel, ty * th:ty * th + block.shape[0], tx * tw:tx * tw + block.shape[1]] = block
+            self._built.add('%d/%d.%d.%d' % (level, channel, ty, tx))
+
+
+class DerivedLevel:
+    # Read-only view of a derived level that builds the tiles covered by a selection before reading it
+
+    def __init__(self, pyramid, level):
+        self.pyramid = pyramid
+        self.level = level
+        self.array = pyramid.arrays[level]
+        self.shape = self.array.shape
+        self.dtype = self.array.dtype
+
+    def ensure(self, channel_selection, y_slice, x_slice):
+        channels = range(self.shape[0])
+        if isinstance(channel_selection, slice):
+            channels = channels[channel_selection]
+        elif np.isscalar(channel_selection):
+            channels = [int(channel_selection)]
+        else:
+            channels = [int(c) for c in channel_selection]
+        th, tw = self.pyramid.tile_height, self.pyramid.tile_width
+        y_start, y_stop, _ = y_slice.indices(self.shape[1])
+        x_start, x_stop, _ = x_slice.indices(self.shape[2])
+        for channel in channels:
+            for ty in range(y_start // th, int(np.ceil(y_stop / th))):
+                for tx in range(x_start // tw, int(np.ceil(x_stop / tw))):
+                    self.pyramid.build(self.level, channel, ty, tx)
+
+    def __getitem__(self, selection):
+        self.ensure(*selection)
+        return self.array[selection]
+
+    def get_orthogonal_selection(self, selection):
+        self.ensure(*selection)
+        return self.array.get_orthogonal_selection(selection)
@@ -0,0 +1,137 @@
+# Binary columnar cache of a datasource's feature CSV: one .npy file per column plus a manifest, so that columns
+# can be loaded one at a time. String columns are stored as integer codes and categories. The cached table is
+# compacted: float32 floats, the smallest lossless integer types and categorical strings.
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 3
+MANIFEST = 'manifest.json'
+
+
+def source_identity(csv_path):
+    stat = os.stat(csv_path)
+    return {'path': str(csv_path), 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+
+def read_manifest(cache_dir):
+    try:
+        with open(Path(cache_dir) / MANIFEST, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_valid(cache_dir, csv_path, options):
+    manifest = read_manifest(cache_dir)
+    return manifest is not None and manifest.get('version') == CACHE_VERSION and \
+           manifest.get('source') == source_identity(csv_path) and manifest.get('options') == options
+
+
+def compact(df, float_dtype='float32', categorical=True):
+    """
+    Downcasts the columns of a freshly parsed feature table in place: floats to float_dtype, integers to the
+    smallest type holding their range, and strings (phenotypes, cluster names) to categoricals.
+    """
+    for name in df.columns:
+        values = df[name]
+        if values.dtype.kind == 'f':
+            df[name] = values.astype(float_dtype, copy=False)
+        elif values.dtype.kind in 'iu':
+            df[name] = pd.to_numeric(values, downcast='integer' if values.dtype.kind == 'i' else 'unsigned')
+        elif values.dtype == object and categorical:
+            df[name] = values.astype('category')
+    return df
+
+
+def memory_mb(num_bytes):
+    return str(round(num_bytes / 1024 ** 2, 1)) + ' MB'
+
+
+def write_cache(df, cache_dir, csv_path, options, uncompacted_memory):
+    # Written into a temporary directory that replaces the old cache, so readers never see half a cache
+    cache_dir = Path(cache_dir)
+    tmp_dir = cache_dir.with_name(cache_dir.name + '.tmp')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    columns = []
+    for i, name in enumerate(df.columns):
+        column = {'name': name, 'file': 'column_' + str(i) + '.npy'}
+        values = df[name]
+        if values.dtype.name == 'category':
+            column['categorical'] = True
+            column['categories'] = [str(category) for category in values.cat.categories]
+            values = values.cat.codes.to_numpy()
+        elif values.dtype == object:
+            codes, categories = pd.factorize(values)
+            column['categories'] = [str(category) for category in categories]
+            values = codes.astype(np.int32)
+        else:
+            values = values.to_numpy()
+        np.save(tmp_dir / column['file'], values)
+        columns.append(column)
+    manifest = {'version': CACHE_VERSION, 'source': source_identity(csv_path), 'options': options, 'rows': len(df),
+                'uncompacted_memory': uncompacted_memory, 'columns': columns}
+    with open(tmp_dir / MANIFEST, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.replace(tmp_dir, cache_dir)
+
+
+def decode_column(column, values):
+    # -1 codes are missing values
+    if column.get('categorical'):
+        return pd.Categorical.from_codes(values, column['categories'])
+    if 'categories' in column:
+        categories = np.array(column['categories'] + [np.nan], dtype=object)
+        return categories[values]
+    return values
+
+
+def load_column(cache_dir, column):
+    # Numeric columns and categorical codes stay memory mapped and read only, string columns are decoded into
+    # memory. Loaded columns count with their full size against the column budget either way, which bounds
+    # the pages they keep resident.
+    return decode_column(column, np.asarray(np.load(Path(cache_dir) / column['file'], mmap_mode='r')))
+
+
+def load_column_rows(cache_dir, column, positions):
+    # Only the pages holding the requested rows are read from the memory mapped file
+    values = np.load(Path(cache_dir) / column['file'], mmap_mode='r')
+    return decode_column(column, np.asarray(values[positions]))
+
+
+def replace_negative_infinity(df):
+    # Only the columns containing -inf are replaced, instead of copying the whole table
+    for column in df.columns:
+        values = df[column].to_numpy()
+        if values.dtype.kind == 'f' and np.isneginf(values).any():
+            df[column] = np.where(np.isneginf(values), 0, values)
+
+
+def build_cache(csv_path, cache_dir, options):
+    """
+    Parses the feature CSV, without the excluded columns, compacts it and writes the cache. Returns the table,
+    and whether the cache could be written.
+    """
+    start = time.time()
+    print("Loading csv data.. (this can take some time)")
+    excluded = set(options['exclude_columns']) & set(pd.read_csv(csv_path, nrows=0).columns)
+    df = pd.read_csv(csv_path, usecols=lambda column: column not in excluded)
+    # With pandas' defaults, excluded columns would be float64 and ids an extra int64 column
+    uncompacted_memory = int(df.memory_usage(index=True, deep=True).sum()) + 8 * len(df) * (len(excluded) + 1)
+    replace_negative_infinity(df)
+    compact(df, options['float_dtype'], options['categorical'])
+    print('Parsed csv in', round(time.time() - start, 2), 's, writing feature cache')
+    try:
+        write_cache(df, cache_dir, csv_path, options, uncompacted_memory)
+    except OSError as e:
+        print('Could not write feature cache:', e)
+        return df, False
+    return df, True
@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from cycif_viewer.server.utils import feature_cache
+
+
+class FeatureTable:
+    """
+    Feature table whose columns are loaded from the feature cache the first time they are used. Pinned columns
+    (coordinates and phenotype) are loaded up front and kept, the others are evicted least recently used first
+    once they take more than max_bytes. Row ids are the positions of the rows.
+    """
+
+    def __init__(self, cache_dir, manifest, pinned_columns=(), max_bytes=None):
+        self.cache_dir = cache_dir
+        self.num_rows = manifest['rows']
+        self.columns = [column['name'] for column in manifest['columns']]
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned_columns) & set(self.columns)
+        self.loads = 0
+        self.evictions = 0
+        self._manifest_columns = {column['name']: column for column in manifest['columns']}
+        self._loaded = {}
+        self._sizes = {}
+        # Loaded columns that are not pinned, least recently used first
+        self._evictable = OrderedDict()
+        self._lock = threading.RLock()
+        for name in self.pinned:
+            self._values(name)
+
+    @classmethod
+    def from_frame(cls, df):
+        # Used when the cache could not be written, every column stays loaded
+        table = cls(None, {'rows': len(df), 'columns': [{'name': name} for name in df.columns]})
+        for name in df.columns:
+            table._store(name, df[name].values)
+        table.pinned = set(df.columns)
+        return table
+
+    def __len__(self):
+        return self.num_rows
+
+    @property
+    def index(self):
+        return pd.RangeIndex(self.num_rows)
+
+    def _store(self, name, values):
+        self._loaded[name] = values
+        self._sizes[name] = int(pd.Series(values, copy=False).memory_usage(index=False, deep=True))
+
+    def _values(self, name):
+        with self._lock:
+            if name in self._loaded:
+                if name in self._evictable:
+                    self._evictable.move_to_end(name)
+                return self._loaded[name]
+            if name not in self._manifest_columns:
+                raise KeyError(name)
+            values = feature_cache.load_column(self.cache_dir, self._manifest_columns[name])
+            self._store(name, values)
+            self.loads += 1
+            if name not in self.pinned:
+                self._evictable[name] = True
+                self._evict()
+            return values
+
+    def _evict(self):
+        # The most recently loaded column is kept even if it alone exceeds the budget
+        if self.max_bytes is None:
+            return
+        while len(self._evictable) > 1 and sum(self._sizes[name] for name in self._evictable) > self.max_bytes:
+            [name, _] = self._evictable.popitem(last=False)
+            del self._loaded[name]
+            del self._sizes[name]
+            self.evictions += 1
+
+    def is_numeric(self, name):
+        # Without loading the column, strings are cached with their categories
+        with self._lock:
+            if name in self._loaded:
+                return pd.api.types.is_numeric_dtype(pd.Series(self._loaded[name], copy=False))
+            if name not in self._manifest_columns:
+                raise KeyError(name)
+            return 'categories' not in self._manifest_columns[name]
+
+    def column(self, name):
+        return pd.Series(self._values(name), index=self.index, name=name, copy=False)
+
+    def frame(self, columns=None):
+        """
+        Table of the given columns (all by default), loading those that are not loaded yet.
+        """
+        columns = self.columns if columns is None else list(columns)
+        return pd.DataFrame({name: self._values(name) for name in columns}, index=self.index, columns=columns,
+                            copy=False)
+
+    def rows(self, positions, columns=None):
+        """
+        Some rows of the given columns (all by default). Columns that are not loaded are read directly from the
+        cache instead of being loaded as a whole.
+        """
+        positions = pd.Index(positions, dtype='int64').to_numpy()
+        columns = self.columns if columns is None else list(columns)
+        data = {}
+        for name in columns:
+            with self._lock:
+                values = self._loaded.get(name)
+            if values is not None:
+                data[name] = values[positions]
+            elif name in self._manifest_columns:
+                data[name] = feature_cache.load_column_rows(self.cache_dir, self._manifest_columns[name], positions)
+            else:
+                raise KeyError(name)
+        return pd.DataFrame(data, index=positions, columns=columns)
+
+    def memory(self):
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def stats(self):
+        with self._lock:
+            return {
+                'columns': len(self.columns),
+                'loaded': sorted(self._loaded),
+                'pinned': sorted(self.pinned),
+                'memory': sum(self._sizes.values()),
+                'max_bytes': self.max_bytes,
+                'loads': self.loads,
+                'evictions': self.evictions
+            }
+
+
+def read_features(csv_path, cache_dir, pinned_columns=(), max_bytes=None, exclude_columns=(), float_dtype='float32',
+                  categorical=True):
+    """
+    Opens the compacted feature table of a datasource. The binary cache is used when it matches the CSV's path,
+    mtime and size and the compaction options, otherwise it is rebuilt from the CSV first. Excluded columns
+    are not parsed at all. Logs the memory of the loaded columns and the memory saved compared to loading all
+    columns with pandas' default dtypes.
+    """
+    start = time.time()
+    options = {'exclude_columns': sorted(exclude_columns), 'float_dtype': float_dtype, 'categorical': categorical}
+    if not feature_cache.is_valid(cache_dir, csv_path, options):
+        [df, written] = feature_cache.build_cache(csv_path, cache_dir, options)
+        if not written:
+            return FeatureTable.from_frame(df)
+    manifest = feature_cache.read_manifest(cache_dir)
+    table = FeatureTable(cache_dir, manifest, pinned_columns, max_bytes)
+    memory = table.memory()
+    print('Opened feature table in', round(time.time() - start, 2), 's,', len(table.pinned), 'of',
+          len(table.columns), 'columns loaded using', feature_cache.memory_mb(memory) + ',',
+          feature_cache.memory_mb(manifest['uncompacted_memory'] - memory), 'less than all columns with default dtypes')
+    return table
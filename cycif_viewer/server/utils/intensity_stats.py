@@ -0,0 +1,134 @@
+import concurrent.futures
+import itertools
+import json
+import multiprocessing
+import os
+from pathlib import Path
+
+import numpy as np
+import tifffile as tf
+import zarr
+
+from cycif_viewer.server.utils import derived_pyramid
+
+STATS_VERSION = 1
+PERCENTILES = [0.5, 1, 5, 25, 50, 75, 95, 99, 99.5]
+MAX_BINS = 1024
+# Levels up to this many pixels per channel are indexed at import time, larger ones on first request
+EAGER_LEVEL_PIXELS = 4096 * 4096
+
+
+def open_levels(channel_file, directory, tile_height, tile_width):
+    """
+    Pyramid levels of a channel file, full resolution first. Single resolution images get the levels derived
+    from them next to the datasource, as they are served.
+    """
+    channel_io = tf.TiffFile(str(channel_file), is_ome=False)
+    channels = zarr.open(channel_io.series[0].aszarr(), mode='r')
+    if isinstance(channels, zarr.Array):
+        if derived_pyramid.count_levels(channels.shape) == 1:
+            return [channels]
+        channels = derived_pyramid.open_derived_pyramid(channels, channel_file,
+                                                        Path(directory) / 'channel_pyramid.zarr',
+                                                        tile_height, tile_width)
+    return [channels[level] for level in range(len(channels))]
+
+
+def source_identity(channel_file, shape):
+    # Statistics are recomputed when the channel file or the level they were computed from changes
+    stat = os.stat(channel_file)
+    return [STATS_VERSION, stat.st_mtime_ns, stat.st_size, [int(n) for n in shape]]
+
+
+def stats_path(directory, level):
+    return Path(directory) / ('intensity_stats_level_' + str(level) + '.npz')
+
+
+def histogram_edges(dtype):
+    top = np.iinfo(dtype).max + 1 if np.issubdtype(dtype, np.integer) else 65536
+    bins = min(MAX_BINS, top)
+    return np.linspace(0, top, bins + 1)
+
+
+def compute_level_stats(img, tile_height, tile_width):
+    """
+    Per tile min/max/mean and per channel histograms of one pyramid level, shaped (channel, ty, tx) and
+    (channel, bins). Each tile is read once for all channels, tiles are processed on a thread pool.
+    """
+    num_channels, height, width = img.shape
+    edges = histogram_edges(img.dtype)
+    bins = len(edges) - 1
+    shift = int(np.log2(edges[-1] / bins))
+    ny = int(np.ceil(height / tile_height))
+    nx = int(np.ceil(width / tile_width))
+
+    def tile_stats(coords):
+        ty, tx = coords
+        slab = img[:, ty * tile_height:(ty + 1) * tile_height, tx * tile_width:(tx + 1) * tile_width]
+        slab = slab.reshape(num_channels, -1)
+        offsets = (np.arange(num_channels) * bins)[:, None]
+        hist = np.bincount(((slab.astype(np.int64) >> shift) + offsets).ravel(), minlength=num_channels * bins)
+        return ty, tx, slab.min(axis=1), slab.max(axis=1), slab.mean(axis=1), hist.reshape(num_channels, bins), \
+               slab.shape[1]
+
+    tile_min = np.zeros((num_channels, ny, nx), dtype=img.dtype)
+    tile_max = np.zeros((num_channels, ny, nx), dtype=img.dtype)
+    tile_mean = np.zeros((num_channels, ny, nx), dtype=np.float32)
+    tile_count = np.zeros((ny, nx), dtype=np.int64)
+    histogram = np.zeros((num_channels, bins), dtype=np.int64)
+    num_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+    with concurrent.futures.ThreadPoolExecutor(num_workers) as executor:
+        for ty, tx, mins, maxs, means, hist, count in executor.map(
+                tile_stats, itertools.product(range(ny), range(nx))):
+            tile_min[:, ty, tx] = mins
+            tile_max[:, ty, tx] = maxs
+            tile_mean[:, ty, tx] = means
+            tile_count[ty, tx] = count
+            histogram += hist
+    return {'tile_min': tile_min, 'tile_max': tile_max, 'tile_mean': tile_mean, 'tile_count': tile_count,
+            'histogram': histogram, 'edges': edges, 'tile_size': np.array([tile_height, tile_width])}
+
+
+def percentiles_from_histogram(histogram, edges, q=PERCENTILES):
+    # Linearly interpolates within the bin containing each percentile, shaped (channel, len(q))
+    cdf = np.cumsum(histogram, axis=1)
+    result = np.zeros((histogram.shape[0], len(q)))
+    for c in range(histogram.shape[0]):
+        total = cdf[c, -1]
+        if total == 0:
+            continue
+        targets = np.array(q) / 100 * total
+        idx = np.minimum(np.searchsorted(cdf[c], targets), histogram.shape[1] - 1)
+        below = np.where(idx > 0, cdf[c, idx - 1], 0)
+        fraction = (targets - below) / np.maximum(histogram[c, idx], 1)
+        result[c] = edges[idx] + fraction * (edges[idx + 1] - edges[idx])
+    return result
+
+
+def save_level_stats(directory, level, stats, identity):
+    np.savez(stats_path(directory, level), identity=np.array(json.dumps(identity)), **stats)
+
+
+def load_level_stats(directory, level, identity):
+    # None if the level was not indexed or was indexed from another image
+    path = stats_path(directory, level)
+    if not path.is_file():
+        return None
+    with np.load(path) as data:
+        if 'identity' not in data.files or json.loads(str(data['identity'])) != identity:
+            return None
+        return {key: data[key] for key in data.files if key != 'identity'}
+
+
+def build_eager_stats(channel_file, directory, tile_height, tile_width, max_pixels=EAGER_LEVEL_PIXELS):
+    # Indexes the coarsest level and every other level small enough, called when a datasource is imported
+    for path in Path(directory).glob('intensity_stats_level_*.npz'):
+        path.unlink()
+    levels = open_levels(channel_file, directory, tile_height, tile_width)
+    for level in reversed(range(len(levels))):
+        shape = levels[level].shape
+        if level != len(levels) - 1 and shape[-2] * shape[-1] > max_pixels:
+            break
+        print('Computing intensity statistics for level', level)
+        save_level_stats(directory, level, compute_level_stats(levels[level], tile_height, tile_width),
+                         source_identity(channel_file, shape))
@@ -0,0 +1,30 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# Tile cache key component of a label color tile, version changes whenever the labels may have changed
+LabelColors = namedtuple('LabelColors', ['label_field', 'version'])
+
+
+def build_label_lut(values, color_scheme):
+    """
+    Dense RGBA lookup table indexed by segmentation label. Label 0 is background and label i
+    is the cell in row i - 1, colored by its value in the color scheme. Unknown values stay transparent.
+    """
+    codes, uniques = pd.factorize(values)
+    # The extra last row is picked by the -1 code pandas assigns to missing values
+    palette = np.zeros((len(uniques) + 1, 4), dtype=np.uint8)
+    for i, value in enumerate(uniques):
+        color = color_scheme.get(str(value))
+        if color is not None:
+            palette[i] = list(color['rgb']) + [255]
+    lut = np.zeros((len(codes) + 1, 4), dtype=np.uint8)
+    lut[1:] = palette[codes]
+    return lut
+
+
+def apply_label_lut(labels, lut):
+    # One gather per tile, labels without a row map to background
+    labels = np.where(labels < len(lut), labels, 0)
+    return lut[labels]
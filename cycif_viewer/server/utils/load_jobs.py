@@ -0,0 +1,98 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Finished jobs kept for status requests, the oldest are forgotten first
+MAX_FINISHED_JOBS = 100
+
+
+class LoadJob:
+    """
+    A datasource load, or another computation on a datasource, running in the background. params are the
+    computation's parameters. State is 'queued', 'running', 'ready' or 'failed'.
+    """
+
+    def __init__(self, datasource_name, reload=False, params=None):
+        self.id = uuid.uuid4().hex
+        self.datasource_name = datasource_name
+        self.reload = reload
+        self.params = params
+        self.state = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    def is_active(self):
+        return self.state in ['queued', 'running']
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'datasource': self.datasource_name,
+            'params': self.params,
+            'state': self.state,
+            'error': self.error,
+            'created': self.created,
+            'finished': self.finished
+        }
+
+
+class LoadJobs:
+    """
+    Runs load(datasource_name, reload, params) for datasources on a small pool of background threads. Starting a
+    load of a datasource and params that already has a queued or running job returns that job.
+    """
+
+    def __init__(self, load, num_workers, name='datasource-load'):
+        self.load = load
+        self.num_workers = num_workers
+        self.name = name
+        self._jobs = OrderedDict()
+        self._latest = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self, datasource_name, reload=False, params=None):
+        key = self.key(datasource_name, params)
+        with self._lock:
+            job = self._latest.get(key)
+            if job is not None and job.is_active() and (job.reload or not reload):
+                return job
+            job = LoadJob(datasource_name, reload, params)
+            self._jobs[job.id] = job
+            self._latest[key] = job
+            self._forget_finished()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.num_workers, thread_name_prefix=self.name)
+            self._executor.submit(self._run, job)
+            return job
+
+    def _run(self, job):
+        job.state = 'running'
+        try:
+            self.load(job.datasource_name, job.reload, job.params)
+            job.state = 'ready'
+        except Exception as e:
+            print(self.name, 'job of datasource', job.datasource_name, 'failed:', e)
+            job.error = type(e).__name__ + ': ' + str(e)
+            job.state = 'failed'
+        job.finished = time.time()
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.items() if not job.is_active()]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def latest(self, datasource_name, params=None):
+        with self._lock:
+            return self._latest.get(self.key(datasource_name, params))
+
+    @staticmethod
+    def key(datasource_name, params):
+        return datasource_name, None if params is None else tuple(sorted(params.items()))
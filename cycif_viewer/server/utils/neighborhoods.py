@@ -0,0 +1,146 @@
+# Phenotype composition of the neighborhood of every cell: its k nearest neighbors or the cells within a radius,
+# the cell itself excluded. Cells are processed in chunks that are contiguous in the spatial index, so each chunk
+# is spatially compact, on a process pool whose workers open the index memory mapped. The result is a cells x
+# phenotypes matrix of neighbor counts, saved as .npy next to the datasource and memory mapped when served.
+
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+
+from cycif_viewer.server.utils import spatial_index
+
+NEIGHBORHOOD_VERSION = 1
+HEADER = 'neighborhoods.json'
+COMPOSITION = 'composition.npy'
+CHUNK_CELLS = 50000
+MAX_K = 1000
+
+
+def parse_params(k=None, radius=None):
+    # Neighborhood parameters as stored with the result, raises ValueError unless exactly one is valid
+    if (k is None) == (radius is None):
+        raise ValueError('Either k or radius is required')
+    if k is not None:
+        k = int(k)
+        if k < 1 or k > MAX_K:
+            raise ValueError('k must be between 1 and ' + str(MAX_K))
+        return {'k': k}
+    radius = float(radius)
+    if not radius > 0:
+        raise ValueError('radius must be positive')
+    return {'radius': radius}
+
+
+def result_name(params):
+    if 'k' in params:
+        return 'knn_' + str(params['k'])
+    return 'radius_' + str(params['radius'])
+
+
+def count_dtype(params):
+    # kNN counts are at most k, radius counts saturate at 65535
+    if 'k' in params:
+        return np.uint8 if params['k'] <= 255 else np.uint16
+    return np.uint16
+
+
+def neighbors(index, ids, x, y, params):
+    """
+    Neighbors of the cells (ids, x, y) excluding themselves, as (owner, neighbor id) pairs where owner is the
+    position of the cell in ids.
+    """
+    if 'k' in params:
+        # One more than k, as the cell itself is usually among them
+        [_, nearest] = index.nearest_batch(x, y, params['k'] + 1)
+        others = nearest != ids[:, None]
+        # Drops the cell itself, or the farthest neighbor where another cell at the same place displaced it
+        keep = others & (np.cumsum(others, axis=1) <= params['k'])
+        owner = np.repeat(np.arange(len(ids)), keep.sum(axis=1))
+        return owner, nearest[keep]
+    [offsets, found, _] = index.radius_batch(x, y, params['radius'])
+    owner = np.repeat(np.arange(len(ids)), np.diff(offsets))
+    others = found != ids[owner]
+    return owner[others], found[others]
+
+
+def count_chunk(index, codes, num_phenotypes, params, start, stop):
+    """
+    Neighbor counts per phenotype of the cells at positions [start, stop) of the index. Returns their ids and
+    counts shaped (cells, phenotypes), neighbors without a phenotype are not counted.
+    """
+    ids = np.asarray(index.ids[start:stop], dtype=np.int64)
+    [owner, found] = neighbors(index, ids, index.x[start:stop], index.y[start:stop], params)
+    found_codes = np.asarray(codes[found], dtype=np.int64)
+    valid = found_codes >= 0
+    counts = np.bincount(owner[valid] * num_phenotypes + found_codes[valid], minlength=len(ids) * num_phenotypes)
+    counts = np.minimum(counts, np.iinfo(count_dtype(params)).max).astype(count_dtype(params))
+    return ids, counts.reshape(len(ids), num_phenotypes)
+
+
+def compute_composition(index, index_path, codes, num_phenotypes, params, path, identity, num_workers=1):
+    """
+    Computes the composition matrix and saves it at path with identity, written into a temporary directory
+    that replaces the old result. Chunks run on up to num_workers processes, see spatial_index.map_chunks.
+    """
+    start = time.time()
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    composition = np.lib.format.open_memmap(tmp_path / COMPOSITION, mode='w+', dtype=count_dtype(params),
+                                            shape=(len(index), num_phenotypes))
+    chunks = [(i, min(i + CHUNK_CELLS, len(index))) for i in range(0, len(index), CHUNK_CELLS)]
+    for [ids, counts] in spatial_index.map_chunks(count_chunk, index, index_path, [codes], (num_phenotypes, params),
+                                                  chunks, tmp_path, num_workers):
+        composition[ids] = counts
+    composition.flush()
+    del composition
+    with open(tmp_path / HEADER, 'w') as f:
+        json.dump({'version': NEIGHBORHOOD_VERSION, 'identity': identity, 'params': params}, f, indent=4)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print('Computed neighborhood composition', result_name(params), 'of', len(index), 'cells in',
+          round(time.time() - start, 2), 's')
+
+
+def load_composition(path, identity):
+    # The saved composition matrix memory mapped, None if there is none or it was computed from other data
+    path = Path(path)
+    try:
+        with open(path / HEADER, 'r') as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if header.get('version') != NEIGHBORHOOD_VERSION or header.get('identity') != identity:
+        return None
+    return np.load(path / COMPOSITION, mmap_mode='r')
+
+
+def cluster_composition(composition, num_clusters, seed=0):
+    """
+    Cellular neighborhoods: k-means clusters of the cells' neighborhood fractions. Returns the cluster of
+    every cell and the mean fractions of every cluster, the same for the same composition and seed.
+    """
+    totals = np.maximum(composition.sum(axis=1, keepdims=True, dtype=np.float64), 1)
+    fractions = (composition / totals).astype(np.float32)
+    kmeans = MiniBatchKMeans(n_clusters=num_clusters, random_state=seed, batch_size=4096, n_init=3)
+    labels = kmeans.fit_predict(fractions)
+    return labels.astype(np.uint8 if num_clusters <= 256 else np.uint16), kmeans.cluster_centers_.astype(np.float32)
+
+
+def load_clusters(path, num_clusters):
+    # Clusters are saved inside the composition's directory, so they go away when it is recomputed
+    try:
+        with np.load(Path(path) / ('clusters_' + str(num_clusters) + '.npz')) as data:
+            return data['labels'], data['centers']
+    except (OSError, KeyError):
+        return None
+
+
+def save_clusters(path, num_clusters, labels, centers):
+    np.savez(Path(path) / ('clusters_' + str(num_clusters) + '.npz'), labels=labels, centers=centers)
@@ -0,0 +1,31 @@
+from collections import namedtuple
+
+import numpy as np
+
+# Tile cache key component of an outline tile, bits is 1 (boolean mask) or 8 (0/255 mask)
+Outline = namedtuple('Outline', ['bits'])
+
+
+def halo_window(start, size, length):
+    """
+    Range to read for a tile spanning [start, start + size) of an axis of the given length, extended by one
+    pixel on each side where possible, plus the padding needed where the halo falls outside the image.
+    """
+    end = min(start + size, length)
+    read_start = max(start - 1, 0)
+    read_end = min(end + 1, length)
+    return read_start, read_end, (1 - (start - read_start), 1 - (read_end - end))
+
+
+def outline_mask(labels, bits=8):
+    """
+    Cell boundaries of a label tile that has a 1 pixel halo on every side. A pixel is a boundary pixel
+    if it belongs to a cell and any of its 4 neighbors has a different label.
+    """
+    center = labels[1:-1, 1:-1]
+    boundary = (center != labels[:-2, 1:-1]) | (center != labels[2:, 1:-1]) | \
+               (center != labels[1:-1, :-2]) | (center != labels[1:-1, 2:])
+    boundary &= center != 0
+    if bits == 1:
+        return boundary
+    return boundary.astype(np.uint8) * 255
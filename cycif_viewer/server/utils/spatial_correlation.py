@@ -0,0 +1,140 @@
+# Spatial correlation of marker values by neighbor rank: for every rank j below k, the mean over all cells of the
+# product of a cell's standardized marker value with that of its j-th nearest neighbor (rank 0 is the cell itself
+# unless another cell is at the same place), and the mean distance of the j-th neighbors. Cells are processed in
+# chunks that are contiguous in the spatial index, on a process pool whose workers open the index and the
+# standardized values memory mapped. All markers of a chunk are gathered together, so its neighbors are queried
+# once. Results are small and saved per parameter set next to the datasource.
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+
+from cycif_viewer.server.utils import spatial_index
+
+SPATIAL_CORR_VERSION = 1
+HEADER = 'spatial_corr.json'
+RESULT = 'spatial_corr.npz'
+# Neighbors queried at once, a chunk holds CHUNK_NEIGHBORS // k cells
+CHUNK_NEIGHBORS = 2 ** 21
+# Marker values gathered at once
+GATHER_VALUES = 2 ** 22
+MAX_K = 1000
+
+
+def parse_params(markers, k=500, log=False, threshold=None):
+    # Parameters as stored with the result, raises ValueError for invalid ones
+    if isinstance(markers, str) or len(markers) == 0:
+        raise ValueError('markers must be a non-empty list')
+    k = int(k)
+    if k < 1 or k > MAX_K:
+        raise ValueError('k must be between 1 and ' + str(MAX_K))
+    if threshold is not None:
+        threshold = float(threshold)
+        if np.isnan(threshold):
+            raise ValueError('threshold must be a number')
+    return {'markers': tuple(str(marker) for marker in markers), 'k': k, 'log': bool(log), 'threshold': threshold}
+
+
+def result_name(params):
+    # Marker lists make names too long to spell out
+    stored = json.dumps(dict(params, markers=list(params['markers'])), sort_keys=True)
+    return 'corr_' + hashlib.sha1(stored.encode()).hexdigest()[:16]
+
+
+def standardize(values, log=False, threshold=None):
+    """
+    Standardized (cells, markers) values, optionally log1p transformed and then set to 1 at or above the
+    threshold and 0 below it. Missing values are skipped by the mean and standard deviation and returned as 0,
+    with a mask of the present values, None if there are no missing values. Constant markers are all 0.
+    """
+    values = np.array(values, dtype=np.float64)
+    if log:
+        values = np.log1p(values)
+    if threshold is not None:
+        values = np.where(np.isnan(values), np.nan, (values >= threshold).astype(np.float64))
+    present = ~np.isnan(values)
+    mean = np.nanmean(values, axis=0)
+    std = np.nanstd(values, axis=0)
+    values = (values - mean) / np.where(std > 0, std, 1)
+    values[~present] = 0
+    return values.astype(np.float32), None if present.all() else present.astype(np.float32)
+
+
+def correlate_chunk(index, values, present, k, start, stop):
+    """
+    Sums over the cells at positions [start, stop) of the index of their neighbor distances by rank, shaped
+    (k,), and of the products of their values with their neighbors' values by rank and marker, shaped
+    (k, markers), with the number of products that had both values present, None if none are missing.
+    """
+    [distances, neighbors] = index.nearest_batch(index.x[start:stop], index.y[start:stop], k)
+    ids = np.asarray(index.ids[start:stop], dtype=np.int64)
+    num_markers = values.shape[1]
+    sums = np.zeros((k, num_markers))
+    counts = None if present is None else np.zeros((k, num_markers))
+    step = max(GATHER_VALUES // (k * num_markers), 1)
+    for i in range(0, len(ids), step):
+        [block_ids, block_neighbors] = [ids[i:i + step], neighbors[i:i + step]]
+        # (cells, k, markers) values of the neighbors times the (cells, markers) values of the cells, summed
+        # over the cells
+        sums += np.einsum('ckm,cm->km', values[block_neighbors], values[block_ids])
+        if present is not None:
+            counts += np.einsum('ckm,cm->km', present[block_neighbors], present[block_ids])
+    return distances.sum(axis=0), sums, counts
+
+
+def compute_correlation(index, index_path, values, params, path, identity, num_workers=1):
+    """
+    Computes the spatial correlation of the (cells, markers) values of params['markers'], rows in cell id
+    order, and saves it at path with identity, written into a temporary directory that replaces the old
+    result. Chunks run on up to num_workers processes, see spatial_index.map_chunks.
+    """
+    start = time.time()
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    [values, present] = standardize(values, params['log'], params['threshold'])
+    k = min(params['k'], len(index))
+    chunk_cells = max(CHUNK_NEIGHBORS // k, 1)
+    chunks = [(i, min(i + chunk_cells, len(index))) for i in range(0, len(index), chunk_cells)]
+    results = list(spatial_index.map_chunks(correlate_chunk, index, index_path, [values, present], (k,), chunks,
+                                            tmp_path, num_workers))
+    distance = sum(result[0] for result in results) / max(len(index), 1)
+    sums = sum(result[1] for result in results)
+    counts = len(index) if present is None else sum(result[2] for result in results)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = np.where(counts > 0, sums / counts, np.nan)
+    np.savez(tmp_path / RESULT, distance=distance, correlation=correlation)
+    with open(tmp_path / HEADER, 'w') as f:
+        json.dump({'version': SPATIAL_CORR_VERSION, 'identity': identity,
+                   'params': dict(params, markers=list(params['markers']))}, f, indent=4)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print('Computed spatial correlation of', len(params['markers']), 'markers over', k, 'neighbors of',
+          len(index), 'cells in', round(time.time() - start, 2), 's')
+
+
+def load_correlation(path, identity):
+    """
+    The saved result as {'markers', 'k', 'distance', 'correlation'}: the mean distance of the neighbors of
+    each rank and the correlation of each marker by rank. None if there is none or it was computed from
+    other data.
+    """
+    path = Path(path)
+    try:
+        with open(path / HEADER, 'r') as f:
+            header = json.load(f)
+        if header.get('version') != SPATIAL_CORR_VERSION or header.get('identity') != identity:
+            return None
+        with np.load(path / RESULT) as data:
+            [distance, correlation] = [data['distance'], data['correlation']]
+    except (OSError, ValueError, KeyError):
+        return None
+    markers = header['params']['markers']
+    return {'markers': markers, 'k': len(distance), 'distance': distance,
+            'correlation': {marker: np.ascontiguousarray(correlation[:, i]) for i, marker in enumerate(markers)}}
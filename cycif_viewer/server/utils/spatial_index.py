@@ -0,0 +1,511 @@
+# Uniform grid index over cell centroids. Points are sorted by grid cell (row major), so the points of a row of
+# grid cells are one contiguous slice. The index is a directory of .npy files plus a json header, loaded memory
+# mapped without copying. Whole-slide analyses run over chunks of the index with map_chunks.
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+INDEX_VERSION = 1
+HEADER = 'index.json'
+ARRAYS = ['ids', 'x', 'y', 'cell_start']
+# Average number of points per grid cell
+POINTS_PER_CELL = 8
+# Most candidate points a batched query gathers at once
+MAX_BATCH_CANDIDATES = 2 ** 21
+
+# Index and arrays of a map_chunks pool worker
+worker_state = {}
+
+
+def grid_cells(header, x, y):
+    # Grid cell (cx, cy) of each point, points outside the grid are put in the closest border cell
+    cx = np.floor((np.asarray(x, dtype=np.float64) - header['x0']) / header['cell_size'])
+    cy = np.floor((np.asarray(y, dtype=np.float64) - header['y0']) / header['cell_size'])
+    return np.clip(cx, 0, header['nx'] - 1).astype(np.int64), np.clip(cy, 0, header['ny'] - 1).astype(np.int64)
+
+
+def points_in_polygon(x, y, polygon):
+    """
+    Whether each point (x, y) is inside the polygon, a list of [x, y] vertices, by the even-odd rule. Points are
+    sorted by y once, so every edge only tests the points in its band of y instead of all of them, and a
+    lasso costs about as much as a few passes over the points whatever its number of vertices.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+    inside = np.zeros(len(x), dtype=bool)
+    if len(polygon) < 3:
+        return inside
+    order = np.argsort(y, kind='stable')
+    sorted_y = y[order]
+    for [[x0, y0], [x1, y1]] in zip(polygon, np.roll(polygon, -1, axis=0)):
+        if y0 == y1:
+            continue
+        # Half open band, so a vertex shared by two edges is crossed once
+        band = order[np.searchsorted(sorted_y, min(y0, y1)):np.searchsorted(sorted_y, max(y0, y1))]
+        crossing = x0 + (y[band] - y0) * (x1 - x0) / (y1 - y0)
+        band = band[x[band] < crossing]
+        inside[band] = ~inside[band]
+    return inside
+
+
+def id_priority(ids):
+    # Fixed pseudo-random priority of each id (an integer hash), so samples do not depend on the query
+    h = np.asarray(ids, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+    for _ in range(2):
+        h = ((h >> np.uint64(16)) ^ h) * np.uint64(0x45D9F3B) & np.uint64(0xFFFFFFFF)
+    return (h >> np.uint64(16)) ^ h
+
+
+def stratified_sample(ids, x, y, stratum_size):
+    """
+    One point per square stratum of stratum_size, aligned to the origin: the one with the lowest id priority.
+    Strata of power of two sizes nest, so a point sampled at one size is also sampled at every smaller one.
+    Returns the indices of the sampled points and the number of points in their strata.
+    """
+    sx = np.floor(np.asarray(x, dtype=np.float64) / stratum_size).astype(np.int64)
+    sy = np.floor(np.asarray(y, dtype=np.float64) / stratum_size).astype(np.int64)
+    if len(sx) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    stratum = (sy - sy.min()) * (sx.max() - sx.min() + 1) + (sx - sx.min())
+    # Priorities are 32 bit, so one sort orders by (stratum, priority)
+    order = np.argsort((stratum << 32) | id_priority(ids).astype(np.int64))
+    stratum = stratum[order]
+    first = np.flatnonzero(np.concatenate([[True], stratum[1:] != stratum[:-1]]))
+    return order[first], np.diff(np.append(first, len(order)))
+
+
+class GridIndex:
+    """
+    ids are the row ids of the points in grid cell order, x and y their coordinates, and the points of grid
+    cell c are ids[cell_start[c]:cell_start[c + 1]]. Cell (cx, cy) is c = cy * nx + cx.
+    """
+
+    def __init__(self, header, ids, x, y, cell_start):
+        self.header = header
+        self.ids = ids
+        self.x = x
+        self.y = y
+        self.cell_start = cell_start
+        self.x0 = header['x0']
+        self.y0 = header['y0']
+        self.cell_size = header['cell_size']
+        self.nx = header['nx']
+        self.ny = header['ny']
+        # Summed area table of the points per grid cell, built on first use
+        self._count_table = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def box_positions(self, cx0, cy0, cx1, cy1):
+        # Positions (into ids, x, y) of the points in the grid cells [cx0, cx1] x [cy0, cy1], one slice per row
+        cx0, cx1 = max(cx0, 0), min(cx1, self.nx - 1)
+        cy0, cy1 = max(cy0, 0), min(cy1, self.ny - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.zeros(0, dtype=np.int64)
+        rows = np.arange(cy0, cy1 + 1) * self.nx
+        starts = np.asarray(self.cell_start[rows + cx0], dtype=np.int64)
+        ends = np.asarray(self.cell_start[rows + cx1 + 1], dtype=np.int64)
+        lengths = ends - starts
+        # Concatenated ranges without a Python loop
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return offsets + np.arange(lengths.sum())
+
+    def distances(self, positions, x, y):
+        # In float64, the coordinates may be stored as float32
+        return np.hypot(self.x[positions].astype(np.float64) - x, self.y[positions].astype(np.float64) - y)
+
+    def rect_positions(self, x0, y0, x1, y1):
+        [cx0, cy0] = grid_cells(self.header, x0, y0)
+        [cx1, cy1] = grid_cells(self.header, x1, y1)
+        positions = self.box_positions(int(cx0), int(cy0), int(cx1), int(cy1))
+        x = self.x[positions]
+        y = self.y[positions]
+        return positions[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+    def rect(self, x0, y0, x1, y1):
+        """
+        Ids of the points in the rectangle [x0, x1] x [y0, y1], in ascending order.
+        """
+        return np.sort(self.ids[self.rect_positions(x0, y0, x1, y1)])
+
+    def polygon(self, polygon):
+        """
+        Ids of the points inside the polygon, in ascending order. Only the points in its bounding box are
+        tested.
+        """
+        polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        if len(polygon) < 3:
+            return np.zeros(0, dtype=self.ids.dtype)
+        [x0, y0] = polygon.min(axis=0)
+        [x1, y1] = polygon.max(axis=0)
+        positions = self.rect_positions(x0, y0, x1, y1)
+        positions = positions[points_in_polygon(self.x[positions], self.y[positions], polygon)]
+        return np.sort(self.ids[positions])
+
+    def viewport(self, x0, y0, x1, y1, stratum_size=None, max_points=None):
+        """
+        Ids, coordinates and represented cell counts of the points in the rectangle, ordered by id priority so
+        that any prefix is spread over the whole rectangle. With a stratum size, one point per stratum is kept.
+        The stratum size is doubled until at most max_points remain.
+        """
+        positions = self.rect_positions(x0, y0, x1, y1)
+        [ids, x, y] = [self.ids[positions], self.x[positions], self.y[positions]]
+        counts = np.ones(len(ids), dtype=np.int64)
+        if stratum_size is None and max_points is not None and len(ids) > max_points:
+            stratum_size = 2.0 ** np.ceil(np.log2(np.sqrt(max((x1 - x0) * (y1 - y0), 1) / max_points)))
+        while stratum_size is not None:
+            [sampled, counts] = stratified_sample(ids, x, y, stratum_size)
+            if max_points is None or len(sampled) <= max_points:
+                [ids, x, y] = [ids[sampled], x[sampled], y[sampled]]
+                break
+            stratum_size *= 2
+        order = np.argsort(id_priority(ids), kind='stable')
+        return ids[order], x[order], y[order], counts[order], stratum_size
+
+    def radius(self, x, y, r, return_distance=False):
+        """
+        Ids of the points within distance r of (x, y), in ascending order, and optionally their distances.
+        """
+        positions = self.rect_positions(x - r, y - r, x + r, y + r)
+        distances = self.distances(positions, x, y)
+        inside = distances <= r
+        ids = self.ids[positions[inside]]
+        order = np.argsort(ids, kind='stable')
+        if return_distance:
+            return ids[order], distances[inside][order]
+        return ids[order]
+
+    def count_radius(self, x, y, r):
+        positions = self.rect_positions(x - r, y - r, x + r, y + r)
+        return int(np.count_nonzero(self.distances(positions, x, y) <= r))
+
+    def nearest(self, x, y, k=1):
+        """
+        Distances and ids of the k points closest to (x, y), closest first. Grid cells are searched in growing
+        squares around (x, y) until no unsearched cell can hold a closer point.
+        """
+        k = min(k, len(self))
+        if k == 0:
+            return np.zeros(0), np.zeros(0, dtype=self.ids.dtype)
+        [cx, cy] = grid_cells(self.header, x, y)
+        cx, cy = int(cx), int(cy)
+        # The 3 x 3 cells around (x, y) usually settle it
+        ring = 1
+        while True:
+            positions = self.box_positions(cx - ring, cy - ring, cx + ring, cy + ring)
+            if len(positions) >= k:
+                distances = self.distances(positions, x, y)
+                closest = np.argpartition(distances, k - 1)[:k]
+                closest = closest[np.lexsort((self.ids[positions[closest]], distances[closest]))]
+                # Points outside the searched square are at least as far away as its sides that have grid
+                # cells beyond them
+                sides = [np.inf]
+                if cx - ring > 0:
+                    sides.append(x - (self.x0 + (cx - ring) * self.cell_size))
+                if cx + ring < self.nx - 1:
+                    sides.append(self.x0 + (cx + ring + 1) * self.cell_size - x)
+                if cy - ring > 0:
+                    sides.append(y - (self.y0 + (cy - ring) * self.cell_size))
+                if cy + ring < self.ny - 1:
+                    sides.append(self.y0 + (cy + ring + 1) * self.cell_size - y)
+                if distances[closest[-1]] <= min(sides):
+                    return distances[closest], self.ids[positions[closest]]
+            ring *= 2
+
+    def box_rows(self, cx0, cy0, cx1, cy1):
+        # Box, first position and length of every grid row of an array of boxes, rows are grouped by box
+        cx0, cx1 = np.maximum(cx0, 0), np.minimum(cx1, self.nx - 1)
+        cy0, cy1 = np.maximum(cy0, 0), np.minimum(cy1, self.ny - 1)
+        num_rows = np.where(cx0 <= cx1, np.maximum(cy1 - cy0 + 1, 0), 0)
+        box = np.repeat(np.arange(len(num_rows)), num_rows)
+        rows = cy0[box] + np.arange(len(box)) - np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+        starts = np.asarray(self.cell_start[rows * self.nx + cx0[box]], dtype=np.int64)
+        ends = np.asarray(self.cell_start[rows * self.nx + cx1[box] + 1], dtype=np.int64)
+        return box, starts, ends - starts
+
+    def boxes_positions(self, cx0, cy0, cx1, cy1):
+        # Like box_positions for arrays of boxes, also returns the box each position belongs to. Positions are
+        # grouped by box, in box order
+        [box, starts, lengths] = self.box_rows(cx0, cy0, cx1, cy1)
+        offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return offsets + np.arange(lengths.sum()), np.repeat(box, lengths)
+
+    def box_batches(self, cx0, cy0, cx1, cy1):
+        """
+        Splits an array of boxes into batches holding about MAX_BATCH_CANDIDATES points together, at least one
+        box each, so that boxes in dense regions do not gather unbounded candidates. The boxes of a batch hold
+        about as many points (within a factor of 2), so padding them to the largest at most doubles the memory.
+        Returns arrays of box indices.
+        """
+        [box, _, lengths] = self.box_rows(cx0, cy0, cx1, cy1)
+        sizes = np.bincount(box, weights=lengths, minlength=len(cx0)).astype(np.int64)
+        order = np.argsort(sizes, kind='stable')
+        if len(order) == 0:
+            return [order]
+        sizes = sizes[order]
+        size_class = np.floor(np.log2(np.maximum(sizes, 1))).astype(np.int64)
+        # Points in the boxes before each box within its size class
+        before = np.cumsum(sizes) - sizes
+        class_start = np.concatenate([[0], np.flatnonzero(np.diff(size_class)) + 1])
+        before -= np.repeat(before[class_start], np.diff(np.append(class_start, len(sizes))))
+        part = before // MAX_BATCH_CANDIDATES
+        return np.split(order, np.flatnonzero((np.diff(size_class) != 0) | (np.diff(part) != 0)) + 1)
+
+    def radius_batch(self, x, y, r):
+        """
+        Points within distance r of each point (x, y), r is a single radius or one per point. Returns offsets,
+        ids and distances, the ids of point i are ids[offsets[i]:offsets[i + 1]] in ascending order.
+        """
+        [x, y, r] = np.broadcast_arrays(np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64),
+                                        np.asarray(r, dtype=np.float64))
+        [cx0, cy0] = grid_cells(self.header, x - r, y - r)
+        [cx1, cy1] = grid_cells(self.header, x + r, y + r)
+        [queries, ids, distances] = [[], [], []]
+        for batch in self.box_batches(cx0, cy0, cx1, cy1):
+            [positions, query] = self.boxes_positions(cx0[batch], cy0[batch], cx1[batch], cy1[batch])
+            query = batch[query]
+            batch_distances = self.distances(positions, x[query], y[query])
+            inside = batch_distances <= r[query]
+            queries.append(query[inside])
+            ids.append(self.ids[positions[inside]])
+            distances.append(batch_distances[inside])
+        [queries, ids, distances] = [np.concatenate(queries), np.concatenate(ids), np.concatenate(distances)]
+        # Ids are row positions, below len(self), so a single sort orders them by (query, id)
+        order = np.argsort(queries * len(self) + ids)
+        offsets = np.zeros(len(x) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(queries, minlength=len(x)), out=offsets[1:])
+        return offsets, ids[order], distances[order]
+
+    def closest_candidates(self, x, y, cx0, cy0, cx1, cy1, k):
+        """
+        Distances and ids of the k points closest to each point (x, y) among the points in its box, shaped
+        (points, k) and padded with infinite distances. Candidates are laid out in a (points, largest box)
+        matrix so that one argpartition per row picks them by squared distance, ties are broken by id among
+        the picked ones.
+        """
+        [positions, query] = self.boxes_positions(cx0, cy0, cx1, cy1)
+        counts = np.bincount(query, minlength=len(x))
+        width = max(int(counts.max(initial=0)), k)
+        column = np.arange(len(query)) - np.repeat(np.cumsum(counts) - counts, counts)
+        dx = self.x[positions].astype(np.float64) - x[query]
+        dy = self.y[positions].astype(np.float64) - y[query]
+        candidate_squares = np.full((len(x), width), np.inf)
+        candidate_squares[query, column] = dx * dx + dy * dy
+        candidate_positions = np.full((len(x), width), -1, dtype=np.int64)
+        candidate_positions[query, column] = positions
+        if width > k:
+            closest = np.argpartition(candidate_squares, k - 1, axis=1)[:, :k]
+            candidate_positions = np.take_along_axis(candidate_positions, closest, axis=1)
+        # Distances of the picked candidates only, the same as those of the other queries
+        found = candidate_positions >= 0
+        candidate_distances = np.where(found, self.distances(np.maximum(candidate_positions, 0), x[:, None],
+                                                             y[:, None]), np.inf)
+        candidate_ids = np.where(found, self.ids[np.maximum(candidate_positions, 0)], 0)
+        order = np.argsort(candidate_distances, axis=1)
+        [candidate_distances, candidate_ids] = [np.take_along_axis(candidate_distances, order, axis=1),
+                                                np.take_along_axis(candidate_ids, order, axis=1)]
+        # Rows with equal distances, rare besides padding, are sorted again with ties broken by id
+        tied = np.flatnonzero((candidate_distances[:, 1:] == candidate_distances[:, :-1]).any(axis=1))
+        if len(tied) > 0:
+            order = np.lexsort((candidate_ids[tied], candidate_distances[tied]), axis=1)
+            candidate_distances[tied] = np.take_along_axis(candidate_distances[tied], order, axis=1)
+            candidate_ids[tied] = np.take_along_axis(candidate_ids[tied], order, axis=1)
+        return candidate_distances, candidate_ids
+
+    def box_counts(self, cx0, cy0, cx1, cy1):
+        # Number of points in arrays of boxes of grid cells [cx0, cx1] x [cy0, cy1]
+        if self._count_table is None:
+            counts = np.diff(np.asarray(self.cell_start, dtype=np.int64)).reshape(self.ny, self.nx)
+            table = np.zeros((self.ny + 1, self.nx + 1), dtype=np.int64)
+            np.cumsum(np.cumsum(counts, axis=0), axis=1, out=table[1:, 1:])
+            self._count_table = table
+        [cx0, cx1] = [np.clip(cx0, 0, self.nx), np.clip(cx1 + 1, 0, self.nx)]
+        [cy0, cy1] = [np.clip(cy0, 0, self.ny), np.clip(cy1 + 1, 0, self.ny)]
+        table = self._count_table
+        return table[cy1, cx1] - table[cy0, cx1] - table[cy1, cx0] + table[cy0, cx0]
+
+    def start_rings(self, cx, cy, k):
+        """
+        Ring of grid cells around the cell (cx, cy) of each point that nearest_batch searches first. Points
+        whose own cell holds k points start with just that cell, as points in dense cells would gather many
+        candidates from the cells around them. The others start with the smallest ring expected to hold k
+        points closer than its inner edge, from the density of points in its box, so that a large k does not
+        take a pass per doubling of the ring.
+        """
+        ring = np.where(self.box_counts(cx, cy, cx, cy) >= k, 0, 1)
+        pending = np.flatnonzero(ring > 0)
+        r = 1
+        while len(pending) > 0 and r < max(self.nx, self.ny):
+            ring[pending] = r
+            [pcx, pcy] = [cx[pending], cy[pending]]
+            count = self.box_counts(pcx - r, pcy - r, pcx + r, pcy + r)
+            pending = pending[count * np.pi * r ** 2 < k * (2 * r + 1) ** 2]
+            r += max(r // 4, 1)
+        return ring
+
+    def nearest_batch(self, x, y, k=1):
+        """
+        Distances and ids of the k points closest to each point (x, y), closest first, as (points, k) arrays.
+        Like nearest, but all points that are not settled yet are searched together, ring by ring.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        k = min(k, len(self))
+        distances = np.zeros((len(x), k))
+        ids = np.zeros((len(x), k), dtype=self.ids.dtype)
+        [cx, cy] = grid_cells(self.header, x, y)
+        pending = np.arange(len(x)) if k > 0 else np.zeros(0, dtype=np.int64)
+        ring = self.start_rings(cx, cy, k)
+        while len(pending) > 0:
+            [px, py, pcx, pcy] = [x[pending], y[pending], cx[pending], cy[pending]]
+            closest_distances = np.zeros((len(pending), k))
+            closest_ids = np.zeros((len(pending), k), dtype=self.ids.dtype)
+            for batch in self.box_batches(pcx - ring, pcy - ring, pcx + ring, pcy + ring):
+                [closest_distances[batch], closest_ids[batch]] = self.closest_candidates(
+                    px[batch], py[batch], pcx[batch] - ring[batch], pcy[batch] - ring[batch],
+                    pcx[batch] + ring[batch], pcy[batch] + ring[batch], k)
+            sides = np.stack([
+                np.where(pcx - ring > 0, px - (self.x0 + (pcx - ring) * self.cell_size), np.inf),
+                np.where(pcx + ring < self.nx - 1, self.x0 + (pcx + ring + 1) * self.cell_size - px, np.inf),
+                np.where(pcy - ring > 0, py - (self.y0 + (pcy - ring) * self.cell_size), np.inf),
+                np.where(pcy + ring < self.ny - 1, self.y0 + (pcy + ring + 1) * self.cell_size - py, np.inf)])
+            done = closest_distances[:, -1] <= sides.min(axis=0)
+            distances[pending[done]] = closest_distances[done]
+            ids[pending[done]] = closest_ids[done]
+            pending = pending[~done]
+            ring = np.maximum(ring[~done] * 2, 1)
+        return distances, ids
+
+    def memory(self):
+        return sum(int(getattr(self, name).nbytes) for name in ARRAYS)
+
+
+def build_index(x, y, points_per_cell=POINTS_PER_CELL):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(x)
+    x0, y0 = (float(x.min()), float(y.min())) if n else (0.0, 0.0)
+    width, height = (float(x.max()) - x0, float(y.max()) - y0) if n else (0.0, 0.0)
+    # Square cells sized so that a cell holds points_per_cell points on average
+    cell_size = max(np.sqrt(max(width * height, 1.0) * points_per_cell / max(n, 1)), 1e-6)
+    nx = int(width // cell_size) + 1
+    ny = int(height // cell_size) + 1
+    header = {'version': INDEX_VERSION, 'points': n, 'x0': x0, 'y0': y0, 'cell_size': cell_size, 'nx': nx, 'ny': ny}
+    [cx, cy] = grid_cells(header, x, y)
+    cells = cy * nx + cx
+    order = np.argsort(cells, kind='stable')
+    cell_start = np.concatenate([[0], np.cumsum(np.bincount(cells, minlength=nx * ny))]).astype(np.int64)
+    return GridIndex(header, order.astype(np.int32 if n < 2 ** 31 else np.int64), x[order], y[order], cell_start)
+
+
+def save_index(index, path, identity):
+    # Written into a temporary directory that replaces the old index, so readers never see half an index
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    for name in ARRAYS:
+        np.save(tmp_path / (name + '.npy'), getattr(index, name))
+    # The saved index is the same as this one, map_chunks workers open it by its identity
+    index.header = dict(index.header, identity=identity)
+    with open(tmp_path / HEADER, 'w') as f:
+        json.dump(index.header, f, indent=4)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+
+def load_index(path, identity):
+    """
+    Opens a saved index memory mapped, returns None if there is none, it has another version or it was built
+    for other data than identity describes.
+    """
+    path = Path(path)
+    try:
+        with open(path / HEADER, 'r') as f:
+            header = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if header.get('version') != INDEX_VERSION or header.get('identity') != identity:
+        return None
+    # Plain array views of the memory maps, indexing np.memmap instances is slower
+    arrays = [np.asarray(np.load(path / (name + '.npy'), mmap_mode='r')) for name in ARRAYS]
+    return GridIndex(header, *arrays)
+
+
+def open_index(path, x, y, identity, reload=False):
+    """
+    Loads the index saved at path, or builds it from the coordinates and saves it.
+    """
+    index = None if reload else load_index(path, identity)
+    if index is None:
+        print('Building spatial index')
+        index = build_index(x, y)
+        try:
+            save_index(index, path, identity)
+        except OSError as e:
+            print('Could not save spatial index:', e)
+    return index
+
+
+def pool_context():
+    """
+    Workers start from a fresh process, a forked copy of the server would inherit its threads and their locks.
+    The fork server imports the libraries loaded here once, so that the workers forked from it start quickly.
+    This package is left to the workers, the fork server does not get this process' import path.
+    """
+    if getattr(sys, 'frozen', False) or 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    packages = {name.split('.')[0] for name in list(sys.modules)} - {__name__.split('.')[0]}
+    context.set_forkserver_preload(sorted(name for name in packages if not name.startswith('_')))
+    return context
+
+
+def init_chunk_worker(path, identity, array_paths):
+    worker_state['index'] = load_index(path, identity)
+    worker_state['arrays'] = [None if array_path is None else np.load(array_path, mmap_mode='r')
+                              for array_path in array_paths]
+
+
+def run_worker_chunk(function, args, start, stop):
+    return function(worker_state['index'], *worker_state['arrays'], *args, start, stop)
+
+
+def map_chunks(function, index, path, arrays, args, chunks, tmp_path, num_workers=1):
+    """
+    Yields function(index, *arrays, *args, start, stop) for every (start, stop) chunk, in order. Runs on a
+    process pool whose workers open the index saved at path and the arrays memory mapped, written into
+    tmp_path for them, instead of receiving copies with every chunk. Runs in this process for a single chunk
+    or worker, or when index is not the one saved at path. function must be defined at module level, arrays
+    may be None.
+    """
+    identity = index.header.get('identity')
+    if num_workers > 1 and len(chunks) > 1 and (identity is None or load_index(path, identity) is None):
+        num_workers = 1
+    if num_workers <= 1 or len(chunks) <= 1:
+        for [start, stop] in chunks:
+            yield function(index, *arrays, *args, start, stop)
+        return
+    array_paths = [None if array is None else str(Path(tmp_path) / ('chunk_array_' + str(i) + '.npy'))
+                   for i, array in enumerate(arrays)]
+    try:
+        for [array_path, array] in zip(array_paths, arrays):
+            if array_path is not None:
+                np.save(array_path, np.asarray(array))
+        with ProcessPoolExecutor(min(num_workers, len(chunks)), mp_context=pool_context(),
+                                 initializer=init_chunk_worker,
+                                 initargs=(str(path), identity, array_paths)) as pool:
+            yield from pool.map(run_worker_chunk, [function] * len(chunks), [args] * len(chunks), *zip(*chunks))
+    finally:
+        for array_path in array_paths:
+            if array_path is not None and os.path.exists(array_path):
+                os.remove(array_path)
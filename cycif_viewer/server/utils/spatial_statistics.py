@@ -0,0 +1,334 @@
+# Spatial statistics of a pair of phenotypes A and B over a sweep of radii: the cross-type Ripley's K, its variance
+# stabilized form L and the pair correlation g, with Ripley's isotropic edge correction for the bounding box of the
+# cells, and the distribution of the distance from every A cell to the nearest B cell, with the reduced sample
+# correction for G. A and B may be the same phenotype. The null is random labelling: for distinct phenotypes the
+# A and B labels are permuted among the A and B cells, for a single phenotype its label is permuted among all
+# cells, so that the tissue's own layout is kept. Pairs of cells closer than the largest radius are gathered once
+# per chunk of cells, chunks being contiguous in the spatial index, on a process pool whose workers open the index
+# and the observed labels memory mapped. Workers draw the labels of the permutations for the cells they read, each
+# cell's position under a permutation being computed on its own from the seed and the number of the permutation,
+# so chunks agree on the cells they share and no labels are stored. The pairs of each radius bin form a sparse
+# matrix, so the observed labels and a block of permutations are counted over them with one sparse product per bin.
+# Results are small and saved per parameter set next to the datasource.
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+from scipy import sparse
+
+from cycif_viewer.server.utils import spatial_index
+
+SPATIAL_STATS_VERSION = 2
+RESULT = 'spatial_stats.json'
+# Expected pairs of cells gathered at once, chunks are sized from the density of the labelled cells
+CHUNK_PAIRS = 2 ** 20
+# Pairs times labellings counted at once
+LABELLING_VALUES = 2 ** 23
+MAX_RADII = 200
+MAX_PERMUTATIONS = 999
+# Labels of the cells, a cell of a single phenotype is both
+LABEL_A = 1
+LABEL_B = 2
+# Rounds of the Feistel network that permutes the labelled cells, fewer cells are permuted whole, the network
+# being biased over small ranges
+PERMUTATION_ROUNDS = 6
+FEISTEL_CELLS = 2 ** 16
+
+
+def parse_params(phenotype_a, phenotype_b, radii, permutations=99):
+    # Parameters as stored with the result, raises ValueError for invalid ones
+    radii = [float(radius) for radius in radii]
+    if len(radii) == 0 or len(radii) > MAX_RADII:
+        raise ValueError('Between 1 and ' + str(MAX_RADII) + ' radii are required')
+    if not radii[0] > 0 or np.any(np.diff(radii) <= 0) or not np.all(np.isfinite(radii)):
+        raise ValueError('radii must be positive and increasing')
+    permutations = int(permutations)
+    if permutations < 0 or permutations > MAX_PERMUTATIONS:
+        raise ValueError('permutations must be between 0 and ' + str(MAX_PERMUTATIONS))
+    return {'phenotype_a': str(phenotype_a), 'phenotype_b': str(phenotype_b), 'radii': tuple(radii),
+            'permutations': permutations}
+
+
+def result_name(params):
+    # Radius lists make names too long to spell out
+    stored = json.dumps(dict(params, radii=list(params['radii'])), sort_keys=True)
+    return 'stats_' + hashlib.sha1(stored.encode()).hexdigest()[:16]
+
+
+def window(index):
+    # Bounding box [x0, y0, x1, y1] of all cells, the observation window of the statistics
+    if len(index) == 0:
+        return [0.0, 0.0, 0.0, 0.0]
+    return [float(np.min(index.x)), float(np.min(index.y)), float(np.max(index.x)), float(np.max(index.y))]
+
+
+def max_radius(bounds):
+    # The isotropic correction assumes that a circle is not cut by two opposite sides of the window
+    return min(bounds[2] - bounds[0], bounds[3] - bounds[1]) / 2
+
+
+def edge_distances(x, y, bounds):
+    # Distances of points to the left, bottom, right and top side of the window, shaped (points, 4)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return np.maximum(np.stack([x - bounds[0], y - bounds[1], bounds[2] - x, bounds[3] - y], axis=1), 0)
+
+
+def isotropic_weights(edges, distances):
+    """
+    Ripley's isotropic edge correction of pairs whose first point has the (pairs, 4) edge distances: the
+    inverse of the fraction of the circle through the second point, around the first, inside the window.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Half the angle of the circle beyond each side, 0 for sides the circle does not reach
+        beyond = np.where(edges < distances[:, None], np.arccos(np.minimum(edges / distances[:, None], 1)), 0)
+    outside = 2 * beyond.sum(axis=1)
+    # Arcs beyond two adjacent sides overlap when the corner is inside the circle
+    for [side, next_side] in [(0, 1), (1, 2), (2, 3), (3, 0)]:
+        outside -= np.maximum(beyond[:, side] + beyond[:, next_side] - np.pi / 2, 0)
+    return np.where(distances > 0, 2 * np.pi / np.maximum(2 * np.pi - outside, 1e-12), 1)
+
+
+def mix(values):
+    # splitmix64 finalizer, a bijection of uint64 arrays whose output bits each depend on all input bits
+    values = values ^ (values >> np.uint64(30))
+    values = values * np.uint64(0xbf58476d1ce4e5b9)
+    values = values ^ (values >> np.uint64(27))
+    values = values * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def permutation_keys(seed, permutation):
+    # Round keys of one random permutation
+    counter = (seed << 32) + permutation * PERMUTATION_ROUNDS
+    return mix(np.arange(counter, counter + PERMUTATION_ROUNDS, dtype=np.uint64))
+
+
+def permute(cells, num_cells, keys):
+    """
+    Positions of cells under the random permutation of range(num_cells) given by keys: a Feistel network over
+    the smallest power of 4 holding num_cells, applied again to the positions that fall outside of it. Cells
+    are permuted each on their own, so any of them get the positions they have in the whole permutation.
+    """
+    half_bits = max((int(num_cells - 1).bit_length() + 1) // 2, 1)
+    [half, mask] = [np.uint64(half_bits), np.uint64((1 << half_bits) - 1)]
+    positions = np.asarray(cells, dtype=np.uint64).copy()
+    pending = np.arange(len(positions))
+    while len(pending) > 0:
+        values = positions[pending]
+        [left, right] = [values >> half, values & mask]
+        for key in keys:
+            [left, right] = [right, left ^ (mix(right ^ key) & mask)]
+        values = (left << half) | right
+        positions[pending] = values
+        pending = pending[values >= num_cells]
+    return positions.astype(np.int64)
+
+
+def random_labels(observed, cells, labellings, seed=0):
+    """
+    Labels of some of the labelled cells, shaped (cells, labellings): the observed labels for labelling 0 and
+    a random permutation of them for the others, drawn from seed and the number of the labelling.
+    """
+    labels = np.empty((len(cells), len(labellings)), dtype=np.int8)
+    for [i, labelling] in enumerate(labellings):
+        if labelling == 0:
+            permuted = cells
+        elif len(observed) <= FEISTEL_CELLS:
+            permuted = np.random.default_rng([seed, labelling]).permutation(len(observed))[cells]
+        else:
+            permuted = permute(cells, len(observed), permutation_keys(seed, labelling))
+        labels[:, i] = observed[permuted]
+    return labels
+
+
+def count_chunk(index, positions, local, observed, bounds, radii, num_labellings, seed, start, stop):
+    """
+    Counts over the labelled cells [start, stop), at index positions positions[start:stop], for the observed
+    labels and num_labellings - 1 random labellings drawn from seed: the edge corrected A-B pairs by radius
+    bin, and the reduced sample counts of G, the A cells at least r from the border with a B cell within r and
+    all A cells at least r from the border. local maps cell ids to labelled cells, -1 for the others. Returns
+    arrays shaped (labellings, radii).
+    """
+    radii = np.asarray(radii)
+    rows = np.arange(start, stop)
+    x = np.asarray(index.x[positions[start:stop]], dtype=np.float64)
+    y = np.asarray(index.y[positions[start:stop]], dtype=np.float64)
+    [offsets, ids, distances] = index.radius_batch(x, y, radii[-1])
+    owner = np.repeat(np.arange(len(rows)), np.diff(offsets))
+    column = np.asarray(local[ids], dtype=np.int64)
+    keep = (column >= 0) & (column != rows[owner])
+    [owner, column, distances] = [owner[keep], column[keep], distances[keep]]
+    edges = edge_distances(x, y, bounds)
+    weights = isotropic_weights(edges[owner], distances)
+    radius_bin = np.searchsorted(radii, distances, side='left')
+    # Whether each cell is at least r from the border, shaped (cells, radii)
+    inside = edges.min(axis=1)[:, None] >= radii
+
+    # Only the labels of the cells of the chunk and their neighbors are drawn
+    needed = np.unique(np.concatenate([rows, column]))
+    row_positions = np.searchsorted(needed, rows)
+    column = np.searchsorted(needed, column)
+    # Pairs of each radius bin as sparse (cells, needed cells) matrices, weighted and counted
+    order = np.argsort(radius_bin, kind='stable')
+    bin_starts = np.searchsorted(radius_bin[order], np.arange(len(radii) + 1))
+    pairs = []
+    for i in range(len(radii)):
+        in_bin = order[bin_starts[i]:bin_starts[i + 1]]
+        weighted = sparse.csr_matrix((weights[in_bin], (owner[in_bin], column[in_bin])),
+                                     shape=(len(rows), len(needed)))
+        counted = weighted.copy()
+        counted.data[:] = 1
+        pairs.append((weighted, counted))
+
+    pair_sums = np.zeros((num_labellings, len(radii)))
+    nearest_numerator = np.zeros((num_labellings, len(radii)))
+    nearest_denominator = np.zeros((num_labellings, len(radii)))
+    step = max(LABELLING_VALUES // max(len(needed), 1), 1)
+    for first in range(0, num_labellings, step):
+        block = slice(first, min(first + step, num_labellings))
+        needed_labels = random_labels(observed, needed, range(block.start, block.stop), seed)
+        is_a = (needed_labels[row_positions] & LABEL_A) > 0
+        is_b = ((needed_labels & LABEL_B) > 0).astype(np.float64)
+        # B cells within the radii so far of each cell and labelling
+        within = np.zeros(is_a.shape)
+        for [i, [weighted, counted]] in enumerate(pairs):
+            pair_sums[block, i] = np.sum(is_a * (weighted @ is_b), axis=0)
+            within += counted @ is_b
+            inside_a = is_a & inside[:, i:i + 1]
+            nearest_numerator[block, i] = np.count_nonzero(inside_a & (within > 0), axis=0)
+            nearest_denominator[block, i] = np.count_nonzero(inside_a, axis=0)
+    return pair_sums, nearest_numerator, nearest_denominator
+
+
+def label_cells(index, codes, code_a, code_b):
+    # Index positions of the labelled cells, in index order, and their observed labels
+    cell_codes = np.asarray(codes)[np.asarray(index.ids)]
+    if code_a == code_b:
+        positions = np.arange(len(index))
+        observed = np.where(cell_codes == code_a, LABEL_A | LABEL_B, 0).astype(np.int8)
+    else:
+        positions = np.flatnonzero((cell_codes == code_a) | (cell_codes == code_b))
+        observed = np.where(cell_codes[positions] == code_a, LABEL_A, LABEL_B).astype(np.int8)
+    return positions, observed
+
+
+def nearest_distances(index, codes, code_a, code_b):
+    # Distance from every A cell to the nearest other B cell, over the whole slide
+    cell_codes = np.asarray(codes)[np.asarray(index.ids)]
+    [a, b] = [np.flatnonzero(cell_codes == code_a), np.flatnonzero(cell_codes == code_b)]
+    if len(a) == 0 or len(b) <= (code_a == code_b):
+        return np.zeros(0)
+    b_index = spatial_index.build_index(np.asarray(index.x[b]), np.asarray(index.y[b]))
+    if code_a != code_b:
+        return b_index.nearest_batch(index.x[a], index.y[a], 1)[0][:, 0]
+    # The nearest cell of a single phenotype is the cell itself, b_index ids are positions in b, which is a
+    [distances, ids] = b_index.nearest_batch(index.x[a], index.y[a], 2)
+    return np.where(ids[:, 0] == np.arange(len(a)), distances[:, 1], distances[:, 0])
+
+
+def summarize(observed, null, theoretical):
+    # Observed values with the theoretical ones and the mean and pointwise 95% envelope of the null
+    summary = {'observed': observed, 'theoretical': theoretical}
+    if len(null) > 0:
+        # G is undefined (NaN) at radii where no A cell is that far from the border
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            summary.update({'null_mean': np.nanmean(null, axis=0), 'null_low': np.nanpercentile(null, 2.5, axis=0),
+                            'null_high': np.nanpercentile(null, 97.5, axis=0)})
+    return summary
+
+
+def compute_statistics(index, index_path, codes, code_a, code_b, params, path, identity, num_workers=1, seed=0):
+    """
+    Computes the statistics of params for the phenotype codes code_a and code_b of the cells (codes in cell
+    id order) and saves them at path with identity, written into a temporary directory that replaces the old
+    result. Permutations are drawn from seed. Chunks run on up to num_workers processes, see
+    spatial_index.map_chunks.
+    """
+    start = time.time()
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    radii = np.asarray(params['radii'])
+    bounds = window(index)
+    area = max((bounds[2] - bounds[0]) * (bounds[3] - bounds[1]), 1e-12)
+    [positions, observed] = label_cells(index, codes, code_a, code_b)
+    local = np.full(len(index), -1, dtype=np.int64)
+    local[np.asarray(index.ids)[positions]] = np.arange(len(positions))
+
+    expected_pairs = len(positions) / area * np.pi * radii[-1] ** 2
+    chunk_cells = int(max(CHUNK_PAIRS // max(expected_pairs, 1), 1))
+    chunks = [(i, min(i + chunk_cells, len(positions))) for i in range(0, len(positions), chunk_cells)]
+    num_labellings = 1 + params['permutations']
+    results = list(spatial_index.map_chunks(count_chunk, index, index_path, [positions, local, observed],
+                                            (bounds, radii, num_labellings, seed), chunks, tmp_path, num_workers))
+    [pair_sums, nearest_numerator, nearest_denominator] = [
+        sum((result[i] for result in results), np.zeros((num_labellings, len(radii)))) for i in range(3)]
+
+    # Permutations keep the number of A and B cells
+    num_a = int(np.count_nonzero(observed & LABEL_A))
+    num_b = int(np.count_nonzero(observed & LABEL_B))
+    num_pairs = num_a * num_b - int(np.count_nonzero(observed == LABEL_A | LABEL_B))
+    k = area * np.cumsum(pair_sums, axis=1) / max(num_pairs, 1)
+    l = np.sqrt(k / np.pi)
+    # Ring estimator of the pair correlation, between consecutive radii
+    g = np.diff(k, axis=1, prepend=0) / (np.pi * np.diff(radii ** 2, prepend=0))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        nearest_g = np.where(nearest_denominator > 0, nearest_numerator / nearest_denominator, np.nan)
+    # Two sided pointwise p-values of L, from the deviation of the observed and null values from the null mean
+    p_value = None
+    if num_labellings > 1:
+        deviation = np.abs(l - l[1:].mean(axis=0))
+        p_value = (1 + np.sum(deviation[1:] >= deviation[0], axis=0)) / num_labellings
+
+    distances = nearest_distances(index, codes, code_a, code_b)
+    edges = np.concatenate([[0], radii])
+    result = {
+        'phenotypes': [params['phenotype_a'], params['phenotype_b']], 'radii': radii, 'cells': [num_a, num_b],
+        'window': bounds, 'permutations': params['permutations'],
+        'K': summarize(k[0], k[1:], np.pi * radii ** 2), 'L': summarize(l[0], l[1:], radii),
+        'g': summarize(g[0], g[1:], np.ones(len(radii))), 'G': summarize(nearest_g[0], nearest_g[1:], None),
+        'p_value': p_value,
+        'nearest': {'mean': float(distances.mean()) if len(distances) else None,
+                    'median': float(np.median(distances)) if len(distances) else None,
+                    'histogram': np.histogram(distances, bins=edges)[0],
+                    'beyond': int(np.count_nonzero(distances > radii[-1]))}
+    }
+    with open(tmp_path / RESULT, 'w') as f:
+        json.dump({'version': SPATIAL_STATS_VERSION, 'identity': identity,
+                   'params': dict(params, radii=list(params['radii'])), 'result': to_json(result)}, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+    print('Computed spatial statistics of', params['phenotype_a'], 'and', params['phenotype_b'], 'with',
+          params['permutations'], 'permutations over', len(positions), 'cells in', round(time.time() - start, 2), 's')
+
+
+def to_json(value):
+    # Arrays as lists and NaN, where a statistic is undefined, as None
+    if isinstance(value, dict):
+        return {key: to_json(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return [to_json(item) for item in value.tolist()]
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def load_statistics(path, identity):
+    # The saved result, None if there is none or it was computed from other data
+    try:
+        with open(Path(path) / RESULT, 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if saved.get('version') != SPATIAL_STATS_VERSION or saved.get('identity') != identity:
+        return None
+    return saved['result']
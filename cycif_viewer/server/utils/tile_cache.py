@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+
+class TileCache:
+    """
+    Thread-safe LRU cache for rendered tiles, bounded by a total byte budget.
+    Keys are tuples whose first element is the datasource name, so all entries of
+    a datasource can be dropped at once when it is reloaded. Each invalidation starts a
+    new generation of the datasource's tiles, tiles rendered in an older one are not cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        # Generation of the last invalidation of each datasource, and of the last one of all datasources
+        self._generation = 0
+        self._generations = {}
+        self._cleared = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(value):
+        if hasattr(value, 'nbytes'):
+            return int(value.nbytes)
+        return len(value)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self, datasource_name):
+        with self._lock:
+            return max(self._generations.get(datasource_name, 0), self._cleared)
+
+    def put(self, key, value, generation=None):
+        # generation is the one of the datasource when the tile started rendering, if it was given
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != max(self._generations.get(key[0], 0), self._cleared):
+                return
+            if key in self._entries:
+                self.current_bytes -= self._sizeof(self._entries.pop(key))
+            self._entries[key] = value
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= self._sizeof(evicted)
+                self.evictions += 1
+
+    def invalidate(self, datasource_name=None):
+        with self._lock:
+            self._generation += 1
+            if datasource_name is None:
+                self._cleared = self._generation
+                self._entries.clear()
+                self.current_bytes = 0
+                return
+            self._generations[datasource_name] = self._generation
+            for key in [key for key in self._entries if key[0] == datasource_name]:
+                self.current_bytes -= self._sizeof(self._entries.pop(key))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0
+            }
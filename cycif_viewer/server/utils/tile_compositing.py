@@ -0,0 +1,42 @@
+from collections import namedtuple
+
+import numpy as np
+from PIL import ImageColor
+
+# Rendering settings of a composite tile. All fields are tuples (one entry per channel) so that the
+# settings can be part of a tile cache key.
+Composite = namedtuple('Composite', ['channels', 'colors', 'windows', 'gammas'])
+
+
+def make_composite(channels, colors, mins=None, maxs=None, gammas=None):
+    """
+    Builds composite settings from per channel lists. Colors are hex strings ('#ff0000' or 'ff0000'),
+    windows are in raw intensity units and default to the full uint16 range, gamma defaults to 1.
+    Raises ValueError when the lists do not line up.
+    """
+    n = len(channels)
+    mins = mins if mins else [0] * n
+    maxs = maxs if maxs else [65535] * n
+    gammas = gammas if gammas else [1] * n
+    if not (len(colors) == len(mins) == len(maxs) == len(gammas) == n) or n == 0:
+        raise ValueError('Expected one color, window and gamma per channel')
+    rgb = tuple(tuple(ImageColor.getcolor('#' + color.lstrip('#'), 'RGB')) for color in colors)
+    windows = tuple((float(low), float(high)) for low, high in zip(mins, maxs))
+    return Composite(tuple(int(c) for c in channels), rgb, windows, tuple(float(g) for g in gammas))
+
+
+def composite(slab, settings):
+    """
+    Additively blends a (channel, y, x) slab into an 8 bit RGB tile, the same way frag.glsl colors and
+    blends channels on the GPU: each channel is windowed to [0, 1], gamma corrected and multiplied by its color.
+    """
+    windows = np.array(settings.windows, dtype=np.float32)
+    low = windows[:, 0, None, None]
+    span = np.maximum(windows[:, 1] - windows[:, 0], 1e-6)[:, None, None]
+    scaled = np.clip((slab.astype(np.float32) - low) / span, 0, 1)
+    gammas = np.array(settings.gammas, dtype=np.float32)
+    if np.any(gammas != 1):
+        scaled **= gammas[:, None, None]
+    colors = np.array(settings.colors, dtype=np.float32) / 255
+    rgb = np.einsum('cyx,ck->yxk', scaled, colors)
+    return (np.clip(rgb, 0, 1) * 255 + 0.5).astype(np.uint8)
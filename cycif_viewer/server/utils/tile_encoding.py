@@ -0,0 +1,94 @@
+# Encodes image tiles into the formats the tile routes can serve.
+#
+# Image formats:
+#   png     - 16 bit grayscale for channel tiles, label bytes in RGB(A) for segmentation tiles
+#   webp    - lossless; uint16 pixels are split into R (high byte) and G (low byte), as frag.glsl decodes them
+# Binary formats (HEADER followed by little-endian pixels, channel-major):
+#   raw     - uncompressed
+#   deflate - zlib stream
+#   zstd    - zstandard frame
+
+import io
+import struct
+import zlib
+
+import numpy as np
+from numcodecs import Zstd
+from PIL import Image
+
+HEADER = struct.Struct('<4sBBBBIII')
+MAGIC = b'CYCT'
+VERSION = 1
+COMPRESSION = {'raw': 0, 'deflate': 1, 'zstd': 2}
+
+MIMETYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'raw': 'application/vnd.cycif.tile+raw',
+    'deflate': 'application/vnd.cycif.tile+deflate',
+    'zstd': 'application/vnd.cycif.tile+zstd'
+}
+DEFAULT_ENCODING = 'png'
+
+zstd_codec = Zstd(level=1)
+
+
+def negotiate_encoding(requested, accept_mimetypes, default=DEFAULT_ENCODING):
+    """
+    Picks the tile encoding from an explicit format name, or else from the Accept header.
+    Only the binary formats are negotiated via Accept, as browsers list image/webp for every image request.
+    """
+    if requested:
+        return requested if requested in MIMETYPES else None
+    for encoding in COMPRESSION:
+        if MIMETYPES[encoding] in accept_mimetypes.values():
+            return encoding
+    return default
+
+
+def label_to_rgba(tile):
+    tile = np.ascontiguousarray(tile, dtype='<u4')
+    tile = tile.view('uint8').reshape(tile.shape + (-1,))[..., [0, 1, 2]]
+    return np.append(tile, np.zeros((tile.shape[0], tile.shape[1], 1), dtype='uint8'), axis=2)
+
+
+def split_bytes_to_rgb(tile):
+    rgb = np.zeros(tile.shape + (3,), dtype='uint8')
+    rgb[..., 0] = tile >> 8
+    rgb[..., 1] = tile & 0xFF
+    return rgb
+
+
+def encode_binary(tile, compression='raw'):
+    tile = np.asarray(tile)
+    if tile.ndim == 2:
+        tile = tile[np.newaxis]
+    payload = np.ascontiguousarray(tile, dtype=tile.dtype.newbyteorder('<')).tobytes()
+    if compression == 'deflate':
+        payload = zlib.compress(payload, 1)
+    elif compression == 'zstd':
+        payload = zstd_codec.encode(payload)
+    header = HEADER.pack(MAGIC, VERSION, COMPRESSION[compression], tile.dtype.itemsize, 0, *tile.shape)
+    return header + bytes(payload)
+
+
+def encode_image(tile, encoding='png'):
+    file_object = io.BytesIO()
+    if tile.dtype == np.uint32:
+        tile = label_to_rgba(tile)
+        # The alpha byte carries no data, and lossless WebP may drop colors under zero alpha
+        if encoding == 'webp':
+            tile = tile[..., :3]
+    if encoding == 'webp':
+        if tile.dtype == np.uint16:
+            tile = split_bytes_to_rgb(tile)
+        Image.fromarray(tile).save(file_object, 'WEBP', lossless=True, quality=0, method=0)
+    else:
+        Image.fromarray(tile).save(file_object, 'PNG', compress_level=1)
+    return file_object.getvalue()
+
+
+def encode_tile(tile, encoding=DEFAULT_ENCODING):
+    if encoding in COMPRESSION:
+        return encode_binary(tile, encoding)
+    return encode_image(tile, encoding)
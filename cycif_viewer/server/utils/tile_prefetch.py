@@ -0,0 +1,102 @@
+import threading
+from collections import OrderedDict, deque
+
+
+class TilePrefetcher:
+    """
+    Background workers that warm the tile cache with tiles likely to be requested next.
+    Pending work is a bounded stack: the newest tiles are rendered first, and once the queue is full
+    the oldest (stale) prefetches are dropped. Tiles are scheduled with the tile cache generation of
+    their datasource, render(key, generation) gets it back so that tiles of a datasource that was
+    reloaded meanwhile are not cached.
+    """
+
+    def __init__(self, render, num_workers=4, max_pending=64):
+        self.render = render
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.scheduled = 0
+        self.dropped = 0
+        self.completed = 0
+        self.skipped = 0
+        self.failed = 0
+        self.hits = 0
+        self._pending = deque()
+        self._pending_keys = set()
+        self._prefetched = OrderedDict()
+        self._condition = threading.Condition()
+        self._workers = []
+
+    def _start(self):
+        for i in range(self.num_workers):
+            worker = threading.Thread(target=self._run, name='tile-prefetch-' + str(i), daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def schedule(self, keys, generation=None):
+        if self.num_workers <= 0:
+            return
+        with self._condition:
+            if not self._workers:
+                self._start()
+            for key in keys:
+                if key in self._pending_keys:
+                    continue
+                if len(self._pending) >= self.max_pending:
+                    self._pending_keys.discard(self._pending.popleft()[0])
+                    self.dropped += 1
+                self._pending.append((key, generation))
+                self._pending_keys.add(key)
+                self.scheduled += 1
+            self._condition.notify_all()
+
+    def cancel(self, datasource_name=None):
+        with self._condition:
+            kept = [job for job in self._pending if datasource_name is not None and job[0][0] != datasource_name]
+            self.dropped += len(self._pending) - len(kept)
+            self._pending = deque(kept)
+            self._pending_keys = set(key for [key, _] in kept)
+
+    def record_hit(self, key):
+        # Called on a cache hit, counts it if the tile was put there by a prefetch
+        with self._condition:
+            if self._prefetched.pop(key, None) is not None:
+                self.hits += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                [key, generation] = self._pending.pop()
+                self._pending_keys.discard(key)
+            try:
+                rendered = self.render(key, generation)
+            except Exception as e:
+                print('Prefetching tile', key, 'failed:', e)
+                with self._condition:
+                    self.failed += 1
+                continue
+            with self._condition:
+                if rendered:
+                    self.completed += 1
+                    self._prefetched[key] = True
+                    # Only remember as many prefetched tiles as could plausibly still be cached
+                    while len(self._prefetched) > self.max_pending * 16:
+                        self._prefetched.popitem(last=False)
+                else:
+                    self.skipped += 1
+
+    def stats(self):
+        with self._condition:
+            return {
+                'workers': self.num_workers,
+                'pending': len(self._pending),
+                'scheduled': self.scheduled,
+                'dropped': self.dropped,
+                'completed': self.completed,
+                'skipped': self.skipped,
+                'failed': self.failed,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.completed if self.completed > 0 else 0
+            }
@@ -1,9 +1,11 @@
 from waitress import serve
 from cycif_viewer import app
+from cycif_viewer.server.models import data_model
 import multiprocessing
 import sys
 
 if __name__ == '__main__':
     multiprocessing.freeze_support()
+    data_model.preload_datasources()
     print("Server Running")
     serve(app, host='0.0.0.0', port=8000, max_request_body_size=107374182400, max_request_header_size=8589934592)
@@ -0,0 +1,78 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+from cycif_viewer import app
+
+# Size of the test datasource's images, its tiles and the number of pyramid levels and cells
+HEIGHT = 512
+WIDTH = 384
+TILE = 128
+LEVELS = 3
+NUM_CELLS = 300
+PHENOTYPES = ['Bcell', 'Stroma', 'Tumor']
+
+
+def write_pyramid(path, image, metadata=None):
+    # Full resolution image with its halved levels as sub IFDs, like the images the viewer imports
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        tif.write(image, tile=(TILE, TILE), subifds=LEVELS - 1, metadata=metadata)
+        for level in range(1, LEVELS):
+            tif.write(image[..., ::2 ** level, ::2 ** level], tile=(TILE, TILE), subfiletype=1)
+
+
+def make_datasource(directory):
+    """
+    Writes a datasource of 3 channels and NUM_CELLS square cells, and returns its config.json entry and
+    the arrays it was made from.
+    """
+    rng = np.random.default_rng(0)
+    channels = rng.integers(0, 60000, (3, HEIGHT, WIDTH), dtype=np.uint16)
+    labels = np.zeros((HEIGHT, WIDTH), dtype=np.uint32)
+    x = rng.uniform(4, WIDTH - 4, NUM_CELLS)
+    y = rng.uniform(4, HEIGHT - 4, NUM_CELLS)
+    for i in range(NUM_CELLS):
+        labels[int(y[i]) - 3:int(y[i]) + 3, int(x[i]) - 3:int(x[i]) + 3] = i + 1
+    write_pyramid(directory / 'img.ome.tif', channels, {'axes': 'CYX'})
+    write_pyramid(directory / 'seg.ome.tif', labels)
+    cells = pd.DataFrame({'CellID': np.arange(1, NUM_CELLS + 1), 'X_centroid': x, 'Y_centroid': y,
+                          'M0': rng.random(NUM_CELLS) * 1000, 'M1': rng.random(NUM_CELLS) * 1000,
+                          'M2': rng.random(NUM_CELLS) * 1000, 'Area': rng.integers(10, 100, NUM_CELLS),
+                          'phenotype': rng.choice(PHENOTYPES, NUM_CELLS)})
+    cells.to_csv(directory / 'cells.csv', index=False)
+    src = 'cycif_viewer/data/' + directory.name + '/'
+    config = {
+        'featureData': [{'src': src + 'cells.csv', 'xCoordinate': 'X_centroid', 'yCoordinate': 'Y_centroid',
+                         'celltype': 'phenotype', 'idField': 'CellID', 'normalization': 'none'}],
+        'segmentation': src + 'seg.ome.tif', 'channelFile': src + 'img.ome.tif', 'tileWidth': TILE,
+        'tileHeight': TILE, 'maxLevel': LEVELS, 'height': HEIGHT, 'width': WIDTH, 'num_channels': 3,
+        'imageData': [{'name': 'Area', 'fullname': 'Area', 'src': '/generated/data/test/seg/'}] +
+                     [{'name': 'M' + str(i), 'fullname': 'M' + str(i), 'src': '/generated/data/test/img_' + str(i) + '/'}
+                      for i in range(3)]
+    }
+    return config, channels, labels, cells
+
+
+@pytest.fixture(scope='session')
+def datasource(tmp_path_factory):
+    """
+    The test datasource, written into a temporary working directory that the app's relative data path
+    points to for the session: its name, the channel image, the segmentation and the cells.
+    """
+    root = tmp_path_factory.mktemp('app')
+    directory = root / 'cycif_viewer' / 'data' / 'test'
+    directory.mkdir(parents=True)
+    [config, channels, labels, cells] = make_datasource(directory)
+    with open(root / 'cycif_viewer' / 'data' / 'config.json', 'w') as f:
+        json.dump({'test': config}, f, indent=4)
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(root)
+        yield {'name': 'test', 'channels': channels, 'labels': labels, 'cells': cells}
+
+
+@pytest.fixture
+def client(datasource):
+    return app.test_client()
@@ -0,0 +1,58 @@
+import numpy as np
+
+from cycif_viewer.server.utils import aggregate_tiles
+
+
+def test_bin_cells():
+    bins = aggregate_tiles.bin_cells([0, 15.9, 16, 40, -1, 50, 10], [0, 0, 0, 20, 0, 10, 40], 16, (2, 3))
+    # Cells left of, right of or below the raster are outside
+    np.testing.assert_array_equal(bins, [0, 0, 1, 5, -1, -1, -1])
+
+
+def test_count_bins():
+    rng = np.random.default_rng(0)
+    bins = rng.integers(-1, 12, 500)
+    codes = rng.integers(-1, 3, 500)
+    counts = aggregate_tiles.count_bins(bins, codes, 4, (3, 4))
+    assert counts.dtype == np.uint32 and counts.shape == (4, 3, 4)
+    for code in range(4):
+        expected = [np.count_nonzero((bins == b) & (codes == code)) for b in range(12)]
+        np.testing.assert_array_equal(counts[code].ravel(), expected)
+    # Cells outside the raster or without a code are not counted
+    assert counts.sum() == np.count_nonzero((bins >= 0) & (codes >= 0))
+    assert not aggregate_tiles.count_bins(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8), 2, (1, 1)).any()
+
+
+def test_mean_bins():
+    means = aggregate_tiles.mean_bins(np.array([0, 0, 1, 1, -1, 3]), [1, 3, 5, np.nan, 100, 2], (2, 2))
+    np.testing.assert_array_equal(means, np.array([[2, 5], [np.nan, 2]], dtype=np.float32))
+
+
+def test_store_builds_levels_once(tmp_path):
+    calls = []
+    x = np.array([1.0, 20, 100, 130])
+    y = np.array([1.0, 1, 50, 70])
+    codes = np.array([0, 1, 1, 0])
+
+    def load():
+        calls.append(True)
+        return x, y, codes, ['A', 'B']
+
+    store = aggregate_tiles.AggregateStore(tmp_path / 'aggregates.zarr', {'source': 1}, 80, 140, 64, 64)
+    assert store.tile_bins == (4, 4) and store.level_shape(0) == (5, 9) and store.level_shape(1) == (3, 5)
+    counts = store.counts(1, 'digest', load)
+    np.testing.assert_array_equal(counts[:].sum(axis=0), [[2, 0, 0, 0, 0], [0, 0, 0, 1, 0], [0, 0, 0, 0, 1]])
+    store.counts(1, 'digest', load)
+    assert len(calls) == 1
+    # Counts of another phenotype column are rebuilt
+    store.counts(1, 'other', load)
+    assert len(calls) == 2
+    # Edge tiles are cut at the raster border
+    assert store.read_tile(counts, 1, 0).shape == (2, 3, 1)
+    reopened = aggregate_tiles.AggregateStore(tmp_path / 'aggregates.zarr', {'source': 1}, 80, 140, 64, 64)
+    reopened.counts(1, 'other', load)
+    assert len(calls) == 2
+    # The store is emptied when what the rasters depend on changes
+    changed = aggregate_tiles.AggregateStore(tmp_path / 'aggregates.zarr', {'source': 2}, 80, 140, 64, 64)
+    changed.counts(1, 'other', load)
+    assert len(calls) == 3
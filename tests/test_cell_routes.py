@@ -0,0 +1,86 @@
+import json
+
+import numpy as np
+
+
+def post(client, url, **form):
+    return client.post(url, data={name: value if isinstance(value, str) else json.dumps(value)
+                                  for name, value in form.items()})
+
+
+def test_nearest_cells(client, datasource):
+    cells = datasource['cells']
+    points = [[cells['X_centroid'][3], cells['Y_centroid'][3]], [100.5, 200.5]]
+    response = post(client, '/get_nearest_cells', datasource='test', points=points, k=2, fields=['phenotype', 'M0'])
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['k'] == 2 and len(result['id']) == 4
+    # Coordinates are stored as float32
+    assert result['id'][0] == 3 and result['distance'][0] < 1e-3
+    distances = np.hypot(cells['X_centroid'] - 100.5, cells['Y_centroid'] - 200.5)
+    np.testing.assert_allclose(result['distance'][2:], np.sort(distances)[:2], atol=1e-3)
+    assert result['phenotype'] == cells['phenotype'][result['id']].tolist()
+    np.testing.assert_allclose(result['M0'], cells['M0'][result['id']], rtol=1e-6)
+
+
+def test_neighborhoods(client, datasource):
+    cells = datasource['cells']
+    points = [[100, 100], [300, 400]]
+    response = post(client, '/get_neighborhoods', datasource='test', points=points, radius=[30, 50])
+    assert response.status_code == 200
+    result = response.get_json()
+    for i, [[x, y], r] in enumerate(zip(points, [30, 50])):
+        expected = np.flatnonzero(np.hypot(cells['X_centroid'] - x, cells['Y_centroid'] - y) <= r)
+        assert result['id'][result['offsets'][i]:result['offsets'][i + 1]] == expected.tolist()
+
+
+def test_batch_query_errors(client):
+    for form in [{'points': [[0, 0]], 'k': 0}, {'points': [[0, 0]], 'k': 'a'}, {'points': [[0, 0, 1]]},
+                 {'points': 'nope'}, {'points': '[[0, NaN]]'}, {'points': [[0, 0]], 'fields': ['missing']}]:
+        assert post(client, '/get_nearest_cells', datasource='test', **form).status_code == 422, form
+    for form in [{'points': [[0, 0]], 'radius': -1}, {'points': [[0, 0]], 'radius': 'Infinity'},
+                 {'points': [[0, 0]]}, {'points': [[0, 0], [1, 1]], 'radius': [1, 2, 3]}]:
+        assert post(client, '/get_neighborhoods', datasource='test', **form).status_code == 422, form
+
+
+def test_selected_cells(client, datasource):
+    [x, y] = [datasource['cells']['X_centroid'].to_numpy(), datasource['cells']['Y_centroid'].to_numpy()]
+    # Corners may be given in any order
+    response = post(client, '/get_selected_cells', datasource='test', rect=[300, 200, 100, 50], fields=['Area'])
+    assert response.status_code == 200
+    result = response.get_json()
+    expected = np.flatnonzero((x >= 100) & (x <= 300) & (y >= 50) & (y <= 200))
+    assert result['id'] == expected.tolist()
+    assert result['Area'] == datasource['cells']['Area'][expected].tolist()
+    triangle = [[0, 0], [380, 0], [0, 500]]
+    result = post(client, '/get_selected_cells', datasource='test', polygon=triangle).get_json()
+    assert result['id'] == np.flatnonzero(x / 380 + y / 500 < 1).tolist()
+
+
+def test_selected_cells_errors(client):
+    for form in [{}, {'rect': [0, 0, 1, 1], 'polygon': [[0, 0], [1, 0], [0, 1]]}, {'rect': [0, 0, 1]},
+                 {'rect': 'nope'}, {'rect': [0, 0, 1, 1], 'fields': ['missing']}]:
+        assert post(client, '/get_selected_cells', datasource='test', **form).status_code == 422, form
+
+
+def test_viewport_cells(client, datasource):
+    [x, y] = [datasource['cells']['X_centroid'].to_numpy(), datasource['cells']['Y_centroid'].to_numpy()]
+    inside = np.flatnonzero((x >= 50) & (x <= 350) & (y >= 20) & (y <= 400))
+    result = client.get('/get_viewport_cells?datasource=test&rect=50,20,350,400').get_json()
+    assert result['total'] == len(inside) and sorted(result['id']) == inside.tolist()
+    assert set(result['count']) == {1} and result['stratum_size'] is None
+    # Zoomed out or capped, every sampled cell stands for the cells of its stratum
+    for query in ['&level=2', '&maxPoints=20']:
+        result = client.get('/get_viewport_cells?datasource=test&rect=50,20,350,400' + query).get_json()
+        assert result['total'] < len(inside) and sum(result['count']) == len(inside)
+        assert set(result['id']) <= set(inside.tolist())
+    assert result['total'] <= 20
+    page = client.get('/get_viewport_cells?datasource=test&rect=50,20,350,400&maxPoints=20&page=1&pageSize=8')
+    assert page.get_json()['id'] == result['id'][8:16]
+
+
+def test_viewport_cells_errors(client):
+    for query in ['', '&rect=0,0,1', '&rect=0,0,10,10&maxPoints=0', '&rect=0,0,10,10&maxPoints=-5',
+                  '&rect=0,0,10,10&level=3', '&rect=0,0,10,10&level=100000', '&rect=0,0,10,10&level=-1',
+                  '&rect=0,0,10,10&fields=["missing"]']:
+        assert client.get('/get_viewport_cells?datasource=test' + query).status_code == 422, query
@@ -0,0 +1,48 @@
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from cycif_viewer.server.models import data_model
+from cycif_viewer.server.utils import spatial_index
+from conftest import HEIGHT, NUM_CELLS, WIDTH
+
+
+def count_calls(monkeypatch, module, name):
+    calls = []
+    function = getattr(module, name)
+
+    def counted(*args, **kwargs):
+        calls.append(kwargs)
+        return function(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, counted)
+    return calls
+
+
+def test_build_datasource_parses_features_once(datasource, monkeypatch):
+    shutil.rmtree(data_model.data_path / 'test' / 'feature_cache', ignore_errors=True)
+    stages = []
+    monkeypatch.setattr(data_model, 'report_load_stage', lambda name, stage: stages.append(stage))
+    reads = count_calls(monkeypatch, pd, 'read_csv')
+    builds = count_calls(monkeypatch, spatial_index, 'build_index')
+    loaded = data_model.build_datasource('test', reload=True)
+    assert stages == ['features', 'index', 'segmentation', 'metadata', 'ready']
+    # Besides its header, the CSV is parsed once and the index is built from the parsed coordinates
+    assert len([kwargs for kwargs in reads if 'nrows' not in kwargs]) == 1
+    assert len(builds) == 1
+    np.testing.assert_allclose(loaded.data.column('M0'), datasource['cells']['M0'], rtol=1e-6)
+    assert len(loaded.spatial_index) == NUM_CELLS
+    assert loaded.seg[0].shape == (HEIGHT, WIDTH)
+    assert loaded.channels[0].shape == (3, HEIGHT, WIDTH)
+
+
+def test_build_datasource_reuses_saved_features_and_index(datasource, monkeypatch):
+    data_model.build_datasource('test')
+    reads = count_calls(monkeypatch, pd, 'read_csv')
+    builds = count_calls(monkeypatch, spatial_index, 'build_index')
+    loaded = data_model.build_datasource('test')
+    assert reads == [] and builds == []
+    [_, [position]] = loaded.spatial_index.nearest(datasource['cells']['X_centroid'][7],
+                                                   datasource['cells']['Y_centroid'][7])
+    assert position == 7
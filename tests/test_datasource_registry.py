@@ -0,0 +1,102 @@
+import threading
+
+import numpy as np
+
+from cycif_viewer.server.utils.datasource_registry import Datasource, DatasourceRegistry
+
+
+def make_datasource(name, memory):
+    datasource = Datasource(name, {})
+    datasource.seg = np.zeros(memory, dtype=np.uint8)
+    return datasource
+
+
+def test_evicts_least_recently_used_beyond_memory_budget():
+    evicted = []
+    registry = DatasourceRegistry(250, on_evict=evicted.append)
+    for name in 'abc':
+        registry.load(name, lambda name: make_datasource(name, 100))
+    assert evicted == ['a']
+    assert 'a' not in registry and 'b' in registry and 'c' in registry
+    # Using b makes c the least recently used
+    assert registry.get('b').name == 'b'
+    registry.load('d', lambda name: make_datasource(name, 100))
+    assert evicted == ['a', 'c']
+    assert registry.memory() == 200 and registry.evictions == 2
+
+
+def test_keeps_the_newest_datasource_over_budget():
+    evicted = []
+    registry = DatasourceRegistry(100, on_evict=evicted.append)
+    registry.load('a', lambda name: make_datasource(name, 50))
+    registry.load('b', lambda name: make_datasource(name, 300))
+    assert evicted == ['a'] and 'b' in registry
+
+
+def test_derived_memory_counts_towards_budget():
+    derived = {'a': 0, 'b': 0}
+    evicted = []
+    registry = DatasourceRegistry(250, on_evict=evicted.append, derived_memory=lambda name: derived[name])
+    registry.load('a', lambda name: make_datasource(name, 100))
+    derived['a'] = 100
+    registry.load('b', lambda name: make_datasource(name, 100))
+    assert evicted == ['a']
+    assert registry.measure(registry.get('b')) == 100
+
+
+def test_concurrent_loads_build_once():
+    registry = DatasourceRegistry(10 ** 6)
+    started = threading.Event()
+    release = threading.Event()
+    builds = []
+
+    def build(name):
+        builds.append(name)
+        started.set()
+        release.wait(5)
+        return make_datasource(name, 10)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(registry.load('a', build))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    started.wait(5)
+    assert registry.is_loading('a') and 'a' not in registry
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert builds == ['a']
+    assert len(results) == 4 and all(result is results[0] for result in results)
+    assert not registry.is_loading('a')
+
+
+def test_waiting_loads_share_the_build_error():
+    registry = DatasourceRegistry(10 ** 6)
+    release = threading.Event()
+    errors = []
+
+    def build(name):
+        release.wait(5)
+        raise ValueError('broken')
+
+    def load():
+        try:
+            registry.load('a', build)
+        except ValueError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=load) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 3 and 'a' not in registry and not registry.is_loading('a')
+
+
+def test_reload_replaces_the_datasource():
+    registry = DatasourceRegistry(10 ** 6)
+    old = registry.load('a', lambda name: make_datasource(name, 10))
+    new = registry.load('a', lambda name: make_datasource(name, 20), reload=True)
+    assert new is not old and registry.get('a') is new
+    assert registry.load('a', lambda name: make_datasource(name, 30)) is new
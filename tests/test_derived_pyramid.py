@@ -0,0 +1,41 @@
+import numpy as np
+import skimage
+import skimage.transform
+
+from cycif_viewer.server.utils import derived_pyramid, pyramid_assemble
+
+
+def halve(image):
+    halved = skimage.transform.downscale_local_mean(skimage.img_as_float32(image), (1, 2, 2))
+    return pyramid_assemble.dtype_convert(halved, image.dtype)
+
+
+def test_count_levels():
+    assert derived_pyramid.count_levels((3, 1000, 800)) == 1
+    assert derived_pyramid.count_levels((3, 1025, 800)) == 2
+    assert derived_pyramid.count_levels((3, 600, 4096), tile_size=512) == 4
+
+
+def test_derived_levels_are_built_on_read_and_persisted(tmp_path):
+    image = np.random.default_rng(0).integers(0, 65535, (2, 2100, 1500), dtype=np.uint16)
+    source_path = tmp_path / 'image.tif'
+    source_path.write_bytes(b'image')
+    path = tmp_path / 'pyramid.zarr'
+    pyramid = derived_pyramid.DerivedPyramid(image, source_path, path, 256, 256)
+    assert len(pyramid) == 3
+    assert pyramid[0] is image
+    level1 = halve(image)
+    level2 = halve(level1)
+    assert pyramid[1].shape == level1.shape and pyramid[2].shape == level2.shape
+    # A tile of level 2 builds the level 1 tiles below it first
+    np.testing.assert_array_equal(pyramid[2][1, 256:512, 0:256], level2[1, 256:512, 0:256])
+    assert pyramid.is_built(1, 1, 2, 1) and not pyramid.is_built(1, 0, 2, 1)
+    np.testing.assert_array_equal(pyramid[1].get_orthogonal_selection(([0, 1], slice(0, 300), slice(500, 750))),
+                                  level1[:, 0:300, 500:750])
+    # Edge tiles are cut at the level's border
+    np.testing.assert_array_equal(pyramid[2][:, 512:, 256:], level2[:, 512:, 256:])
+
+    # Built tiles are found again by a new pyramid over the same source, until the source changes
+    assert derived_pyramid.DerivedPyramid(image, source_path, path, 256, 256).is_built(2, 1, 1, 0)
+    source_path.write_bytes(b'changed image')
+    assert not derived_pyramid.DerivedPyramid(image, source_path, path, 256, 256).is_built(2, 1, 1, 0)
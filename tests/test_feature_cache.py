@@ -0,0 +1,108 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cycif_viewer.server.utils import feature_cache
+
+OPTIONS = {'exclude_columns': ['Skip'], 'float_dtype': 'float32', 'categorical': True}
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    path = tmp_path / 'cells.csv'
+    pd.DataFrame({
+        'CellID': [1, 2, 3, 4],
+        'X_centroid': [0.5, 1.5, 2.5, 3.5],
+        'Area': [10, 300, 20, 40],
+        'M0': [1.0, -np.inf, 3.0, np.nan],
+        'phenotype': ['T', 'B', None, 'T'],
+        'Skip': [0, 0, 0, 0]
+    }).to_csv(path, index=False)
+    return path
+
+
+def read_column(cache_dir, name):
+    manifest = feature_cache.read_manifest(cache_dir)
+    [column] = [column for column in manifest['columns'] if column['name'] == name]
+    return column, feature_cache.load_column(cache_dir, column)
+
+
+def test_build_cache(tmp_path, csv_path):
+    cache_dir = tmp_path / 'feature_cache'
+    [_, written] = feature_cache.build_cache(csv_path, cache_dir, OPTIONS)
+    assert written
+    assert feature_cache.is_valid(cache_dir, csv_path, OPTIONS)
+    assert feature_cache.read_manifest(cache_dir)['rows'] == 4
+    # The cache is written to a temporary directory and moved into place
+    assert not (tmp_path / 'feature_cache.tmp').exists()
+    assert not feature_cache.is_valid(tmp_path / 'missing', csv_path, OPTIONS)
+
+
+def test_cache_is_invalid_after_csv_changes(tmp_path, csv_path):
+    cache_dir = tmp_path / 'feature_cache'
+    feature_cache.build_cache(csv_path, cache_dir, OPTIONS)
+    stat = os.stat(csv_path)
+    os.utime(csv_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert not feature_cache.is_valid(cache_dir, csv_path, OPTIONS)
+
+
+def test_decode_numeric_columns(tmp_path, csv_path):
+    cache_dir = tmp_path / 'feature_cache'
+    feature_cache.build_cache(csv_path, cache_dir, OPTIONS)
+    [column, values] = read_column(cache_dir, 'M0')
+    assert 'categories' not in column
+    # -inf is replaced by 0, missing values stay NaN
+    np.testing.assert_array_equal(values, np.array([1, 0, 3, np.nan], dtype=np.float32))
+    assert not values.flags.writeable
+    [_, values] = read_column(cache_dir, 'Area')
+    np.testing.assert_array_equal(values, [10, 300, 20, 40])
+
+
+def test_decode_string_columns(tmp_path, csv_path):
+    cache_dir = tmp_path / 'feature_cache'
+    feature_cache.build_cache(csv_path, cache_dir, OPTIONS)
+    [column, values] = read_column(cache_dir, 'phenotype')
+    assert sorted(column['categories']) == ['B', 'T']
+    decoded = pd.Series(values)
+    assert decoded.tolist()[:2] == ['T', 'B'] and decoded.tolist()[3] == 'T'
+    assert pd.isna(decoded[2])
+    # Rows are read without decoding the whole column
+    rows = pd.Series(feature_cache.load_column_rows(cache_dir, column, np.array([3, 2, 0])))
+    assert rows[0] == 'T' and pd.isna(rows[1]) and rows[2] == 'T'
+
+
+def test_build_cache_compacts_columns(tmp_path, csv_path):
+    cache_dir = tmp_path / 'feature_cache'
+    [df, _] = feature_cache.build_cache(csv_path, cache_dir, OPTIONS)
+    # Excluded columns are not parsed, integers are downcast and floats stored in float_dtype
+    assert [column['name'] for column in feature_cache.read_manifest(cache_dir)['columns']] == \
+           ['CellID', 'X_centroid', 'Area', 'M0', 'phenotype']
+    assert df['Area'].dtype == np.int16 and df['CellID'].dtype == np.int8
+    assert df['X_centroid'].dtype == np.float32
+    assert not feature_cache.is_valid(cache_dir, csv_path, dict(OPTIONS, float_dtype='float64'))
+    [df, _] = feature_cache.build_cache(csv_path, cache_dir, dict(OPTIONS, float_dtype='float64'))
+    assert df['X_centroid'].dtype == np.float64
+
+
+@pytest.mark.parametrize('categorical', [True, False])
+def test_decode_string_columns_with_and_without_categoricals(tmp_path, csv_path, categorical):
+    cache_dir = tmp_path / 'feature_cache'
+    feature_cache.build_cache(csv_path, cache_dir, dict(OPTIONS, categorical=categorical))
+    [column, values] = read_column(cache_dir, 'phenotype')
+    assert column.get('categorical', False) == categorical
+    assert isinstance(values, pd.Categorical) == categorical
+    decoded = pd.Series(values)
+    assert decoded[0] == 'T' and decoded[1] == 'B' and pd.isna(decoded[2])
+
+
+def test_decode_column():
+    codes = np.array([1, -1, 0], dtype=np.int8)
+    categorical = feature_cache.decode_column({'categorical': True, 'categories': ['a', 'b']}, codes)
+    assert isinstance(categorical, pd.Categorical)
+    assert list(categorical.categories) == ['a', 'b']
+    assert categorical[0] == 'b' and pd.isna(categorical[1]) and categorical[2] == 'a'
+    strings = feature_cache.decode_column({'categories': ['a', 'b']}, codes)
+    assert strings[0] == 'b' and pd.isna(strings[1]) and strings[2] == 'a'
+    assert feature_cache.decode_column({}, codes) is codes
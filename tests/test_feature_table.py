@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cycif_viewer.server.utils import feature_table
+
+
+@pytest.fixture
+def csv_path(tmp_path):
+    rng = np.random.default_rng(0)
+    path = tmp_path / 'cells.csv'
+    df = pd.DataFrame({'X_centroid': rng.random(1000), 'phenotype': rng.choice(['T', 'B'], 1000)})
+    for i in range(3):
+        df['M' + str(i)] = rng.random(1000)
+    df.to_csv(path, index=False)
+    return path
+
+
+def test_columns_are_loaded_when_first_used(tmp_path, csv_path):
+    table = feature_table.read_features(csv_path, tmp_path / 'feature_cache', pinned_columns=['X_centroid'])
+    assert table.columns == ['X_centroid', 'phenotype', 'M0', 'M1', 'M2'] and len(table) == 1000
+    assert table.stats()['loaded'] == ['X_centroid'] and table.loads == 1
+    expected = pd.read_csv(csv_path)
+    np.testing.assert_allclose(table.column('M1'), expected['M1'], rtol=1e-6)
+    assert table.stats()['loaded'] == ['M1', 'X_centroid'] and table.loads == 2
+    table.column('M1')
+    assert table.loads == 2
+    # Rows of columns that are not loaded are read without loading them
+    rows = table.rows([5, 2], ['M2', 'phenotype'])
+    assert rows.index.tolist() == [5, 2]
+    np.testing.assert_allclose(rows['M2'], expected['M2'][[5, 2]], rtol=1e-6)
+    assert rows['phenotype'].tolist() == expected['phenotype'][[5, 2]].tolist()
+    assert table.stats()['loaded'] == ['M1', 'X_centroid']
+    with pytest.raises(KeyError):
+        table.column('missing')
+
+
+def test_least_recently_used_columns_are_evicted(tmp_path, csv_path):
+    # Room for two float32 columns besides the pinned ones
+    table = feature_table.read_features(csv_path, tmp_path / 'feature_cache', pinned_columns=['X_centroid'],
+                                        max_bytes=9000)
+    table.column('M0')
+    table.column('M1')
+    table.column('M0')
+    table.column('M2')
+    assert table.stats()['loaded'] == ['M0', 'M2', 'X_centroid'] and table.evictions == 1
+    # Pinned columns are never evicted, and a frame loads what it needs
+    frame = table.frame(['M1', 'X_centroid'])
+    assert list(frame.columns) == ['M1', 'X_centroid']
+    assert 'X_centroid' in table.stats()['loaded'] and table.evictions == 2
+
+
+def test_is_numeric_without_loading(tmp_path, csv_path):
+    table = feature_table.read_features(csv_path, tmp_path / 'feature_cache', pinned_columns=['X_centroid'])
+    # Strings are cached with their categories, so their type is known from the manifest
+    assert table.is_numeric('M0') and not table.is_numeric('phenotype')
+    assert table.stats()['loaded'] == ['X_centroid']
+    table.column('phenotype')
+    assert not table.is_numeric('phenotype') and table.is_numeric('X_centroid')
+    with pytest.raises(KeyError):
+        table.is_numeric('missing')
@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+
+from cycif_viewer.server.utils.label_colors import apply_label_lut, build_label_lut
+
+SCHEME = {'Tumor': {'rgb': (255, 0, 0)}, 'Stroma': {'rgb': (0, 128, 255)}}
+
+
+def test_build_label_lut():
+    lut = build_label_lut(pd.Series(['Tumor', 'Stroma', 'Other', None, 'Tumor']), SCHEME)
+    assert lut.dtype == np.uint8 and lut.shape == (6, 4)
+    # Background, values without a color and missing values are transparent
+    np.testing.assert_array_equal(lut, [[0, 0, 0, 0], [255, 0, 0, 255], [0, 128, 255, 255], [0, 0, 0, 0],
+                                        [0, 0, 0, 0], [255, 0, 0, 255]])
+
+
+def test_apply_label_lut():
+    lut = build_label_lut(pd.Series(['Stroma', 'Tumor']), SCHEME)
+    labels = np.array([[0, 1], [2, 7]], dtype=np.uint32)
+    rgba = apply_label_lut(labels, lut)
+    assert rgba.shape == (2, 2, 4)
+    # Labels beyond the table are drawn as background
+    np.testing.assert_array_equal(rgba, [[[0, 0, 0, 0], [0, 128, 255, 255]], [[255, 0, 0, 255], [0, 0, 0, 0]]])
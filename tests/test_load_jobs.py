@@ -0,0 +1,131 @@
+import threading
+import time
+
+import pytest
+
+from cycif_viewer.server.models import data_model
+from cycif_viewer.server.utils import load_jobs
+
+
+class BlockingLoad:
+    # Records its calls and blocks them until released
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+
+    def __call__(self, datasource_name, reload, params):
+        self.calls.append((datasource_name, reload, params))
+        assert self.release.wait(10)
+        if datasource_name == 'broken':
+            raise ValueError('Unknown marker')
+
+
+def wait(job):
+    deadline = time.time() + 10
+    while job.is_active() and time.time() < deadline:
+        time.sleep(0.01)
+    return job
+
+
+@pytest.fixture
+def load():
+    load = BlockingLoad()
+    yield load
+    load.release.set()
+
+
+def test_start_is_once_only(load):
+    jobs = load_jobs.LoadJobs(load, 2)
+    job = jobs.start('a', params={'k': 5})
+    assert jobs.start('a', params={'k': 5}) is job
+    assert jobs.start('a', params={'k': 6}) is not job
+    assert jobs.start('b', params={'k': 5}) is not job
+    load.release.set()
+    assert wait(job).state == 'ready'
+    assert load.calls.count(('a', False, {'k': 5})) == 1
+    assert jobs.get(job.id) is job
+    assert jobs.latest('a', {'k': 5}) is job
+    # A finished job is not reused
+    again = jobs.start('a', params={'k': 5})
+    assert again is not job
+    assert wait(again).state == 'ready'
+
+
+def test_reload(load):
+    jobs = load_jobs.LoadJobs(load, 1)
+    job = jobs.start('a')
+    reload = jobs.start('a', reload=True)
+    assert reload is not job
+    # A queued or running reload also serves plain loads
+    assert jobs.start('a') is reload
+    assert jobs.start('a', reload=True) is reload
+    load.release.set()
+    assert wait(reload).state == 'ready'
+    assert load.calls == [('a', False, None), ('a', True, None)]
+
+
+def test_failed_job(load):
+    jobs = load_jobs.LoadJobs(load, 1)
+    job = jobs.start('broken')
+    load.release.set()
+    assert wait(job).state == 'failed'
+    assert job.error == 'ValueError: Unknown marker'
+    assert job.to_dict()['error'] == job.error and job.finished is not None
+
+
+def test_finished_jobs_are_forgotten(load, monkeypatch):
+    monkeypatch.setattr(load_jobs, 'MAX_FINISHED_JOBS', 2)
+    load.release.set()
+    jobs = load_jobs.LoadJobs(load, 1)
+    finished = [wait(jobs.start(str(i))) for i in range(4)]
+    jobs.start('last')
+    assert [jobs.get(job.id) for job in finished] == [None, None, finished[2], finished[3]]
+
+
+def poll(client, job_id):
+    deadline = time.time() + 10
+    while True:
+        status = client.get('/get_load_status?job=' + job_id).get_json()
+        if status['job']['state'] not in ['queued', 'running'] or time.time() > deadline:
+            return status
+        time.sleep(0.01)
+
+
+def test_load_status_route(client, monkeypatch):
+    release = threading.Event()
+    open_channel_pyramid = data_model.open_channel_pyramid
+
+    def blocking_open(datasource_name):
+        assert release.wait(10)
+        return open_channel_pyramid(datasource_name)
+
+    monkeypatch.setattr(data_model, 'open_channel_pyramid', blocking_open)
+    job = client.get('/init_database?datasource=test&async=true&reload=true').get_json()['job']
+    deadline = time.time() + 10
+    while data_model.load_progress.get('test') != ('metadata', 85) and time.time() < deadline:
+        time.sleep(0.01)
+    status = client.get('/get_load_status?datasource=test').get_json()
+    assert [status['stage'], status['percent'], status['job']['id']] == ['metadata', 85, job['id']]
+    release.set()
+    status = poll(client, job['id'])
+    assert [status['ready'], status['stage'], status['percent']] == [True, 'ready', 100]
+    # The stage of a finished load is not kept
+    assert 'test' not in data_model.load_progress
+
+
+def test_load_status_route_after_failed_load(client, monkeypatch):
+    def broken_open(datasource_name):
+        raise ValueError('Unreadable image')
+
+    monkeypatch.setattr(data_model, 'open_channel_pyramid', broken_open)
+    job = client.get('/init_database?datasource=test&async=true&reload=true').get_json()['job']
+    status = poll(client, job['id'])
+    assert status['job']['state'] == 'failed' and status['job']['error'] == 'ValueError: Unreadable image'
+    assert 'test' not in data_model.load_progress
+
+
+def test_load_status_route_errors(client):
+    assert client.get('/init_database?datasource=missing&async=true').status_code == 422
+    assert client.get('/get_load_status?job=missing').status_code == 404
+    status = client.get('/get_load_status?datasource=missing').get_json()
+    assert [status['ready'], status['stage'], status['job']] == [False, 'not loaded', None]
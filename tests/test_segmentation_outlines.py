@@ -0,0 +1,28 @@
+import numpy as np
+
+from cycif_viewer.server.utils.segmentation_outlines import halo_window, outline_mask
+
+
+def test_halo_window():
+    # Inner tiles read one extra pixel on each side, edge tiles are padded where the halo leaves the image
+    assert halo_window(128, 128, 512) == (127, 257, (0, 0))
+    assert halo_window(0, 128, 512) == (0, 129, (1, 0))
+    assert halo_window(384, 128, 512) == (383, 512, (0, 1))
+    # A partial last tile ends at the image border
+    assert halo_window(256, 128, 300) == (255, 300, (0, 1))
+
+
+def test_outline_mask():
+    labels = np.zeros((6, 7), dtype=np.uint32)
+    labels[1:5, 1:4] = 3
+    labels[1:5, 4:6] = 5
+    mask = outline_mask(labels, bits=1)
+    assert mask.dtype == bool and mask.shape == (4, 5)
+    expected = np.array([[1, 1, 1, 1, 1],
+                         [1, 0, 1, 1, 1],
+                         [1, 0, 1, 1, 1],
+                         [1, 1, 1, 1, 1]], dtype=bool)
+    np.testing.assert_array_equal(mask, expected)
+    np.testing.assert_array_equal(outline_mask(labels), expected.astype(np.uint8) * 255)
+    # Background is never a boundary, even next to a cell
+    assert not outline_mask(np.pad(labels, 1))[0].any()
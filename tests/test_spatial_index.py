@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+
+from cycif_viewer.server.utils import spatial_index
+
+
+@pytest.fixture(scope='module')
+def points():
+    rng = np.random.default_rng(0)
+    # Clustered points with exact duplicates, so that grid cells are uneven and distances tie
+    x = np.concatenate([rng.uniform(0, 1000, 3000), rng.normal(200, 10, 1000), np.full(20, 500.0)])
+    y = np.concatenate([rng.uniform(0, 500, 3000), rng.normal(300, 10, 1000), np.full(20, 250.0)])
+    return x, y
+
+
+@pytest.fixture(scope='module')
+def index(points):
+    return spatial_index.build_index(*points)
+
+
+def check_nearest(x, y, qx, qy, k, distances, ids):
+    # Points tied with the k-th closest may be returned in any order, so ids are checked by their distances
+    expected = np.sort(np.hypot(x - qx, y - qy))[:k]
+    np.testing.assert_allclose(distances, expected)
+    np.testing.assert_allclose(np.hypot(x[ids] - qx, y[ids] - qy), distances)
+    assert len(np.unique(ids)) == len(ids)
+
+
+@pytest.mark.parametrize('r', [0, 5, 37.5, 600])
+def test_radius(points, index, r):
+    [x, y] = points
+    for [qx, qy] in [(200, 300), (500, 250), (-100, 900), (999, 1)]:
+        distances = np.hypot(x - qx, y - qy)
+        expected = np.flatnonzero(distances <= r)
+        [ids, found] = index.radius(qx, qy, r, return_distance=True)
+        np.testing.assert_array_equal(ids, expected)
+        np.testing.assert_allclose(found, distances[expected])
+        assert index.count_radius(qx, qy, r) == len(expected)
+
+
+@pytest.mark.parametrize('k', [1, 7, 40])
+def test_nearest(points, index, k):
+    [x, y] = points
+    for [qx, qy] in [(200, 300), (500, 250), (-300, -300), (1000, 500), (750, 20)]:
+        check_nearest(x, y, qx, qy, k, *index.nearest(qx, qy, k))
+
+
+def test_nearest_more_than_all_points():
+    index = spatial_index.build_index(np.array([0.0, 1.0, 3.0]), np.array([0.0, 0.0, 0.0]))
+    [distances, ids] = index.nearest(0.5, 0.0, 10)
+    np.testing.assert_allclose(distances, [0.5, 0.5, 2.5])
+    np.testing.assert_array_equal(np.sort(ids), [0, 1, 2])
+
+
+def test_empty_index():
+    index = spatial_index.build_index(np.zeros(0), np.zeros(0))
+    assert len(index) == 0
+    assert len(index.radius(0, 0, 10)) == 0
+    assert len(index.nearest(0, 0, 3)[1]) == 0
+
+
+def test_save_and_load(tmp_path, points, index):
+    spatial_index.save_index(index, tmp_path / 'index', {'source': 1})
+    loaded = spatial_index.load_index(tmp_path / 'index', {'source': 1})
+    for name in spatial_index.ARRAYS:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(index, name))
+    assert loaded.header == index.header
+    assert spatial_index.load_index(tmp_path / 'index', {'source': 2}) is None
+    assert spatial_index.load_index(tmp_path / 'missing', {'source': 1}) is None
+
+
+
+def test_open_index_builds_once(tmp_path, points):
+    [x, y] = points
+    built = spatial_index.open_index(tmp_path / 'index', x, y, {'source': 1})
+    # The saved index is opened memory mapped instead of being built again
+    loaded = spatial_index.open_index(tmp_path / 'index', x[:10], y[:10], {'source': 1})
+    assert len(loaded) == len(built) == len(x)
+    assert len(spatial_index.open_index(tmp_path / 'index', x[:10], y[:10], {'source': 1}, reload=True)) == 10
+
+
+def test_radius_batch(points, index):
+    [x, y] = points
+    rng = np.random.default_rng(1)
+    [qx, qy, r] = [rng.uniform(-50, 1050, 200), rng.uniform(-50, 550, 200), rng.uniform(0, 60, 200)]
+    [offsets, ids, distances] = index.radius_batch(qx, qy, r)
+    for i in range(len(qx)):
+        expected = np.flatnonzero(np.hypot(x - qx[i], y - qy[i]) <= r[i])
+        np.testing.assert_array_equal(ids[offsets[i]:offsets[i + 1]], expected)
+        np.testing.assert_allclose(distances[offsets[i]:offsets[i + 1]], np.hypot(x - qx[i], y - qy[i])[expected])
+
+
+@pytest.mark.parametrize('k', [1, 7, 40])
+def test_nearest_batch(points, index, k):
+    [x, y] = points
+    rng = np.random.default_rng(2)
+    queries = np.concatenate([np.stack([rng.uniform(-200, 1200, 100), rng.uniform(-200, 700, 100)], axis=1),
+                              [[500, 250], [200, 300]]])
+    [distances, ids] = index.nearest_batch(queries[:, 0], queries[:, 1], k)
+    assert distances.shape == ids.shape == (len(queries), k)
+    for i, [qx, qy] in enumerate(queries):
+        check_nearest(x, y, qx, qy, k, distances[i], ids[i])
+
+
+def test_nearest_batch_more_than_all_points():
+    index = spatial_index.build_index(np.array([0.0, 1.0, 3.0]), np.array([0.0, 0.0, 0.0]))
+    [distances, ids] = index.nearest_batch([0.5], [0.0], 10)
+    np.testing.assert_allclose(distances, [[0.5, 0.5, 2.5]])
+    np.testing.assert_array_equal(ids, [[0, 1, 2]])
+
+
+def test_rect(points, index):
+    [x, y] = points
+    for [x0, y0, x1, y1] in [(100, 50, 400, 350), (-50, -50, 2000, 2000), (500, 250, 500, 250), (10, 10, 5, 5)]:
+        expected = np.flatnonzero((x >= x0) & (x <= x1) & (y >= y0) & (y <= y1))
+        np.testing.assert_array_equal(index.rect(x0, y0, x1, y1), expected)
+
+
+def test_polygon(points, index):
+    [x, y] = points
+    triangle = [[0, 0], [800, 100], [300, 450]]
+    expected = np.flatnonzero(spatial_index.points_in_polygon(x, y, triangle))
+    np.testing.assert_array_equal(index.polygon(triangle), expected)
+    assert len(index.polygon([[0, 0], [10, 10]])) == 0
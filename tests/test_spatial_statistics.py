@@ -0,0 +1,145 @@
+import json
+
+import numpy as np
+import pytest
+
+from cycif_viewer.server.utils import spatial_index, spatial_statistics
+
+PARAMS = {'phenotype_a': 'a', 'phenotype_b': 'b', 'radii': (10.0, 25.0, 50.0, 100.0), 'permutations': 19}
+
+
+@pytest.fixture(scope='module')
+def cells(tmp_path_factory):
+    # Uniformly scattered cells of three phenotypes, with their index saved as data_model saves it
+    rng = np.random.default_rng(0)
+    n = 3000
+    [x, y] = [rng.uniform(0, 1000, n), rng.uniform(0, 800, n)]
+    codes = rng.integers(0, 3, n).astype(np.int8)
+    path = tmp_path_factory.mktemp('index') / 'spatial_index'
+    index = spatial_index.open_index(path, x, y, {'cells': n})
+    return index, path, x, y, codes
+
+
+def compute(cells, tmp_path, code_a, code_b, params=PARAMS, name='stats', num_workers=1):
+    [index, path, _, _, codes] = cells
+    spatial_statistics.compute_statistics(index, path, codes, code_a, code_b, params, tmp_path / name, {'cells': 1},
+                                          num_workers=num_workers)
+    return spatial_statistics.load_statistics(tmp_path / name, {'cells': 1})
+
+
+def brute_force(x, y, codes, code_a, code_b, radii):
+    # Edge corrected K and the reduced sample G of every pair of cells at once
+    bounds = [x.min(), y.min(), x.max(), y.max()]
+    area = (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+    [a, b] = [np.flatnonzero(codes == code_a), np.flatnonzero(codes == code_b)]
+    distances = np.hypot(x[a][:, None] - x[b], y[a][:, None] - y[b])
+    distinct = a[:, None] != b
+    edges = spatial_statistics.edge_distances(x[a], y[a], bounds)
+    weights = spatial_statistics.isotropic_weights(np.repeat(edges, len(b), axis=0), distances.ravel())
+    weights = weights.reshape(distances.shape)
+    k = [area * np.sum(weights * (distinct & (distances <= r))) / np.count_nonzero(distinct) for r in radii]
+    nearest = np.where(distinct, distances, np.inf).min(axis=1)
+    inside = edges.min(axis=1)
+    g = [np.count_nonzero((inside >= r) & (nearest <= r)) / np.count_nonzero(inside >= r) for r in radii]
+    return np.array(k), np.array(g), nearest
+
+
+def test_isotropic_weights():
+    far = [1000.0, 1000.0]
+    edges = np.array([far * 2, [0.0, 1000.0, 1000.0, 1000.0], [0.0, 0.0, 1000.0, 1000.0], [5.0, 1000.0, 1000.0, 1000.0],
+                      far * 2])
+    weights = spatial_statistics.isotropic_weights(edges, np.array([10.0, 10.0, 10.0, 10.0, 0.0]))
+    # Inside, half the circle beyond a side, three quarters beyond a corner, a third beyond a side at half the radius
+    np.testing.assert_allclose(weights, [1, 2, 4, 1.5, 1])
+
+
+def test_parse_params():
+    params = spatial_statistics.parse_params('a', 'b', ['5', 10], '9')
+    assert params == {'phenotype_a': 'a', 'phenotype_b': 'b', 'radii': (5.0, 10.0), 'permutations': 9}
+    for radii in [[], [0, 1], [2, 1], [1, float('inf')]]:
+        with pytest.raises(ValueError):
+            spatial_statistics.parse_params('a', 'b', radii)
+    with pytest.raises(ValueError):
+        spatial_statistics.parse_params('a', 'b', [1], spatial_statistics.MAX_PERMUTATIONS + 1)
+
+
+@pytest.mark.parametrize('code_a, code_b', [(0, 1), (2, 2)])
+def test_observed_against_brute_force(cells, tmp_path, code_a, code_b):
+    [_, _, x, y, codes] = cells
+    result = compute(cells, tmp_path, code_a, code_b)
+    [k, g, nearest] = brute_force(x, y, codes, code_a, code_b, PARAMS['radii'])
+    np.testing.assert_allclose(result['K']['observed'], k, rtol=1e-9)
+    np.testing.assert_allclose(result['G']['observed'], g)
+    assert result['nearest']['mean'] == pytest.approx(nearest.mean())
+    assert result['cells'] == [np.count_nonzero(codes == code_a), np.count_nonzero(codes == code_b)]
+
+
+def test_random_labelling_null(cells, tmp_path):
+    # For scattered cells, K of the observed and of the permuted labels is close to pi r^2
+    result = compute(cells, tmp_path, 0, 1)
+    theoretical = np.pi * np.array(PARAMS['radii']) ** 2
+    np.testing.assert_allclose(result['K']['theoretical'], theoretical)
+    np.testing.assert_allclose(result['K']['null_mean'][1:], theoretical[1:], rtol=0.1)
+    np.testing.assert_allclose(result['K']['observed'][1:], theoretical[1:], rtol=0.2)
+    assert all(low <= high for low, high in zip(result['K']['null_low'], result['K']['null_high']))
+    assert all(0 < p <= 1 for p in result['p_value'])
+
+
+def test_without_permutations(cells, tmp_path):
+    result = compute(cells, tmp_path, 0, 1, dict(PARAMS, permutations=0))
+    assert result['p_value'] is None
+    assert 'null_mean' not in result['K']
+
+
+def test_permute_is_a_permutation():
+    for num_cells in [1, 2, 5, 1000, 2 ** 16 + 3]:
+        keys = spatial_statistics.permutation_keys(0, 7)
+        positions = spatial_statistics.permute(np.arange(num_cells), num_cells, keys)
+        np.testing.assert_array_equal(np.sort(positions), np.arange(num_cells))
+        cells = np.array([num_cells - 1, 0, num_cells // 2])
+        np.testing.assert_array_equal(spatial_statistics.permute(cells, num_cells, keys), positions[cells])
+    other = spatial_statistics.permute(np.arange(1000), 1000, spatial_statistics.permutation_keys(0, 8))
+    assert not np.array_equal(other, positions[:1000])
+
+
+@pytest.mark.parametrize('feistel_cells', [spatial_statistics.FEISTEL_CELLS, 10])
+def test_random_labels(monkeypatch, feistel_cells):
+    monkeypatch.setattr(spatial_statistics, 'FEISTEL_CELLS', feistel_cells)
+    observed = np.repeat(np.array([1, 2, 3], dtype=np.int8), [300, 200, 100])
+    labels = spatial_statistics.random_labels(observed, np.arange(len(observed)), range(5), seed=3)
+    np.testing.assert_array_equal(labels[:, 0], observed)
+    for i in range(1, 5):
+        np.testing.assert_array_equal(np.bincount(labels[:, i]), np.bincount(observed))
+    assert not np.array_equal(labels[:, 1], observed)
+    # Any cells get the labels they have among all cells
+    cells = np.array([599, 3, 250, 42])
+    np.testing.assert_array_equal(spatial_statistics.random_labels(observed, cells, range(5), seed=3), labels[cells])
+
+
+@pytest.mark.parametrize('feistel_cells', [spatial_statistics.FEISTEL_CELLS, 10])
+def test_chunks_agree(cells, tmp_path, monkeypatch, feistel_cells):
+    # Chunks draw the labels of the cells they share alike, so the result does not depend on the chunking
+    monkeypatch.setattr(spatial_statistics, 'FEISTEL_CELLS', feistel_cells)
+    whole = compute(cells, tmp_path, 0, 1, name='whole')
+    monkeypatch.setattr(spatial_statistics, 'CHUNK_PAIRS', 2000)
+    monkeypatch.setattr(spatial_statistics, 'LABELLING_VALUES', 5000)
+    chunked = compute(cells, tmp_path, 0, 1, name='chunked')
+    for statistic in ['K', 'L', 'g', 'G']:
+        for key in whole[statistic]:
+            # Undefined values are saved as None
+            np.testing.assert_allclose(np.array(chunked[statistic][key], dtype=np.float64),
+                                       np.array(whole[statistic][key], dtype=np.float64))
+    assert chunked['p_value'] == whole['p_value']
+
+
+def test_worker_processes(cells, tmp_path, monkeypatch):
+    monkeypatch.setattr(spatial_statistics, 'CHUNK_PAIRS', 20000)
+    single = compute(cells, tmp_path, 0, 1, name='single')
+    pooled = compute(cells, tmp_path, 0, 1, name='pooled', num_workers=2)
+    assert json.dumps(pooled) == json.dumps(single)
+
+
+def test_load_statistics(cells, tmp_path):
+    compute(cells, tmp_path, 0, 1)
+    assert spatial_statistics.load_statistics(tmp_path / 'stats', {'cells': 2}) is None
+    assert spatial_statistics.load_statistics(tmp_path / 'missing', {'cells': 1}) is None
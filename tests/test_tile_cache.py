@@ -0,0 +1,82 @@
+import threading
+
+import numpy as np
+
+from cycif_viewer.server.utils.tile_cache import TileCache
+
+
+def test_get_and_put():
+    cache = TileCache(100)
+    assert cache.get(('a', 'c0', 0, 0, 0, 'png')) is None
+    cache.put(('a', 'c0', 0, 0, 0, 'png'), b'tile')
+    assert cache.get(('a', 'c0', 0, 0, 0, 'png')) == b'tile'
+    assert ('a', 'c0', 0, 0, 0, 'png') in cache
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+    assert cache.stats()['hit_rate'] == 0.5
+
+
+def test_evicts_least_recently_used_beyond_byte_budget():
+    cache = TileCache(30)
+    for name in 'abc':
+        cache.put((name,), b'x' * 10)
+    # Reading a makes b the least recently used
+    cache.get(('a',))
+    cache.put(('d',), b'x' * 10)
+    assert ('b',) not in cache
+    assert all(key in cache for key in [('a',), ('c',), ('d',)])
+    assert cache.stats()['bytes'] == 30
+    assert cache.stats()['evictions'] == 1
+    # One large tile evicts several small ones
+    cache.put(('e',), b'x' * 25)
+    assert [key in cache for key in [('a',), ('c',), ('d',), ('e',)]] == [False, False, False, True]
+    assert cache.stats()['bytes'] == 25
+
+
+def test_arrays_count_with_their_bytes():
+    cache = TileCache(1000)
+    cache.put(('a',), np.zeros((10, 10), dtype=np.uint16))
+    assert cache.stats()['bytes'] == 200
+
+
+def test_tiles_larger_than_the_budget_are_not_cached():
+    cache = TileCache(10)
+    cache.put(('a',), b'x' * 5)
+    cache.put(('b',), b'x' * 11)
+    assert ('b',) not in cache and ('a',) in cache
+
+
+def test_replacing_an_entry_updates_bytes():
+    cache = TileCache(100)
+    cache.put(('a',), b'x' * 10)
+    cache.put(('a',), b'x' * 40)
+    assert cache.get(('a',)) == b'x' * 40
+    assert cache.stats()['bytes'] == 40 and cache.stats()['entries'] == 1
+
+
+def test_invalidate():
+    cache = TileCache(100)
+    for key in [('a', 0), ('a', 1), ('b', 0)]:
+        cache.put(key, b'x' * 10)
+    cache.invalidate('a')
+    assert [key in cache for key in [('a', 0), ('a', 1), ('b', 0)]] == [False, False, True]
+    assert cache.stats()['bytes'] == 10
+    cache.invalidate()
+    assert cache.stats()['entries'] == 0 and cache.stats()['bytes'] == 0
+
+
+def test_concurrent_puts_stay_within_budget():
+    cache = TileCache(1000)
+
+    def put(thread):
+        for i in range(500):
+            cache.put((thread, i), b'x' * 7)
+            cache.get((thread, i - 3))
+
+    threads = [threading.Thread(target=put, args=(thread,)) for thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stats = cache.stats()
+    assert stats['bytes'] <= 1000
+    assert stats['bytes'] == 7 * stats['entries']
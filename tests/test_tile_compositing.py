@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+from cycif_viewer.server.utils.tile_compositing import composite, make_composite
+
+
+def test_make_composite():
+    settings = make_composite([0, 2], ['#ff0000', '00ff00'], [100, 0], [1100, 65535], [1, 0.5])
+    assert settings.channels == (0, 2)
+    assert settings.colors == ((255, 0, 0), (0, 255, 0))
+    assert settings.windows == ((100.0, 1100.0), (0.0, 65535.0))
+    assert settings.gammas == (1.0, 0.5)
+    assert make_composite([1], ['0000ff']).windows == ((0.0, 65535.0),)
+    for args in [([], []), ([0, 1], ['ff0000']), ([0], ['ff0000'], [0, 1]), ([0], ['nothex'])]:
+        with pytest.raises(ValueError):
+            make_composite(*args)
+
+
+def test_composite_windows_and_blends_channels():
+    settings = make_composite([0, 1], ['ff0000', '0080ff'], [100, 0], [1100, 1000], [1, 2])
+    slab = np.array([[[0, 600, 5000]], [[0, 500, 1000]]], dtype=np.uint16)
+    rgb = composite(slab, settings)
+    assert rgb.dtype == np.uint8 and rgb.shape == (1, 3, 3)
+    # Below the window is black, the middle of a window is half bright (a quarter with gamma 2)
+    np.testing.assert_array_equal(rgb[0, 0], [0, 0, 0])
+    np.testing.assert_array_equal(rgb[0, 1], [128, round(0.25 * 128), 64])
+    # Additive blending saturates instead of wrapping around
+    np.testing.assert_array_equal(rgb[0, 2], [255, 128, 255])
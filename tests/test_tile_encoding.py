@@ -0,0 +1,69 @@
+import io
+import zlib
+
+import numpy as np
+import pytest
+from PIL import Image
+from werkzeug.datastructures import MIMEAccept
+
+from cycif_viewer.server.utils import tile_encoding
+
+
+def decode_binary(data):
+    [magic, version, compression, itemsize, _, channels, height, width] = tile_encoding.HEADER.unpack_from(data)
+    assert magic == tile_encoding.MAGIC
+    assert version == tile_encoding.VERSION
+    payload = data[tile_encoding.HEADER.size:]
+    if compression == tile_encoding.COMPRESSION['deflate']:
+        payload = zlib.decompress(payload)
+    elif compression == tile_encoding.COMPRESSION['zstd']:
+        payload = tile_encoding.zstd_codec.decode(payload)
+    dtype = {1: '<u1', 2: '<u2', 4: '<u4'}[itemsize]
+    return np.frombuffer(payload, dtype=dtype).reshape(channels, height, width)
+
+
+@pytest.mark.parametrize('compression', ['raw', 'deflate', 'zstd'])
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.uint32])
+def test_binary_round_trip(compression, dtype):
+    tile = np.random.default_rng(0).integers(0, np.iinfo(dtype).max, (3, 5, 7), dtype=dtype)
+    decoded = decode_binary(tile_encoding.encode_binary(tile, compression))
+    np.testing.assert_array_equal(decoded, tile)
+
+
+def test_binary_single_channel():
+    tile = np.arange(12, dtype=np.uint16).reshape(3, 4)
+    decoded = decode_binary(tile_encoding.encode_binary(tile))
+    assert decoded.shape == (1, 3, 4)
+    np.testing.assert_array_equal(decoded[0], tile)
+
+
+def test_binary_pixels_are_little_endian():
+    for tile in [np.array([[0x0102]], dtype='<u2'), np.array([[0x0102]], dtype='>u2')]:
+        data = tile_encoding.encode_binary(tile)
+        assert data[tile_encoding.HEADER.size:] == b'\x02\x01'
+
+
+def test_webp_splits_uint16_into_high_and_low_bytes():
+    tile = np.array([[0x0102, 0xFFFE], [0, 0x8000]], dtype=np.uint16)
+    image = np.asarray(Image.open(io.BytesIO(tile_encoding.encode_tile(tile, 'webp'))).convert('RGB'))
+    np.testing.assert_array_equal(image[..., 0].astype(np.uint16) << 8 | image[..., 1], tile)
+
+
+def test_png_labels_in_rgba_bytes():
+    tile = np.array([[0x010203, 0], [0xFFFFFF, 7]], dtype=np.uint32)
+    image = np.asarray(Image.open(io.BytesIO(tile_encoding.encode_tile(tile, 'png'))))
+    labels = image[..., 0].astype(np.uint32) | image[..., 1].astype(np.uint32) << 8 | image[..., 2].astype(np.uint32) << 16
+    np.testing.assert_array_equal(labels, tile)
+
+
+def test_png_uint16_round_trip():
+    tile = np.random.default_rng(1).integers(0, 2 ** 16, (6, 9), dtype=np.uint16)
+    image = np.asarray(Image.open(io.BytesIO(tile_encoding.encode_tile(tile, 'png'))))
+    np.testing.assert_array_equal(image, tile)
+
+
+def test_negotiate_encoding():
+    assert tile_encoding.negotiate_encoding('webp', MIMEAccept()) == 'webp'
+    assert tile_encoding.negotiate_encoding('gif', MIMEAccept()) is None
+    assert tile_encoding.negotiate_encoding(None, MIMEAccept([('image/webp', 1), ('*/*', 0.8)])) == 'png'
+    assert tile_encoding.negotiate_encoding(None, MIMEAccept([(tile_encoding.MIMETYPES['zstd'], 1)])) == 'zstd'
@@ -0,0 +1,77 @@
+import threading
+import time
+
+from cycif_viewer.server.models import data_model
+from cycif_viewer.server.utils.tile_cache import TileCache
+from cycif_viewer.server.utils.tile_prefetch import TilePrefetcher
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_renders_scheduled_tiles_with_their_generation():
+    rendered = []
+    prefetcher = TilePrefetcher(lambda key, generation: rendered.append((key, generation)) or True, 2)
+    prefetcher.schedule([('a', 0), ('a', 1)], 3)
+    wait_until(lambda: prefetcher.stats()['completed'] == 2)
+    assert sorted(rendered) == [(('a', 0), 3), (('a', 1), 3)]
+    prefetcher.record_hit(('a', 0))
+    prefetcher.record_hit(('b', 0))
+    assert prefetcher.stats()['hits'] == 1
+
+
+def test_full_queue_drops_oldest_and_cancel_drops_a_datasource():
+    release = threading.Event()
+    prefetcher = TilePrefetcher(lambda key, generation: release.wait(), 1, max_pending=3)
+    prefetcher.schedule([('busy', 0)])
+    wait_until(lambda: prefetcher.stats()['pending'] == 0)
+    prefetcher.schedule([('a', 0), ('b', 0), ('a', 0), ('a', 1), ('b', 1)])
+    assert prefetcher._pending_keys == {('b', 0), ('a', 1), ('b', 1)}
+    assert prefetcher.stats()['dropped'] == 1
+    prefetcher.cancel('b')
+    assert prefetcher._pending_keys == {('a', 1)}
+    release.set()
+
+
+def test_tiles_rendered_across_an_invalidation_are_not_cached():
+    cache = TileCache(1000)
+    started = threading.Event()
+    release = threading.Event()
+
+    def render(key, generation):
+        started.set()
+        release.wait()
+        cache.put(key, b'stale', generation)
+        return True
+
+    prefetcher = TilePrefetcher(render, 1)
+    prefetcher.schedule([('a', 0)], cache.generation('a'))
+    started.wait(5)
+    # The datasource is reloaded while the tile is rendered from its old data
+    cache.invalidate('a')
+    release.set()
+    wait_until(lambda: prefetcher.stats()['completed'] == 1)
+    assert ('a', 0) not in cache
+    cache.put(('a', 0), b'fresh', cache.generation('a'))
+    assert cache.get(('a', 0)) == b'fresh'
+    # Clearing the whole cache starts a new generation of every datasource
+    generation = cache.generation('a')
+    cache.invalidate()
+    cache.put(('a', 1), b'stale', generation)
+    assert ('a', 1) not in cache
+
+
+def test_render_tile_drops_tiles_of_a_reloaded_datasource(datasource):
+    data_model.load_datasource(datasource['name'])
+    key = (datasource['name'], (0,), 2, 0, 0, 'raw')
+    generation = data_model.tile_cache.generation(datasource['name'])
+    data_model.tile_cache.invalidate(datasource['name'])
+    assert data_model.render_tile(key, generation)
+    assert key not in data_model.tile_cache
+    assert not data_model.prefetch_tile(key, generation)
+    assert data_model.prefetch_tile(key, data_model.tile_cache.generation(datasource['name']))
+    assert key in data_model.tile_cache
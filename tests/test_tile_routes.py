@@ -0,0 +1,135 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from cycif_viewer.server.models import data_model
+from cycif_viewer.server.utils import tile_encoding
+from cycif_viewer.server.utils.segmentation_outlines import outline_mask
+from cycif_viewer.server.utils.tile_compositing import composite, make_composite
+from conftest import TILE
+
+
+def decode_raw(data):
+    [_, _, _, itemsize, _, channels, height, width] = tile_encoding.HEADER.unpack_from(data)
+    dtype = {1: '<u1', 2: '<u2', 4: '<u4'}[itemsize]
+    return np.frombuffer(data[tile_encoding.HEADER.size:], dtype=dtype).reshape(channels, height, width)
+
+
+def test_batch_tile(client, datasource):
+    response = client.get('/generated/batch/test/0/1_2?channels=2,0&format=raw')
+    assert response.status_code == 200
+    expected = datasource['channels'][[2, 0], 2 * TILE:3 * TILE, TILE:2 * TILE]
+    np.testing.assert_array_equal(decode_raw(response.data), expected)
+    # Edge tiles are cut at the level's border
+    response = client.get('/generated/batch/test/2/0_0?channels=1&format=raw')
+    np.testing.assert_array_equal(decode_raw(response.data), datasource['channels'][1:2, ::4, ::4])
+
+
+def test_batch_tile_errors(client):
+    for url in ['/generated/batch/test/0/0_0?channels=0,3', '/generated/batch/test/0/0_0?channels=-1',
+                '/generated/batch/test/0/0_0', '/generated/batch/test/0/0_0?channels=a',
+                '/generated/batch/test/9/0_0?channels=0', '/generated/batch/test/0/x_0?channels=0',
+                '/generated/batch/test/0/0_0?channels=0&format=png']:
+        assert client.get(url).status_code == 422, url
+    for url in ['/generated/batch/test/0/3_0?channels=0', '/generated/batch/test/0/0_4?channels=0',
+                '/generated/batch/test/2/1_0?channels=0', '/generated/batch/test/0/-1_0?channels=0',
+                '/generated/batch/missing/0/0_0?channels=0']:
+        assert client.get(url).status_code == 404, url
+
+
+def test_composite_tile(client, datasource):
+    response = client.get('/generated/composite/test/1/1_0?channels=0,2&colors=ff0000,00ff00'
+                          '&min=0,1000&max=60000,30000')
+    assert response.status_code == 200 and response.mimetype == 'image/png'
+    settings = make_composite([0, 2], ['ff0000', '00ff00'], [0, 1000], [60000, 30000])
+    expected = composite(datasource['channels'][[0, 2], :2 * TILE:2, 2 * TILE::2], settings)
+    np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(response.data))), expected)
+
+
+def test_composite_tile_errors(client):
+    for url in ['/generated/composite/test/0/0_0?channels=0,7&colors=ff0000,00ff00',
+                '/generated/composite/test/0/0_0?channels=0&colors=ff0000,00ff00',
+                '/generated/composite/test/0/0_0?channels=0',
+                '/generated/composite/test/9/0_0?channels=0&colors=ff0000',
+                '/generated/composite/test/0/x_0?channels=0&colors=ff0000',
+                '/generated/composite/test/0/0_0?channels=0&colors=ff0000&format=zstd']:
+        assert client.get(url).status_code == 422, url
+    for url in ['/generated/composite/test/0/40_40?channels=0&colors=ff0000',
+                '/generated/composite/test/2/0_1?channels=0&colors=ff0000',
+                '/generated/composite/missing/0/0_0?channels=0&colors=ff0000']:
+        assert client.get(url).status_code == 404, url
+
+
+def test_outline_tile(client, datasource):
+    response = client.get('/generated/outline/test/0/1_2')
+    assert response.status_code == 200
+    # Boundaries across the tile's edges are found as in the whole image
+    expected = outline_mask(np.pad(datasource['labels'], 1, mode='edge'))[2 * TILE:3 * TILE, TILE:2 * TILE]
+    np.testing.assert_array_equal(np.asarray(Image.open(io.BytesIO(response.data))), expected)
+    response = client.get('/generated/outline/test/0/1_2?bits=1&format=raw')
+    np.testing.assert_array_equal(decode_raw(response.data)[0], expected // 255)
+
+
+def test_outline_tile_errors(client):
+    for url in ['/generated/outline/test/0/0_0?bits=4', '/generated/outline/test/9/0_0',
+                '/generated/outline/test/0/0_x', '/generated/outline/test/0/0_0?format=gif']:
+        assert client.get(url).status_code == 422, url
+    for url in ['/generated/outline/test/0/3_0', '/generated/outline/test/1/0_2', '/generated/outline/missing/0/0_0']:
+        assert client.get(url).status_code == 404, url
+
+
+def test_label_color_tile(client, datasource):
+    response = client.get('/generated/labels/test/1/0_1')
+    assert response.status_code == 200
+    rgba = np.asarray(Image.open(io.BytesIO(response.data)))
+    labels = datasource['labels'][2 * TILE:4 * TILE:2, :2 * TILE:2]
+    assert rgba.shape == labels.shape + (4,)
+    np.testing.assert_array_equal(rgba[labels == 0], 0)
+    # Cells of a phenotype share its color from the color scheme
+    scheme = data_model.get_color_scheme('test', False)
+    phenotypes = datasource['cells']['phenotype'].to_numpy()[labels[labels > 0] - 1]
+    colors = np.array([list(scheme[phenotype]['rgb']) + [255] for phenotype in phenotypes])
+    np.testing.assert_array_equal(rgba[labels > 0], colors)
+
+
+def test_label_color_tile_errors(client):
+    for url in ['/generated/labels/test/9/0_0', '/generated/labels/test/0/0_x', '/generated/labels/test/0/0_0?field=M9',
+                '/generated/labels/test/0/0_0?format=raw']:
+        assert client.get(url).status_code == 422, url
+    for url in ['/generated/labels/test/0/3_0', '/generated/labels/test/2/0_1', '/generated/labels/missing/0/0_0']:
+        assert client.get(url).status_code == 404, url
+
+
+def test_aggregate_tile(client, datasource):
+    cells = datasource['cells']
+    # Bins of level 1 cover 32 image pixels, a tile holds 8 x 8 of them and the raster is 12 bins wide
+    bx = (cells['X_centroid'].to_numpy(np.float32) // 32).astype(int)
+    by = (cells['Y_centroid'].to_numpy(np.float32) // 32).astype(int)
+    in_tile = (bx >= 8) & (by < 8)
+    response = client.get('/generated/aggregate/test/1/1_0?field=phenotype')
+    assert response.status_code == 200
+    counts = decode_raw(response.data)
+    phenotypes = client.get('/get_aggregate_info?datasource=test').get_json()['phenotypes']
+    for i, phenotype in enumerate(phenotypes):
+        expected = np.zeros((8, 4), dtype=np.uint32)
+        selected = in_tile & (cells['phenotype'] == phenotype).to_numpy()
+        np.add.at(expected, (by[selected], bx[selected] - 8), 1)
+        np.testing.assert_array_equal(counts[i], expected)
+    density = decode_raw(client.get('/generated/aggregate/test/1/1_0?field=density').data)
+    np.testing.assert_array_equal(density[0], counts.sum(axis=0))
+    # Edge tiles are cut at the raster border, level 2 is 384 / 64 = 6 bins wide
+    means = client.get('/generated/aggregate/test/2/0_0?field=M0&format=raw')
+    assert means.status_code == 200
+    assert np.frombuffer(means.data[tile_encoding.HEADER.size:], dtype='<f4').size == 8 * 6
+
+
+def test_aggregate_tile_errors(client):
+    for url in ['/generated/aggregate/test/3/0_0', '/generated/aggregate/test/-1/0_0',
+                '/generated/aggregate/test/a/0_0', '/generated/aggregate/test/0/0_x',
+                '/generated/aggregate/test/0/0_0?field=missing',
+                '/generated/aggregate/test/0/0_0?format=png']:
+        assert client.get(url).status_code == 422, url
+    for url in ['/generated/aggregate/test/0/3_0', '/generated/aggregate/test/0/0_4', '/generated/aggregate/test/2/1_0',
+                '/generated/aggregate/test/0/-1_0', '/generated/aggregate/missing/0/0_0']:
+        assert client.get(url).status_code == 404, url